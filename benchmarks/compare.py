@@ -0,0 +1,69 @@
+"""Compare two benchmark result files.
+
+Run from the repo root::
+
+    python -m benchmarks.compare old.json new.json
+
+Prints the median time of every case in both files and their ratio.
+Exits with 1 if any case got slower than the threshold.
+"""
+import sys
+import json
+import argparse
+
+DEFAULT_THRESHOLD = 1.2
+
+_KEY_FIELDS = ("stage", "resolution", "algorithm", "collision", "engine")
+
+
+def case_name(result: dict) -> str:
+    """Get a readable name for a benchmark case."""
+    return " ".join(str(result[field]) for field in _KEY_FIELDS if result.get(field) is not None)
+
+
+def load_results(path: str) -> dict:
+    """Load a result file as case name -> result."""
+    with open(path, "r") as fh:
+        return {case_name(result): result for result in json.load(fh)["results"]}
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser("Compare two mp3toimage benchmark result files")
+    parser.add_argument("old", help="Path to the baseline results")
+    parser.add_argument("new", help="Path to the results to check")
+    parser.add_argument(
+        "--threshold", action="store", type=float, default=DEFAULT_THRESHOLD,
+        help=f"Slowdown ratio (new / old median) that counts as a regression (default {DEFAULT_THRESHOLD})")
+    args = parser.parse_args()
+
+    old = load_results(args.old)
+    new = load_results(args.new)
+
+    regressions = 0
+    width = max((len(name) for name in new), default=0)
+    for name, result in new.items():
+        baseline = old.get(name)
+        if baseline is None or "median" not in baseline or "median" not in result:
+            status = result.get("error") or ("timeout" if "timeout" in result else "new")
+            if baseline is not None and "median" not in baseline:
+                status = "no baseline"
+            print(f"{name:<{width}}  {status}")
+            continue
+
+        ratio = result["median"] / baseline["median"] if baseline["median"] else float("inf")
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  SLOWER"
+            regressions += 1
+        elif ratio < 1 / args.threshold:
+            flag = "  faster"
+        print(f"{name:<{width}}  {baseline['median']:.6f}s -> {result['median']:.6f}s  x{ratio:.2f}{flag}")
+
+    if regressions:
+        print(f"{regressions} case(s) slower than x{args.threshold}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
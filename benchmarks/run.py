@@ -0,0 +1,471 @@
+"""Benchmark each stage of the render pipeline on a synthetic song.
+
+Run from the repo root::
+
+    python -m benchmarks.run -r 64x64 -r 256x256 --out results.json
+
+Every stage is timed on its own (decoding under every decode mode, tempo
+analysis under every analysis profile, per-pixel analysis,
+get_info_at_pixel, generate_pixels, every walking algorithm under every
+collision mode and engine, the per-pixel garbage algorithm, image encoding,
+.pb writing and animations), as is rendering all the resolutions one by
+one vs in a single pass, rendering a few songs with and without decoding
+ahead and the cold start of the command line, and the results are written
+as JSON. Compare two result files with
+benchmarks.compare.
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from typing import Callable, List
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.compare import case_name
+from benchmarks.synthetic import make_song
+from mp3toimage import analysis
+from mp3toimage.animation import DEFAULT_FRAME_DURATION, DEFAULT_FRAME_INTERVAL, FORMATS, FrameRecorder
+from mp3toimage.output import DEFAULT_COMPRESS_LEVEL, ImageWriter, OutputError, check_format
+from mp3toimage.playback import PlaybackRecorder
+from mp3toimage.song import DECODE_MODES, NotEnoughSong, SongAnalysis, SongImage
+from mp3toimage.util import generate_pixels, Point, Color
+
+DEFAULT_RESOLUTIONS = ("64x64", "256x256", "512x512")
+DEFAULT_REPEAT = 3
+DEFAULT_TIMEOUT = 20  # seconds per algorithm case
+
+#: Collision mode name -> command line flags
+COLLISION_MODES = {
+    "turn": {},
+    "wrap": {"wrap_collisions": True},
+    "collide_180": {"collide_180": True}
+}
+ENGINES = ("python", "kernel")
+#: Stage name -> output settings benchmarked besides the default PNG
+ENCODERS = {
+    "png_encode_level1": ImageWriter("png", compress_level=1),
+    "png_encode_palette": ImageWriter("png", palette=True),
+    "webp_encode": ImageWriter("webp", compress_level=0),
+    "qoi_encode": ImageWriter("qoi")
+}
+
+
+def render_args(**kwargs) -> argparse.Namespace:
+    """Get the command line arguments of a render with the defaults of mp3toimage."""
+    args = argparse.Namespace(
+        alg="basic", seed=0, wrap_collisions=False, collide_180=False, start_middle=False,
+        four_directions=False, playback=False, playback_compress=False, engine="python", single_pass=False,
+        image_format="png", compress_level=DEFAULT_COMPRESS_LEVEL, palette=False, writer_threads=0,
+        animate=None, frame_interval=DEFAULT_FRAME_INTERVAL, frame_duration=DEFAULT_FRAME_DURATION,
+        beat_color=Color(255, 221, 74, 255), off_beat_color=Color(60, 105, 151, 255))
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def timed(func: Callable, repeat: int, setup: Callable = None) -> dict:
+    """Time ``func`` ``repeat`` times after one untimed warm up run.
+
+    ``setup`` is called (untimed) before every run and its result is
+    passed to ``func``.
+    """
+    times = []
+    for run in range(repeat + 1):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        if setup is not None:
+            func(arg)
+        else:
+            func()
+        elapsed = time.perf_counter() - start
+        if run:
+            times.append(elapsed)
+
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "times": times
+    }
+
+
+def startup_stages(repeat: int) -> List[dict]:
+    """Benchmark the cold start of mp3toimage in a new interpreter.
+
+    Times printing the help and failing on an invalid argument, which
+    should return before anything heavy is imported.
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def run(*argv):
+        subprocess.run(
+            [sys.executable, "-m", "mp3toimage", *argv], cwd=repo_dir,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    return [
+        dict(stage="cold_start_help", **timed(lambda: run("-h"), repeat)),
+        dict(stage="cold_start_invalid_args", **timed(lambda: run("-s", "song.mp3", "--alg", "invalid"), repeat))
+    ]
+
+
+def song_stages(song_path: str, repeat: int) -> List[dict]:
+    """Benchmark the stages that only depend on the song."""
+    results = []
+    decoded = []
+
+    def decode():
+        decoded[:] = SongImage._load_samples(song_path)
+
+    results.append(dict(stage="decode", **timed(decode, repeat)))
+
+    # The other decode modes. The auto mode decodes for a 32x32 icon.
+    default_mode = SongImage.decode_mode
+    try:
+        for mode in DECODE_MODES:
+            if mode == default_mode:
+                continue
+            SongImage.decode_mode = mode
+            results.append(dict(
+                stage=f"decode_{mode}", **timed(lambda: SongImage._load_samples(song_path, 32 * 32), repeat)))
+    finally:
+        SongImage.decode_mode = default_mode
+
+    _duration, time_series, sample_rate, _reference_samples = decoded
+    results.append(dict(
+        stage="analysis", **timed(lambda: analysis.measure_tempo(time_series, sample_rate), repeat)))
+    for profile in ("fast", "excerpt", "full"):
+        params = {"profile": profile}
+        results.append(dict(
+            stage=f"analysis_{profile}",
+            **timed(lambda: analysis.analyze(song_path, time_series, sample_rate, params), repeat)))
+    return results
+
+
+def resolution_stages(song_path: str, resolution: Point, repeat: int) -> List[dict]:
+    """Benchmark the stages that depend on the resolution (except the algorithms)."""
+    res_name = f"{resolution.x}x{resolution.y}"
+    results = []
+
+    # The song is decoded once and cached, so this times the per-pixel analysis
+    SongImage.load(song_path)
+    results.append(dict(
+        stage="pixel_analysis", resolution=res_name,
+        **timed(lambda: SongImage(song_path, resolution), repeat)))
+
+    song = SongImage(song_path, resolution)
+
+    def get_info():
+        for pixel_idx in range(song.num_pixels):
+            song.get_info_at_pixel(pixel_idx)
+
+    results.append(dict(stage="get_info_at_pixel", resolution=res_name, **timed(get_info, repeat)))
+    results.append(dict(
+        stage="generate_pixels", resolution=res_name,
+        **timed(lambda: generate_pixels(resolution), repeat)))
+
+    # Encode and write what a real render produces. The wrap mode always finishes.
+    import mp3toimage.algorithms.basic as basic
+    pixels = generate_pixels(resolution)
+    pb_list = PlaybackRecorder(song.pixel_time)
+    basic.generate_image(
+        pixels, song, render_args(wrap_collisions=True, engine="kernel", playback=True), pb_list=pb_list)
+
+    results.append(dict(
+        stage="png_encode", resolution=res_name,
+        **timed(lambda: Image.fromarray(pixels).save(io.BytesIO(), format="PNG"), repeat)))
+
+    # The other output settings
+    colors = (Color(60, 105, 151, 255), Color(255, 221, 74, 255))
+    for stage, writer in ENCODERS.items():
+        try:
+            check_format(writer.image_format)
+        except OutputError:
+            continue
+        results.append(dict(
+            stage=stage, resolution=res_name,
+            **timed(lambda: writer.save(pixels, io.BytesIO(), colors), repeat)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pb_path = os.path.join(tmp_dir, "song.pb")
+        results.append(dict(
+            stage="pb_write", resolution=res_name,
+            **timed(lambda: pb_list.write(pb_path, song_path, resolution), repeat)))
+
+        # The same walk drawn as an animation (compare with the algorithm case)
+        for animate, ext in FORMATS.items():
+            anim_args = render_args(wrap_collisions=True, engine="kernel", animate=animate)
+            anim_path = os.path.join(tmp_dir, "song" + ext)
+
+            def animate_walk():
+                with FrameRecorder(anim_path, song, anim_args) as recorder:
+                    basic.generate_image(generate_pixels(resolution), song, anim_args, pb_list=recorder)
+
+            results.append(dict(stage=f"animate_{animate}", resolution=res_name, **timed(animate_walk, repeat)))
+    return results
+
+
+def multi_resolution_stages(song_path: str, resolutions: List[Point], repeat: int) -> List[dict]:
+    """Benchmark rendering every resolution one by one and in a single pass.
+
+    Raises AssertionError if the single pass analyzes a pixel differently.
+    """
+    import mp3toimage.__main__ as cli
+    cli.ALGORITHMS = cli.discover_algorithms()
+    res_name = "+".join(f"{res.x}x{res.y}" for res in resolutions)
+
+    song_analysis = SongAnalysis(song_path, resolutions)
+    for resolution in resolutions:
+        try:
+            song = SongImage(song_path, resolution)
+        except NotEnoughSong:
+            continue
+        single_pass = song_analysis.song_image(resolution)
+        for field in ("timestamps", "beats", "amplitudes"):
+            assert np.array_equal(getattr(song, field), getattr(single_pass, field)), \
+                f"The single pass {field} of {resolution.x}x{resolution.y} differ"
+
+    def each(args):
+        for resolution in resolutions:
+            cli.generate_image(resolution, song_path, args)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The wrap mode always finishes
+        args = render_args(wrap_collisions=True, engine="kernel", out_dir=tmp_dir)
+        results.append(dict(stage="render_each", resolution=res_name, **timed(lambda: each(args), repeat)))
+        results.append(dict(
+            stage="render_single_pass", resolution=res_name,
+            **timed(lambda: cli.generate_images(resolutions, song_path, args), repeat)))
+    return results
+
+
+def library_stages(song_path: str, resolution: Point, repeat: int, num_songs: int = 4) -> List[dict]:
+    """Benchmark rendering a small library with and without decoding the next songs ahead."""
+    import mp3toimage.__main__ as cli
+    from mp3toimage.prefetch import prefetch
+    cli.ALGORITHMS = cli.discover_algorithms()
+    res_name = f"{resolution.x}x{resolution.y}"
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Copies of the song so every one of them is decoded
+        _, ext = os.path.splitext(song_path)
+        renders = []
+        for idx in range(num_songs):
+            copy_path = os.path.join(tmp_dir, f"song{idx}{ext}")
+            shutil.copyfile(song_path, copy_path)
+            renders.append((copy_path, [resolution]))
+        args = render_args(wrap_collisions=True, engine="kernel", out_dir=tmp_dir)
+
+        def render_library(depth):
+            for path, song_resolutions in prefetch(renders, depth):
+                for song_resolution in song_resolutions:
+                    cli.generate_image(song_resolution, path, args)
+                SongImage._song_cache.release(path)
+
+        for depth in (0, 1, 2):
+            results.append(dict(
+                stage=f"render_library_prefetch{depth}", resolution=res_name,
+                **timed(lambda: render_library(depth), repeat)))
+    return results
+
+
+def _init_worker() -> None:
+    """Set up a worker process for the algorithm cases."""
+    import mp3toimage.__main__ as cli
+    cli.ALGORITHMS = cli.discover_algorithms()
+
+
+def algorithm_case(song_path: str, resolution: tuple, alg: str, collision: str, engine: str, repeat: int) -> dict:
+    """Benchmark one algorithm at one resolution, collision mode and engine."""
+    import mp3toimage.__main__ as cli
+
+    resolution = Point(*resolution)
+    song = SongImage(song_path, resolution)
+    args = render_args(alg=alg, engine=engine or "python", **COLLISION_MODES[collision or "turn"])
+    result = timed(
+        lambda pixels: cli.ALGORITHMS[alg].generate_image(pixels, song, args, pb_list=None),
+        repeat, setup=lambda: generate_pixels(resolution))
+    result["pixels_per_second"] = song.num_pixels / result["median"] if result["median"] else None
+    return result
+
+
+def algorithm_stages(song_path: str, resolutions: List[Point], repeat: int, timeout: float) -> List[dict]:
+    """Benchmark every algorithm, collision mode and engine at every resolution.
+
+    Algorithms that draw every pixel on its own (PER_PIXEL, e.g. garbage)
+    don't depend on the collision mode or engine and run once per
+    resolution, as the throughput reference of the walks. Every case
+    records its pixels per second.
+
+    Each case runs in a worker process so a walk that never finishes is
+    stopped after ``timeout`` seconds and recorded as a timeout.
+    """
+    import mp3toimage.__main__ as cli
+    registry = cli.discover_algorithms()
+    algorithms = sorted(registry)
+
+    results = []
+    pool = multiprocessing.Pool(1, initializer=_init_worker)
+    try:
+        for resolution in resolutions:
+            for alg in algorithms:
+                cases = [(collision, engine) for collision in COLLISION_MODES for engine in ENGINES]
+                if getattr(registry[alg], "PER_PIXEL", False):
+                    cases = [(None, None)]
+                for collision, engine in cases:
+                    result = dict(
+                        stage="algorithm", resolution=f"{resolution.x}x{resolution.y}",
+                        algorithm=alg, collision=collision, engine=engine)
+                    print(f"\t{case_name(result)}...", end="", flush=True)
+                    pending = pool.apply_async(
+                        algorithm_case,
+                        (song_path, (resolution.x, resolution.y), alg, collision, engine, repeat))
+                    try:
+                        result.update(pending.get(timeout * (repeat + 1)))
+                        print(f"{result['median']:.4f}s", flush=True)
+                    except multiprocessing.TimeoutError:
+                        result["timeout"] = timeout
+                        print("Timed out.", flush=True)
+                        pool.terminate()
+                        pool = multiprocessing.Pool(1, initializer=_init_worker)
+                    except Exception as exc:
+                        result["error"] = f"{type(exc).__name__}: {exc}"
+                        print(f"Failed. {result['error']}", flush=True)
+                    results.append(result)
+    finally:
+        pool.terminate()
+    return results
+
+
+def environment() -> dict:
+    """Describe where the benchmarks ran."""
+    packages = {}
+    for name in ("numpy", "librosa", "numba", "PIL", "soundfile"):
+        try:
+            packages[name] = __import__(name).__version__
+        except ImportError:
+            packages[name] = None
+
+    commit = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": packages
+    }
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser("Benchmark the mp3toimage render pipeline")
+    parser.add_argument(
+        "-r", "--resolution", action="append",
+        help="Resolution to benchmark in the form <num>x<num>. Can be called multiple times "
+             f"(default {', '.join(DEFAULT_RESOLUTIONS)}).")
+    parser.add_argument(
+        "--repeat", action="store", type=int, default=DEFAULT_REPEAT,
+        help=f"Timed runs per stage (default {DEFAULT_REPEAT})")
+    parser.add_argument(
+        "--timeout", action="store", type=float, default=DEFAULT_TIMEOUT,
+        help=f"Seconds an algorithm run may take before it's stopped (default {DEFAULT_TIMEOUT})")
+    parser.add_argument(
+        "--duration", action="store", type=float, default=30.0,
+        help="Length of the synthetic song in seconds (default 30)")
+    parser.add_argument(
+        "--bpm", action="store", type=float, default=120.0,
+        help="Tempo of the synthetic song (default 120)")
+    parser.add_argument(
+        "--song", action="store", default=None,
+        help="Benchmark with this song file instead of a synthetic one.")
+    parser.add_argument(
+        "--skip-algorithms", action="store_true",
+        help="Don't benchmark the algorithms.")
+    parser.add_argument(
+        "--out", action="store", default=None,
+        help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    resolutions = []
+    for res in args.resolution or DEFAULT_RESOLUTIONS:
+        try:
+            x, y = res.split("x")
+            resolutions.append(Point(int(x), int(y)))
+        except ValueError as exc:
+            print(f"Invalid resolution format. Expected <num>x<num> (e.g. 512x512): {exc}")
+            sys.exit(1)
+
+    # The progress goes to stderr when the results go to stdout
+    if args.out is None:
+        sys.stdout = sys.stderr
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        song_path = args.song
+        if song_path is None:
+            song_path = make_song(os.path.join(tmp_dir, "synthetic.wav"), duration=args.duration, bpm=args.bpm)
+
+        print("Benchmarking startup...", flush=True)
+        results = startup_stages(args.repeat)
+        print("Benchmarking song stages...", flush=True)
+        results.extend(song_stages(song_path, args.repeat))
+        for resolution in resolutions:
+            print(f"Benchmarking {resolution.x}x{resolution.y}...", flush=True)
+            try:
+                results.extend(resolution_stages(song_path, resolution, args.repeat))
+            except NotEnoughSong as exc:
+                print(f"\tSkipped. {exc}", flush=True)
+                resolutions = [res for res in resolutions if res is not resolution]
+
+        if resolutions:
+            print("Benchmarking multi-resolution renders...", flush=True)
+            results.extend(multi_resolution_stages(song_path, resolutions, args.repeat))
+            print("Benchmarking library renders...", flush=True)
+            results.extend(library_stages(song_path, resolutions[0], args.repeat))
+
+        if not args.skip_algorithms:
+            print("Benchmarking algorithms...", flush=True)
+            results.extend(algorithm_stages(song_path, resolutions, args.repeat, args.timeout))
+
+    report = {
+        "environment": environment(),
+        "config": {
+            "song": args.song or "synthetic",
+            "duration": args.duration,
+            "bpm": args.bpm,
+            "resolutions": [f"{res.x}x{res.y}" for res in resolutions],
+            "repeat": args.repeat
+        },
+        "results": results
+    }
+
+    if args.out is None:
+        sys.stdout = sys.__stdout__
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.out, "w") as fh:
+            json.dump(report, fh, indent=2)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
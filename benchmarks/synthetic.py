@@ -0,0 +1,34 @@
+"""Synthetic songs for the benchmarks, so no real music is needed."""
+import numpy as np
+import soundfile
+
+
+def make_song(
+    path: str, duration: float = 30.0, bpm: float = 120.0, sample_rate: int = 44100,
+    channels: int = 2, seed: int = 0) -> str:
+    """Write a song with a steady beat to ``path`` (the format follows the extension)."""
+    rng = np.random.default_rng(seed)
+    num_samples = int(duration * sample_rate)
+    times = np.arange(num_samples) / sample_rate
+
+    # A bass line that changes note every bar over a bit of noise
+    beat_time = 60.0 / bpm
+    notes = np.array([55.0, 65.41, 73.42, 82.41])
+    bar = (times // (beat_time * 4)).astype(np.int64) % len(notes)
+    song = 0.3 * np.sin(2 * np.pi * notes[bar] * times)
+    song += 0.05 * rng.standard_normal(num_samples)
+
+    # A decaying click on every beat for the tempo analysis to find
+    click_len = int(0.05 * sample_rate)
+    click = rng.standard_normal(click_len) * np.exp(-np.linspace(0, 8, click_len))
+    for start in np.arange(0, duration, beat_time):
+        start = int(start * sample_rate)
+        end = min(start + click_len, num_samples)
+        song[start:end] += 0.6 * click[:end - start]
+
+    song = np.clip(song, -1.0, 1.0).astype(np.float32)
+    if channels > 1:
+        # Shift the channels a little so the mixdown isn't a no-op
+        song = np.stack([np.roll(song, channel) for channel in range(channels)], axis=1)
+    soundfile.write(path, song, sample_rate)
+    return path
@@ -1,19 +1,28 @@
 """Main module for mp3toimage."""
 import os
 import sys
-import pkgutil
 import argparse
-import importlib
-from typing import List
-
-from PIL import Image
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 import mp3toimage.algorithms
-from mp3toimage.song import NotEnoughSong, SongImage
-from mp3toimage.util import generate_pixels, Point, Color
+from mp3toimage import analysis, animation, kernel, profiling
+from mp3toimage.cache import (
+    AnalysisCache, SongCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, DEFAULT_MEMORY_CACHE_SIZE)
+from mp3toimage.canvas import CanvasPool
+from mp3toimage.manifest import Manifest
+from mp3toimage.output import FORMATS, DEFAULT_COMPRESS_LEVEL, ImageWriter, OutputError, check_format
+from mp3toimage.parallel import render_songs
+from mp3toimage.playback import PlaybackRecorder, check_resolution
+from mp3toimage.prefetch import DEFAULT_PREFETCH, prefetch
+from mp3toimage.song import DECODE_MODES, NotEnoughSong, SongAnalysis, SongImage
+from mp3toimage.util import Point, Color
 
 VALID_SONG_EXTS = (".mp3", ".m4a", ".ogg", ".flac")
 ALGORITHMS = None
+CANVAS_POOL = CanvasPool()
+IMAGE_WRITER = ImageWriter()
 
 
 def get_songs_from_dir(song_dir: str, recursive: bool = False) -> List[str]:
@@ -42,14 +51,19 @@ def validate_color(color: str) -> Color:
     return Color(int(r), int(g), int(b), 255)
 
 
-def iter_namespace(ns_pkg):
-    """Iterate a namespace."""
-    return pkgutil.iter_modules(ns_pkg.__path__, ns_pkg.__name__ + ".")
+def discover_algorithms() -> mp3toimage.algorithms.Registry:
+    """Get the algorithm plugins keyed by their name (imported when they're used)."""
+    return mp3toimage.algorithms.Registry()
 
 
-def generate_image(resolution: Point, song_path: str, args: argparse.Namespace):
-    """Generate an image from a song."""
+def output_paths(resolution: Point, song_path: str, args: argparse.Namespace) -> Tuple[str, str, str]:
+    """Get the image, playback file and animation paths of a render.
+
+    The playback file and animation paths are None without --playback and
+    --animate.
+    """
     pb_file = None
+    anim_file = None
     out_file, _ = os.path.splitext(os.path.basename(song_path))
     out_file += f"-{resolution.x}x{resolution.y}"
     if args.wrap_collisions:
@@ -62,40 +76,128 @@ def generate_image(resolution: Point, song_path: str, args: argparse.Namespace):
         out_file += "-4dir"
     if args.playback:
         pb_file = os.path.join(args.out_dir, out_file + ".pb")
-    out_file += f"-{args.alg}.png"
-    out_path = os.path.join(args.out_dir, out_file)
+    out_file += f"-{args.alg}"
+    if args.animate:
+        anim_file = os.path.join(args.out_dir, out_file + animation.FORMATS[args.animate])
+    out_file += FORMATS[args.image_format]
+    return os.path.join(args.out_dir, out_file), pb_file, anim_file
+
+
+def record_render(manifest: Manifest, song_path: str, resolution: Point, args: argparse.Namespace, result: str) -> None:
+    """Record a finished render in the manifest (nothing without --incremental).
+
+    A render that was drawn is recorded once its image is saved, which
+    can be after the writer threads are done with it.
+    """
+    if manifest is None:
+        return
+    if result != "Done.":
+        manifest.record(song_path, resolution, args, [])
+        return
+
+    outputs = [path for path in output_paths(resolution, song_path, args) if path is not None]
+    IMAGE_WRITER.when_saved(outputs[0], lambda: manifest.record(song_path, resolution, args, outputs))
 
-    pb_list = [] if args.playback else None
+
+def generate_image(resolution: Point, song_path: str, args: argparse.Namespace):
+    """Generate an image from a song."""
+    profiling.set_labels(song=song_path, resolution=f"{resolution.x}x{resolution.y}")
 
     # Process the song
     song = SongImage(song_path, resolution)
+    render_image(song, args)
+
+
+def render_image(song: SongImage, args: argparse.Namespace):
+    """Walk an analyzed song and save the image (and playback file and animation)."""
+    resolution = song.resolution
+    song_path = song.filename
+    out_path, pb_file, anim_file = output_paths(resolution, song_path, args)
+
+    pb_list = PlaybackRecorder(song.pixel_time) if args.playback else None
+    # The animation is drawn from the pixel changes as the walk goes
+    recorder = contextlib.nullcontext(pb_list)
+    if anim_file:
+        recorder = animation.FrameRecorder(anim_file, song, args, playback=pb_list)
 
     # Get an array of transparent pixels
-    img_pixels = generate_pixels(resolution)
+    with profiling.stage("generate_pixels"):
+        img_pixels = CANVAS_POOL.acquire(resolution)
 
     # Edit the pixels in place based on the song
-    ALGORITHMS[args.alg].generate_image(img_pixels, song, args, pb_list=pb_list)
+    with profiling.stage("algorithm"), recorder as changes:
+        ALGORITHMS[args.alg].generate_image(img_pixels, song, args, pb_list=changes)
 
-    # Create the image from our multi-dimmensional array of pixels
-    img = Image.fromarray(img_pixels)
-    img.save(out_path)
+    # Create the image from our multi-dimmensional array of pixels. The
+    # canvas goes back to the pool once it's encoded.
+    IMAGE_WRITER.write(
+        img_pixels, out_path, colors=(args.off_beat_color, args.beat_color), done=CANVAS_POOL.release)
 
     if pb_file and pb_list:
-        with open(pb_file, "w") as fh:
-            fh.write(os.path.abspath(song_path) + "\n")
-            fh.write(f"{resolution.x},{resolution.y}\n")
-            for item in pb_list:
-                fh.write(str(item) + "\n")
+        with profiling.stage("pb_write"):
+            pb_list.write(pb_file, song_path, resolution, compress=args.playback_compress)
+
+
+def _concurrent_walks(args: argparse.Namespace) -> bool:
+    """Check if the walks of a song's resolutions can run on threads at the same time."""
+    if args.engine != "kernel" or not kernel.compiled():
+        # Only the compiled kernel lets go of the GIL while it walks
+        return False
+    if args.collide_180:
+        # Collide-180 walks leave the shared directions flipped for the next walk
+        return False
+    # cProfile can only follow one thread
+    profiler = profiling.active()
+    return profiler is None or profiler.profile_stage is None
+
+
+def generate_images(resolutions: List[Point], song_path: str, args: argparse.Namespace) -> List[str]:
+    """Generate images from a song at several resolutions in one pass.
+
+    The song is analyzed once for all the resolutions (see SongAnalysis)
+    and, with the compiled kernel, the walks run on threads at the same
+    time. Returns the result of every resolution ("Done." or why it failed).
+    """
+    profiling.set_labels(song=song_path, resolution=None)
+    song_analysis = SongAnalysis(song_path, resolutions)
+
+    songs = []
+    results = []
+    for resolution in resolutions:
+        profiling.set_labels(resolution=f"{resolution.x}x{resolution.y}")
+        try:
+            songs.append(song_analysis.song_image(resolution))
+            results.append("Done.")
+        except NotEnoughSong as exc:
+            results.append(f"Failed. {exc}")
+    del song_analysis
+
+    def render(song: SongImage) -> None:
+        profiling.set_labels(song=song_path, resolution=f"{song.resolution.x}x{song.resolution.y}")
+        render_image(song, args)
+
+    if len(songs) > 1 and _concurrent_walks(args):
+        with ThreadPoolExecutor(min(len(songs), os.cpu_count() or 1)) as executor:
+            # Draw the biggest images first so they don't finish last on their own
+            list(executor.map(render, sorted(songs, key=lambda song: -song.num_pixels)))
+    else:
+        for song in songs:
+            render(song)
+    return results
 
 
 def main():
     """Entry point."""
-    global ALGORITHMS
+    global ALGORITHMS, CANVAS_POOL, IMAGE_WRITER
+
+    if sys.argv[1:2] == ["serve"]:
+        # Long-running render server (see mp3toimage.serve)
+        from mp3toimage import serve
+        serve.main(sys.argv[2:])
+        return
 
     # Discover algorithm plugins and set the transparent color
-    ALGORITHMS = {
-        name.split(".")[-1]: importlib.import_module(name) for _finder, name, _ispkg in iter_namespace(mp3toimage.algorithms)
-    }
+    ALGORITHMS = discover_algorithms()
 
     parser = argparse.ArgumentParser("Convert an MP3 into an image")
     parser.add_argument(
@@ -114,8 +216,12 @@ def main():
         "-o", "--off-beat-color", action="store", default="60,105,151",
         help="Color used for off-beat pixels")
     parser.add_argument(
-        "--alg", action="store", default="basic", choices=ALGORITHMS.keys(),
-        help=f"Which algorithm to use. One of: {ALGORITHMS.keys()}")
+        "--alg", action="store", default="basic", choices=list(ALGORITHMS),
+        help=f"Which algorithm to use. One of: {', '.join(ALGORITHMS)}")
+    parser.add_argument(
+        "--seed", action="store", type=int, default=mp3toimage.algorithms.DEFAULT_SEED,
+        help="Seed of the random numbers of the algorithms that use them (garbage) "
+             f"(default {mp3toimage.algorithms.DEFAULT_SEED}).")
     parser.add_argument(
         "--start-middle", action="store_true",
         help="Set the start position in the middle of the image instead "
@@ -129,6 +235,113 @@ def main():
     parser.add_argument(
         "--playback", action="store_true",
         help="Playback the visualization live with the song after it's generated.")
+    parser.add_argument(
+        "--playback-compress", action="store_true",
+        help="Compress the records of the playback file.")
+    parser.add_argument(
+        "--animate", action="store", default=None, choices=animation.FORMATS.keys(),
+        help="Also save an animation of the image being drawn, with a frame every "
+             "--frame-interval seconds of the song. 'frames' writes raw RGBA frames (e.g. for "
+             "ffmpeg, the path can be a named pipe).")
+    parser.add_argument(
+        "--frame-interval", action="store", type=float, default=animation.DEFAULT_FRAME_INTERVAL,
+        help="Seconds of the song between the frames of the animation "
+             f"(default {animation.DEFAULT_FRAME_INTERVAL:g}).")
+    parser.add_argument(
+        "--frame-duration", action="store", type=int, default=animation.DEFAULT_FRAME_DURATION,
+        help="How long each frame of the animation is shown in ms "
+             f"(default {animation.DEFAULT_FRAME_DURATION}).")
+    parser.add_argument(
+        "--engine", action="store", default="python", choices=("python", "kernel"),
+        help="Walk engine for the walking algorithms. 'kernel' runs the walk on integer "
+             "arrays and is compiled with numba when it is installed.")
+    parser.add_argument(
+        "--cache-dir", action="store", default=DEFAULT_CACHE_DIR,
+        help=f"Directory for the persistent cache of decoded songs (default {DEFAULT_CACHE_DIR})")
+    parser.add_argument(
+        "--cache-size", action="store", type=int, default=DEFAULT_CACHE_SIZE,
+        help=f"Size cap of the persistent song cache in MB (default {DEFAULT_CACHE_SIZE})")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Don't use the persistent song cache.")
+    parser.add_argument(
+        "--memory-cache-size", action="store", type=int, default=DEFAULT_MEMORY_CACHE_SIZE,
+        help="Size cap of the in-memory cache of decoded songs in MB "
+             f"(default {DEFAULT_MEMORY_CACHE_SIZE})")
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Analyze songs block by block instead of decoding them whole. Memory use "
+             "grows with the resolution instead of the song length, for very long songs. "
+             "Streamed songs follow --decode and skip the persistent song cache. Songs that "
+             "soundfile can't read are decoded whole.")
+    parser.add_argument(
+        "--decode", action="store", default="hq", choices=DECODE_MODES,
+        help="How songs are decoded. 'hq' resamples them to 22050 Hz with the best resampler "
+             "(default), 'fast' with a fast resampler and 'native' keeps their sample rate. 'auto' "
+             "keeps their sample rate and averages the samples down to what the biggest resolution "
+             "needs, which is a lot faster for small images.")
+    parser.add_argument(
+        "--analysis", action="store", default="default", choices=analysis.PROFILES,
+        help="How the tempo of songs is found. 'default' measures it on the whole song, 'fast' on "
+             "a downsampled song, 'excerpt' on --tempo-excerpt seconds from the middle of the song "
+             "and 'bpm' takes it from --bpm or the BPM tag of the song (with mutagen installed). "
+             "'full' also tracks the beats so beat pixels line up with them. Streamed songs only "
+             "follow 'bpm'.")
+    parser.add_argument(
+        "--bpm", action="store", type=float, default=None,
+        help="Tempo of the songs for the 'bpm' analysis (implies --analysis bpm).")
+    parser.add_argument(
+        "--tempo-excerpt", action="store", type=float, default=analysis.DEFAULT_EXCERPT,
+        help="Seconds of the song the 'excerpt' analysis measures the tempo on "
+             f"(default {analysis.DEFAULT_EXCERPT:g}).")
+    parser.add_argument(
+        "--canvas-mmap-dir", action="store", default=None,
+        help="Back the image canvases with memory-mapped files in this directory "
+             "instead of memory, for very large posters.")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="Time every stage of the pipeline and write a report per song to the output directory.")
+    parser.add_argument(
+        "--profile-format", action="store", default="json", choices=("json", "csv"),
+        help="Format of the profile reports (default json)")
+    parser.add_argument(
+        "--profile-stage", action="store", default=None, choices=profiling.STAGES,
+        help="Also run this stage under cProfile and write the stats per song to the "
+             "output directory (implies --profile).")
+    parser.add_argument(
+        "-j", "--jobs", action="store", type=int, default=1,
+        help="Number of worker processes used to render (default 1). Each song is "
+             "decoded once and its resolutions are rendered in parallel. Collide-180 walks "
+             "then each start from the same directions instead of the flips of the walks before.")
+    parser.add_argument(
+        "--single-pass", action="store_true",
+        help="Render all the resolutions of a song together: the song is analyzed once for "
+             "every resolution and the kernel engine walks them at the same time. With -j "
+             "the songs are rendered in parallel instead of the resolutions.")
+    parser.add_argument(
+        "--prefetch", action="store", type=int, default=DEFAULT_PREFETCH,
+        help="Number of songs decoded ahead on background threads while the current song "
+             f"is rendered (default {DEFAULT_PREFETCH}). 0 to decode each song in turn.")
+    parser.add_argument(
+        "--image-format", action="store", default="png", choices=FORMATS.keys(),
+        help="Format of the images (default png). WebP images are lossless.")
+    parser.add_argument(
+        "--compress-level", action="store", type=int, default=DEFAULT_COMPRESS_LEVEL,
+        help=f"zlib level of PNG images from 0 (fastest) to 9 (default {DEFAULT_COMPRESS_LEVEL}). "
+             "For WebP images, the encoder effort from 0 to 6.")
+    parser.add_argument(
+        "--palette", action="store_true",
+        help="Save PNG images with a palette of the beat, off-beat and transparent colors. "
+             "They're smaller and faster to encode.")
+    parser.add_argument(
+        "--writer-threads", action="store", type=int, default=0,
+        help="Number of threads that encode the images in the background while the next "
+             "image is drawn (default 0 to encode them in turn).")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Only render the songs and resolutions that changed since the last --incremental "
+             "run with the same settings. The renders are tracked in a manifest file in the "
+             "output directory.")
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
@@ -146,6 +359,16 @@ def main():
     else:
         args.resolution = list(set(args.resolution))  # Remove duplicate resolutions
 
+    # Validate the resolutions
+    resolutions = []
+    for res in args.resolution:
+        try:
+            x, y = res.split("x")
+            resolutions.append(Point(int(x), int(y)))
+        except ValueError as exc:
+            print(f"Invalid resolution format. Expected <num>x<num> (e.g. 512x512): {exc}")
+            sys.exit(1)
+
     # Validate the colors
     try:
         args.beat_color = validate_color(args.beat_color)
@@ -154,6 +377,56 @@ def main():
         print(f"Invalid color format. Expected <num>,<num>,<num>: {exc}")
         sys.exit(1)
 
+    # Validate the playback resolutions
+    if args.playback:
+        try:
+            for resolution in resolutions:
+                check_resolution(resolution)
+        except ValueError as exc:
+            print(f"Invalid resolution for --playback. {exc}")
+            sys.exit(1)
+
+    # Validate the analysis
+    if (args.bpm is not None and args.bpm <= 0) or args.tempo_excerpt <= 0:
+        print("Invalid analysis. The BPM and tempo excerpt must be positive.")
+        sys.exit(1)
+
+    # Validate the animation
+    if args.frame_interval <= 0 or not 0 < args.frame_duration <= 0xFFFF:
+        print("Invalid animation. The frame interval must be positive and the frame duration "
+              "between 1 and 65535 ms.")
+        sys.exit(1)
+
+    # Validate the image format
+    try:
+        check_format(args.image_format)
+    except OutputError as exc:
+        print(f"Invalid image format. {exc}")
+        sys.exit(1)
+
+    SongImage._song_cache = SongCache(max_bytes=args.memory_cache_size * 1024 * 1024)
+    if not args.no_cache:
+        SongImage.disk_cache = AnalysisCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+    if args.stream:
+        SongImage.stream_resolutions = resolutions
+    SongImage.decode_mode = args.decode
+    SongImage.decode_resolutions = resolutions
+    if args.bpm is not None:
+        args.analysis = "bpm"
+    SongImage.analysis_params = {"profile": args.analysis}
+    if args.analysis == "bpm":
+        SongImage.analysis_params["bpm"] = args.bpm
+    elif args.analysis == "excerpt":
+        SongImage.analysis_params["excerpt"] = args.tempo_excerpt
+    CANVAS_POOL = CanvasPool(mmap_dir=args.canvas_mmap_dir)
+    IMAGE_WRITER = ImageWriter.from_args(args)
+    args.profile = args.profile or args.profile_stage is not None
+    if args.profile_stage is not None:
+        # cProfile can only follow one thread
+        args.prefetch = 0
+    if args.profile:
+        profiling.enable(profiling.Profiler(profile_stage=args.profile_stage))
+
     song_paths = []
     # Expand any song directories
     for song_path in args.song:
@@ -173,31 +446,61 @@ def main():
         print("No valid song files provided.")
         sys.exit(1)
 
+    # Skip what an earlier incremental run already rendered
+    manifest = Manifest(args.out_dir) if args.incremental else None
+    renders = []
+    for song_path in song_paths:
+        song_resolutions = resolutions if manifest is None else manifest.stale(song_path, resolutions, args)
+        if song_resolutions:
+            renders.append((song_path, song_resolutions))
+
     print(f"Discovered {len(song_paths)} song(s) to process. Press cnrl+c to cancel")
+    if manifest is not None:
+        print(f"{len(song_paths) - len(renders)} song(s) are already rendered.")
 
     try:
-        for song_path in song_paths:
+        if args.jobs > 1:
+            render_songs(renders, args, manifest=manifest)
+            return
+
+        for song_path, song_resolutions in prefetch(renders, args.prefetch):
             print(f"Processing: {song_path}...", flush=True)
-            for res in args.resolution:
-                # Validate the resolution
-                try:
-                    x, y = res.split("x")
-                    resolution = Point(int(x), int(y))
-                except ValueError as exc:
-                    print(f"Invalid resolution format. Expected <num>x<num> (e.g. 512x512): {exc}")
-                    sys.exit(1)
-
-                # Generate the image
-                print(f"\t{res}...", end="", flush=True)
-                try:
-                    generate_image(resolution, song_path, args)
-                    print("Done.", flush=True)
-                except NotEnoughSong as exc:
-                    print(f"Failed. {exc}", flush=True)
+            profiling.set_labels(song=song_path, resolution=None)
+            if args.single_pass:
+                results = generate_images(song_resolutions, song_path, args)
+                for resolution, result in zip(song_resolutions, results):
+                    print(f"\t{resolution.x}x{resolution.y}...{result}", flush=True)
+                    record_render(manifest, song_path, resolution, args, result)
+            else:
+                for resolution in song_resolutions:
+                    # Generate the image
+                    print(f"\t{resolution.x}x{resolution.y}...", end="", flush=True)
+                    try:
+                        generate_image(resolution, song_path, args)
+                        result = "Done."
+                    except NotEnoughSong as exc:
+                        result = f"Failed. {exc}"
+                    print(result, flush=True)
+                    record_render(manifest, song_path, resolution, args, result)
+
+            # Every resolution is done so the decoded song isn't needed anymore.
+            # The images are still encoded while the next song is drawn.
+            SongImage._song_cache.release(song_path)
+            if args.profile:
+                IMAGE_WRITER.flush()
+                print(f"\tProfile: {profiling.finish_song(song_path, args.out_dir, args.profile_format)}")
             print("Done.", flush=True)
 
     except KeyboardInterrupt:
         print("Exiting...")
+    finally:
+        # Keep what was rendered even if the run was cancelled. The images
+        # are saved first so every render that finished is recorded.
+        try:
+            IMAGE_WRITER.close()
+        finally:
+            if manifest is not None:
+                manifest.save()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
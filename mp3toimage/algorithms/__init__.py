@@ -1,7 +1,12 @@
 """Algorithms for generating the images."""
+import pkgutil
 import argparse
+import importlib
+from collections.abc import Mapping
 
-from mp3toimage.util import Point, Color
+import numpy as np
+
+from mp3toimage.util import Point
 
 DIRECTIONS_45 = (
     Point(1, 0), Point(1, 1), Point(0, 1),
@@ -12,42 +17,22 @@ DIRECTIONS_90 = (
     Point(1, 0), Point(0, 1),
     Point(-1, 0), Point(0, -1)
 )
-
-
-class PlaybackItem:
-    """When doing live visualization, this represents a pixel."""
-
-    def __init__(self, position: Point, color: Color, timestamp: float, duration: float):
-        self.position = Point(position.x, position.y)
-        self.color = color
-        self.timestamp = timestamp
-        self.duration = duration
-        self.max_timestamp = self.timestamp + duration
-
-    def __str__(self):
-        return f"{self.position.x},{self.position.y},{self.color},{self.timestamp},{self.duration}"
-
-    def __eq__(self, o: object) -> bool:
-        return self.position.x == o.position.x and\
-               self.position.y == o.position.y
-
-    def __hash__(self) -> int:
-        return hash(self.position)
+#: Seed of the random numbers of the algorithms that use them
+DEFAULT_SEED = 0
 
 
 def test_direction(pos: Point, direction: Point, resolution: Point) -> bool:
     """Check if we can move in that direction."""
     # Compute the next position (the spot we will go
     # if we continue in this direction).
-    check_pos = Point(pos.x, pos.y)
-    check_pos.x += direction.x
-    check_pos.y += direction.y
+    check_x = pos.x + direction.x
+    check_y = pos.y + direction.y
 
     # Make sure we're not outside the bounds
     # of the image and if we are, flip directions
-    if check_pos.x >= resolution.x or check_pos.x < 0:
+    if check_x >= resolution.x or check_x < 0:
         return False
-    if check_pos.y >= resolution.y or check_pos.y < 0:
+    if check_y >= resolution.y or check_y < 0:
         return False
     return True
 
@@ -56,30 +41,35 @@ def update_position(
     pos: Point, direction: Point, resolution: Point,
     args: argparse.Namespace, turn_amnt: int,
     directions: tuple, direction_idx: int) -> Point:
-    """Update the pos or direction based on the input pos and direction."""
+    """Update the pos or direction based on the input pos and direction.
 
-    if args.wrap_collisions or args.collide_180:
-        check_pos = Point(pos.x, pos.y)
-        check_pos.x += direction.x
-        check_pos.y += direction.y
+    This is the step by step edge handling. The walkers read it from the
+    tables of mp3toimage.collision, which are checked against it.
+    """
 
     if args.wrap_collisions:
+        check_x = pos.x + direction.x
+        check_y = pos.y + direction.y
+
         # Wrap if we're outside the bounds
-        if check_pos.x >= resolution.x:
+        if check_x >= resolution.x:
             pos.x = 0
-        elif check_pos.x < 0:
+        elif check_x < 0:
             pos.x = resolution.x - 1
 
-        if check_pos.y >= resolution.y:
+        if check_y >= resolution.y:
             pos.y = 0
-        elif check_pos.y < 0:
+        elif check_y < 0:
             pos.y = resolution.y - 1
         return pos, direction
 
     if args.collide_180:
-        if check_pos.x >= resolution.x or check_pos.x < 0:
+        check_x = pos.x + direction.x
+        check_y = pos.y + direction.y
+
+        if check_x >= resolution.x or check_x < 0:
             direction.x *= -1
-        if check_pos.y >= resolution.y or check_pos.y < 0:
+        if check_y >= resolution.y or check_y < 0:
             direction.y *= -1
         return pos, direction
 
@@ -89,4 +79,44 @@ def update_position(
         direction_idx = direction_idx % len(directions)
         direction = directions[direction_idx]
 
-    return pos, direction
\ No newline at end of file
+    return pos, direction
+
+
+def load_cells(pixels: np.ndarray) -> list:
+    """Get the pixels of an RGBA canvas as a flat, row major list of packed colors.
+
+    The walkers compare and set the cells as plain integers (see
+    Color.packed), so a step doesn't allocate colors or numpy scalars.
+    Write them back with store_cells().
+    """
+    return pixels.view(np.uint32).reshape(-1).tolist()
+
+
+def store_cells(pixels: np.ndarray, cells: list) -> None:
+    """Write cells from load_cells() back to the canvas."""
+    pixels.view(np.uint32).reshape(-1)[:] = cells
+
+
+class Registry(Mapping):
+    """Algorithm plugins keyed by name.
+
+    Every module of this package is a plugin. They're listed without
+    being imported and a plugin is only imported the first time it's used.
+    """
+
+    def __init__(self):
+        self._names = sorted(name for _finder, name, _ispkg in pkgutil.iter_modules(__path__))
+        self._modules = {}
+
+    def __getitem__(self, name: str):
+        if name not in self._names:
+            raise KeyError(name)
+        if name not in self._modules:
+            self._modules[name] = importlib.import_module(f"{__name__}.{name}")
+        return self._modules[name]
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
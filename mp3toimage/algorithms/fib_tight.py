@@ -1,50 +1,79 @@
 """An algorithm using the Fibonacci sequence to choose direction that takes tighter turns than fib."""
 import argparse
 import numpy as np
-from typing import Iterator, List
+from typing import Iterator
 
+from mp3toimage import kernel
+from mp3toimage.playback import PlaybackRecorder
 from mp3toimage.song import SongImage
-from mp3toimage.util import Point, Color
-from mp3toimage.algorithms import DIRECTIONS_45, DIRECTIONS_90, PlaybackItem, update_position
+from mp3toimage.util import Color
+from mp3toimage.algorithms import DIRECTIONS_45, DIRECTIONS_90, load_cells, store_cells
+from mp3toimage.collision import Edges
 
 
-def fib() -> Iterator[int]:
-    """Fibonacci sequence."""
+def fib(modulus: int) -> Iterator[int]:
+    """Fibonacci sequence modulo ``modulus``.
+
+    Only the turns modulo the number of directions matter, and keeping
+    the terms reduced stops them from growing into ever longer integers.
+    """
     a, b = 0, 1
     while 1:
         yield a
-        a, b = b, a + b
+        a, b = b, (a + b) % modulus
 
 
-def generate_image(pixels: np.ndarray, song: SongImage, args: argparse.Namespace, pb_list: List[PlaybackItem] = None) -> None:
+def generate_image(pixels: np.ndarray, song: SongImage, args: argparse.Namespace, pb_list: PlaybackRecorder = None) -> None:
     """Walk the image."""
-    seq = fib()
-    pos = Point(0, 0)
+    x = y = 0
     if args.start_middle:
-        pos = Point(int(song.resolution.x / 2), int(song.resolution.y / 2))
+        x = int(song.resolution.x / 2)
+        y = int(song.resolution.y / 2)
 
     directions = DIRECTIONS_45
     if args.four_directions:
         directions = DIRECTIONS_90
+    seq = fib(len(directions))
+
+    if args.engine == "kernel":
+        kernel.walk(pixels, song, args, directions, kernel.TURN_FIB, False, pb_list=pb_list)
+        return
+
+    # Palette indexes of the playback colors (None when not recording)
+    off_beat_idx = beat_idx = None
+    if pb_list is not None:
+        off_beat_idx = pb_list.color_index(args.off_beat_color)
+        beat_idx = pb_list.color_index(args.beat_color)
+
+    # Work on packed colors and plain lists so the steps don't allocate
+    cells = load_cells(pixels)
+    width = song.resolution.x
+    transparent = Color.transparent().packed
+    off_beat_color = args.off_beat_color.packed
+    beat_color = args.beat_color.packed
+    beats = song.beats.tolist()
+    amps = song.amplitudes.tolist()
 
+    # Edge handling read from the collision tables
+    edges = Edges(directions, song.resolution, args)
     direction_idx = 0
-    direction = directions[direction_idx]
 
     for idx in range(song.num_pixels):
-        beat, amp, timestamp = song.get_info_at_pixel(idx)
-        pixel = Color.from_tuple(pixels[pos.y][pos.x])
+        amp = amps[idx]
+        cell = y * width + x
+        pixel = cells[cell]
 
         # Set the color
-        pixel_changed = False
-        if not beat and pixel == Color.transparent():
-            pixels[pos.y][pos.x] = args.off_beat_color.as_tuple()
-            pixel_changed = True
-        elif pixel == Color.transparent() or pixel == args.off_beat_color:
-            pixels[pos.y][pos.x] = args.beat_color.as_tuple()
-            pixel_changed = True
+        color_idx = None
+        if not beats[idx] and pixel == transparent:
+            cells[cell] = off_beat_color
+            color_idx = off_beat_idx
+        elif pixel == transparent or pixel == off_beat_color:
+            cells[cell] = beat_color
+            color_idx = beat_idx
 
-        if pixel_changed and pb_list is not None:
-            pb_list.append(PlaybackItem(pos, Color.from_tuple(pixels[pos.y][pos.x]), timestamp, song.pixel_time))
+        if color_idx is not None:
+            pb_list.record(x, y, color_idx, song.timestamps[idx])
 
         # Try to choose a direction
         if amp > 0:
@@ -55,11 +84,8 @@ def generate_image(pixels: np.ndarray, song: SongImage, args: argparse.Namespace
         direction_idx += turn_amnt
         direction_idx = direction_idx % len(directions)
 
-        # Update the current direction
-        direction = directions[direction_idx]
-        pos, direction = update_position(pos, direction, song.resolution, args, turn_amnt, directions, direction_idx)
+        # Step, turning away from (or wrapping around or bouncing off) the edges
+        x, y = edges.move(x, y, direction_idx, turn_amnt)
 
-        # Do the real update to the position now that
-        # we know it will be valid.
-        pos.x += direction.x
-        pos.y += direction.y
+    edges.store()
+    store_cells(pixels, cells)
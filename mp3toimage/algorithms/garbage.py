@@ -1,37 +1,47 @@
-"""A bad algorithm that does a bad job."""
-import random
-from typing import List
+"""A bad algorithm that does a bad job.
+
+Every pixel is drawn on its own from the pixel of the song at the same
+index (row by row), so the whole canvas is computed with a few array
+operations. It's the throughput reference for algorithms that don't walk.
+"""
+import argparse
 
 import numpy as np
 
-from mp3toimage.algorithms import PlaybackItem
+from mp3toimage.playback import PlaybackRecorder
 from mp3toimage.song import SongImage
-from mp3toimage.util import Color, Point
+from mp3toimage.util import Color
 
+#: Pixels don't depend on each other so the collision modes and engines don't apply
+PER_PIXEL = True
 
-def generate_image(pixels: np.ndarray, song: SongImage, beat_color: Color, off_beat_color: Color, pb_list: List[PlaybackItem] = None) -> None:
-    """Generate pixels of an image with the provided resolution."""
 
-    pixel_idx = 0
-    for col in range(song.resolution.x):
-        for row in range(song.resolution.y):
-            beat, amp, timestamp = song.get_info_at_pixel(pixel_idx)
-            r = g = b = a = 0
-            if beat and amp > 0:
-                a = 255
-            elif amp > 0:
-                a = 125
-
-            amp = abs(int(amp))
-
-            # Randomly pick a primary color
-            choice = random.choice([0, 1, 2])
-            if choice == 0:
-                r = amp
-            elif choice == 1:
-                g = amp
-            else:
-                b = amp
-
-            pixels[col][row] = (r, g, b, a)
-            pixel_idx += 1
+def generate_image(pixels: np.ndarray, song: SongImage, args: argparse.Namespace, pb_list: PlaybackRecorder = None) -> None:
+    """Generate pixels of an image with the provided resolution."""
+    rng = np.random.default_rng(args.seed)
+    num_pixels = song.num_pixels
+    beats = song.beats
+    amps = song.amplitudes
+
+    colors = np.zeros((num_pixels, 4), dtype=np.uint8)
+
+    # Beats that go up are opaque, other pixels that go up are half transparent
+    up = amps > 0
+    colors[up, 3] = 125
+    colors[up & beats, 3] = 255
+
+    # Randomly pick a primary color for the whole amplitude of every pixel
+    choice = rng.integers(0, 3, size=num_pixels)
+    colors[np.arange(num_pixels), choice] = np.absolute(np.trunc(amps)).astype(np.uint8)
+
+    pixels[:] = colors.reshape(pixels.shape)
+
+    if pb_list is not None:
+        # Record the pixels that aren't transparent anymore, in song order
+        packed = colors.view(np.uint32).reshape(-1)
+        changed = np.flatnonzero(packed != Color.transparent().packed)
+        values, inverse = np.unique(packed[changed], return_inverse=True)
+        palette = np.array([pb_list.color_index(Color.from_packed(value)) for value in values], dtype=np.uint16)
+        pb_list.extend(
+            changed % song.resolution.x, changed // song.resolution.x,
+            palette[inverse.reshape(-1)], song.timestamps[changed])
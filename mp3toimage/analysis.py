@@ -0,0 +1,97 @@
+"""Tempo and beat analysis profiles.
+
+The images only use the tempo of a song (and, with the full profile, the
+times of its beats), so the tempo doesn't have to be measured on the
+whole song at full resolution:
+
+* ``default`` measures the tempo on the whole decoded song.
+* ``fast`` measures it on the song downsampled by FAST_DOWNSAMPLE.
+* ``excerpt`` measures it on ``excerpt`` seconds from the middle of the song.
+* ``bpm`` uses the ``bpm`` parameter or the BPM tag of the song (read with
+  mutagen when it is installed) and skips the measure. Songs without one
+  are measured like ``default``.
+* ``full`` tracks the beats too, so beat pixels line up with the beats
+  of the song instead of being derived from the tempo.
+
+librosa is imported when a song is analyzed since it's slow to import.
+"""
+import warnings
+
+import numpy as np
+
+PROFILES = ("default", "fast", "excerpt", "bpm", "full")
+DEFAULT_EXCERPT = 30.0  # seconds
+FAST_DOWNSAMPLE = 4
+
+
+def measure_tempo(time_series: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Measure the tempo (BPM) of a decoded song."""
+    import librosa
+
+    #: An onset envelop is used to measure BPM
+    onset_env = librosa.onset.onset_strength(time_series, sr=sample_rate)
+    return librosa.beat.tempo(onset_envelope=onset_env, sr=sample_rate)
+
+
+def tagged_bpm(filename: str) -> float:
+    """Get the BPM tag of a song. None if it has none or mutagen isn't installed."""
+    try:
+        import mutagen
+    except ImportError:
+        return None
+
+    try:
+        tags = mutagen.File(filename, easy=True)
+    except mutagen.MutagenError:
+        return None
+    if tags is None:
+        return None
+
+    for value in tags.get("bpm") or ():
+        try:
+            bpm = float(value)
+        except ValueError:
+            continue
+        if bpm > 0:
+            return bpm
+    return None
+
+
+def given_tempo(filename: str, params: dict) -> np.ndarray:
+    """Get the tempo the bpm profile provides for a song. None to measure it."""
+    if params.get("profile") != "bpm":
+        return None
+    bpm = params.get("bpm") or tagged_bpm(filename)
+    if bpm is None:
+        warnings.warn(f"{filename} has no BPM tag. Measuring its tempo.")
+        return None
+    return np.array([bpm], dtype=np.float64)
+
+
+def analyze(filename: str, time_series: np.ndarray, sample_rate: int, params: dict) -> dict:
+    """Get the tempo (and beat times with the full profile) of a decoded song."""
+    profile = params.get("profile", "default")
+    beat_times = None
+
+    tempo = given_tempo(filename, params)
+    if tempo is None:
+        if profile == "fast":
+            # Averaging blocks of samples is a cheap low-pass filter
+            usable = len(time_series) - len(time_series) % FAST_DOWNSAMPLE
+            downsampled = time_series[:usable].reshape(-1, FAST_DOWNSAMPLE).mean(axis=1)
+            tempo = measure_tempo(downsampled, sample_rate // FAST_DOWNSAMPLE)
+        elif profile == "excerpt":
+            num_samples = int(params.get("excerpt", DEFAULT_EXCERPT) * sample_rate)
+            start = max(0, (len(time_series) - num_samples) // 2)
+            tempo = measure_tempo(time_series[start:start + num_samples], sample_rate)
+        elif profile == "full":
+            import librosa
+
+            onset_env = librosa.onset.onset_strength(time_series, sr=sample_rate)
+            tempo, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env, sr=sample_rate)
+            tempo = np.atleast_1d(tempo)
+            beat_times = librosa.frames_to_time(beat_frames, sr=sample_rate)
+        else:
+            tempo = measure_tempo(time_series, sample_rate)
+
+    return {"tempo": tempo, "beat_times": beat_times}
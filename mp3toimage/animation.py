@@ -0,0 +1,337 @@
+"""Animations of a walk unfolding over the song.
+
+A FrameRecorder takes the place of the playback recorder of a walk (it
+can also pass the changes on to one), draws the pixel changes on a frame
+of its own and hands the frame to an encoder every ``interval`` seconds
+of the song. Only the part of the frame that changed since the previous
+one is encoded (APNG and GIF frames are sub-rectangles drawn over the
+previous frame), frames are written as soon as they're done and the walk
+isn't run again, so memory stays at about one frame and the cost on top
+of the render is the encoding.
+
+The ``frames`` format is a stream of raw RGBA frames for other tools,
+e.g.::
+
+    ffmpeg -f rawvideo -pix_fmt rgba -s 512x512 -r 10 -i song.rgba song.mp4
+"""
+import math
+import zlib
+import array
+import struct
+import argparse
+
+import numpy as np
+from PIL import GifImagePlugin, Image
+
+from mp3toimage.output import DEFAULT_COMPRESS_LEVEL, OutputError
+from mp3toimage.playback import PlaybackRecorder
+from mp3toimage.song import SongImage
+from mp3toimage.util import Color, Point
+
+#: Animation formats and their file extensions
+FORMATS = {"apng": ".apng", "gif": ".gif", "frames": ".rgba"}
+DEFAULT_FRAME_INTERVAL = 1.0  # seconds of the song per frame
+DEFAULT_FRAME_DURATION = 100  # ms each frame is shown
+#: Pixel changes buffered before they're drawn on the frame
+CHUNK_SIZE = 64 * 1024
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class ApngEncoder:
+    """Write an animated PNG one frame at a time.
+
+    Frames after the first only hold the rectangle that changed and
+    replace that part of the previous frame.
+    """
+
+    def __init__(
+        self, path: str, resolution: Point, num_frames: int, duration: int,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL):
+        self.compress_level = compress_level
+        self._duration = duration
+        self._sequence = 0
+        self._first = True
+        self._fh = open(path, "wb")
+        self._fh.write(_PNG_SIGNATURE)
+        # 8 bit RGBA
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", resolution.x, resolution.y, 8, 6, 0, 0, 0))
+        # Loop forever
+        self._chunk(b"acTL", struct.pack(">II", num_frames, 0))
+
+    def frame(self, canvas: np.ndarray, palette: list, box: tuple) -> None:
+        """Add a frame. ``box`` is the (x0, y0, x1, y1) rectangle that changed or None."""
+        if self._first:
+            box = (0, 0, canvas.shape[1], canvas.shape[0])
+        elif box is None:
+            box = (0, 0, 1, 1)
+        x0, y0, x1, y1 = box
+        width = x1 - x0
+        height = y1 - y0
+
+        # Dispose none, blend source
+        self._chunk(b"fcTL", struct.pack(
+            ">IIIIIHHBB", self._sequence, width, height, x0, y0, self._duration, 1000, 0, 0))
+        self._sequence += 1
+
+        # Every row starts with its filter type (none)
+        rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+        rows[:, 1:] = np.ascontiguousarray(canvas[y0:y1, x0:x1]).view(np.uint8).reshape(height, width * 4)
+        data = zlib.compress(rows.tobytes(), self.compress_level)
+        if self._first:
+            self._chunk(b"IDAT", data)
+            self._first = False
+        else:
+            self._chunk(b"fdAT", struct.pack(">I", self._sequence) + data)
+            self._sequence += 1
+
+    def close(self) -> None:
+        """Finish the file."""
+        if self._fh.closed:
+            return
+        try:
+            self._chunk(b"IEND", b"")
+        finally:
+            self._fh.close()
+
+    def discard(self) -> None:
+        """Close the file without finishing it."""
+        self._fh.close()
+
+    def _chunk(self, kind: bytes, data: bytes) -> None:
+        self._fh.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+
+class GifEncoder:
+    """Write an animated GIF one frame at a time.
+
+    Frames after the first only hold the rectangle that changed and are
+    drawn over the previous frame. Every frame has its own color table
+    with fully transparent colors as index 0. GIFs have no partial
+    transparency so the other colors are opaque.
+    """
+
+    def __init__(
+        self, path: str, resolution: Point, num_frames: int, duration: int,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL):
+        self._duration = duration
+        self._first = True
+        self._fh = open(path, "wb")
+        # Header with a 2 color global table, which the frames don't use
+        self._fh.write(b"GIF89a" + struct.pack("<HHBBB", resolution.x, resolution.y, 0x80, 0, 0) + bytes(6))
+        # Loop forever
+        self._fh.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + b"\x00")
+
+    def frame(self, canvas: np.ndarray, palette: list, box: tuple) -> None:
+        """Add a frame. ``box`` is the (x0, y0, x1, y1) rectangle that changed or None."""
+        if len(palette) > 255:
+            raise OutputError("GIF animations can't have more than 255 colors.")
+        if self._first:
+            box = (0, 0, canvas.shape[1], canvas.shape[0])
+            self._first = False
+        elif box is None:
+            box = (0, 0, 1, 1)
+        x0, y0, x1, y1 = box
+
+        # Map the packed colors to their index in the palette (after transparent)
+        packed = np.array([color.packed for color in palette], dtype=np.uint32)
+        order = np.argsort(packed)
+        region = canvas[y0:y1, x0:x1]
+        found = np.clip(np.searchsorted(packed[order], region), 0, max(len(palette) - 1, 0))
+        indexes = np.zeros(region.shape, dtype=np.uint8)
+        if len(palette):
+            matched = packed[order][found] == region
+            indexes[matched] = order[found[matched]] + 1
+        alphas = np.array([0] + [color.alpha for color in palette], dtype=np.uint8)
+        indexes[alphas[indexes] == 0] = 0
+
+        img = Image.fromarray(indexes, mode="P")
+        img.putpalette([0, 0, 0] + [channel for color in palette for channel in color.as_tuple()[:3]])
+        # Disposal 1 keeps the previous frame under the transparent pixels
+        for data in GifImagePlugin.getdata(
+                img, offset=(x0, y0), duration=self._duration, transparency=0, disposal=1,
+                include_color_table=True):
+            self._fh.write(data)
+
+    def close(self) -> None:
+        """Finish the file."""
+        if self._fh.closed:
+            return
+        try:
+            self._fh.write(b";")
+        finally:
+            self._fh.close()
+
+    def discard(self) -> None:
+        """Close the file without finishing it."""
+        self._fh.close()
+
+
+class RawEncoder:
+    """Write every frame as raw RGBA bytes (the path can be a named pipe)."""
+
+    def __init__(
+        self, path: str, resolution: Point, num_frames: int, duration: int,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL):
+        self._fh = open(path, "wb")
+
+    def frame(self, canvas: np.ndarray, palette: list, box: tuple) -> None:
+        """Add a frame. The whole frame is written whatever changed."""
+        self._fh.write(canvas.tobytes())
+
+    def close(self) -> None:
+        """Finish the file."""
+        self._fh.close()
+
+    def discard(self) -> None:
+        """Close the file."""
+        self._fh.close()
+
+
+#: Animation format -> encoder
+ENCODERS = {"apng": ApngEncoder, "gif": GifEncoder, "frames": RawEncoder}
+
+
+class FrameRecorder:
+    """Record the pixel changes of a walk as the frames of an animation.
+
+    It can be passed to the algorithms as their playback recorder. Pixel
+    changes are buffered and drawn in chunks, and the frame is encoded
+    every time the song crosses a multiple of ``frame_interval``. The last
+    frame is the finished image. With a ``playback`` recorder the changes
+    are also passed on to it.
+
+    Use it as a context manager: the remaining frames are written when the
+    walk is done (and the file is closed unfinished if it failed).
+    """
+
+    def __init__(self, path: str, song: SongImage, args: argparse.Namespace, playback: PlaybackRecorder = None):
+        #: How long each record lasts in seconds
+        self.pixel_time = song.pixel_time
+        #: Recorder the changes are passed on to
+        self.playback = playback
+        #: Colors referenced by the records' palette index
+        self.palette = playback.palette if playback is not None else []
+        #: Seconds of the song between frames
+        self.interval = args.frame_interval
+        #: Number of frames of the animation
+        self.num_frames = max(1, math.ceil(song.num_pixels * song.pixel_time / self.interval))
+        #: The frame (packed colors)
+        self.frame = np.zeros((song.resolution.y, song.resolution.x), dtype=np.uint32)
+        self._width = song.resolution.x
+        self._palette_idx = {}
+        self._packed = np.zeros(0, dtype=np.uint32)
+        self._frames = 0
+        self._next_time = self._boundary()
+        self._box = None
+        self._x = array.array("I")
+        self._y = array.array("I")
+        self._color = array.array("I")
+        self._timestamp = array.array("d")
+        self._encoder = ENCODERS[args.animate](
+            path, song.resolution, self.num_frames, args.frame_duration, args.compress_level)
+
+    def __enter__(self) -> "FrameRecorder":
+        return self
+
+    def __exit__(self, exc_type, _exc, _tb) -> bool:
+        if exc_type is None:
+            self.close()
+        else:
+            self._encoder.discard()
+        return False
+
+    def color_index(self, color: Color) -> int:
+        """Get the palette index of a color, adding it to the palette if needed."""
+        if self.playback is not None:
+            return self.playback.color_index(color)
+        idx = self._palette_idx.get(color)
+        if idx is None:
+            idx = self._palette_idx[color] = len(self.palette)
+            self.palette.append(color)
+        return idx
+
+    def record(self, x: int, y: int, color_idx: int, timestamp: float) -> None:
+        """Record a single pixel change."""
+        if self.playback is not None:
+            self.playback.record(x, y, color_idx, timestamp)
+        self._x.append(x)
+        self._y.append(y)
+        self._color.append(color_idx)
+        self._timestamp.append(timestamp)
+        if len(self._timestamp) >= CHUNK_SIZE:
+            self._flush()
+
+    def extend(self, x: np.ndarray, y: np.ndarray, color_idx: np.ndarray, timestamps: np.ndarray) -> None:
+        """Record many pixel changes at once (in song order)."""
+        if self.playback is not None:
+            self.playback.extend(x, y, color_idx, timestamps)
+        self._flush()
+        self._draw_until(
+            np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64),
+            np.asarray(color_idx, dtype=np.int64), np.asarray(timestamps, dtype=np.float64))
+
+    def close(self) -> None:
+        """Draw the buffered changes, write the remaining frames and finish the file."""
+        try:
+            self._flush()
+            while self._frames < self.num_frames:
+                self._emit()
+        except BaseException:
+            self._encoder.discard()
+            raise
+        self._encoder.close()
+
+    def _boundary(self) -> float:
+        """Get the song time of the next frame (the last one takes every change)."""
+        if self._frames >= self.num_frames - 1:
+            return math.inf
+        return (self._frames + 1) * self.interval
+
+    def _flush(self) -> None:
+        """Draw the buffered changes."""
+        if not self._timestamp:
+            return
+        changes = (
+            np.frombuffer(self._x, dtype=np.uint32).astype(np.int64),
+            np.frombuffer(self._y, dtype=np.uint32).astype(np.int64),
+            np.frombuffer(self._color, dtype=np.uint32).astype(np.int64),
+            np.frombuffer(self._timestamp, dtype=np.float64).copy())
+        for column in (self._x, self._y, self._color, self._timestamp):
+            del column[:]
+        self._draw_until(*changes)
+
+    def _draw_until(self, x: np.ndarray, y: np.ndarray, colors: np.ndarray, timestamps: np.ndarray) -> None:
+        """Draw changes in song order, writing a frame at every frame time they cross."""
+        start = 0
+        while start < len(timestamps):
+            end = start + int(np.searchsorted(timestamps[start:], self._next_time, side="left"))
+            if end > start:
+                self._draw(x[start:end], y[start:end], colors[start:end])
+            if end == len(timestamps):
+                break
+            self._emit()
+            start = end
+
+    def _draw(self, x: np.ndarray, y: np.ndarray, colors: np.ndarray) -> None:
+        """Draw changes on the frame. The last change of a pixel wins."""
+        if len(self._packed) < len(self.palette):
+            self._packed = np.array([color.packed for color in self.palette], dtype=np.uint32)
+        cells = y * self._width + x
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        self.frame.reshape(-1)[cells[last]] = self._packed[colors[last]]
+
+        box = (int(x.min()), int(y.min()), int(x.max()) + 1, int(y.max()) + 1)
+        if self._box is not None:
+            box = (
+                min(box[0], self._box[0]), min(box[1], self._box[1]),
+                max(box[2], self._box[2]), max(box[3], self._box[3]))
+        self._box = box
+
+    def _emit(self) -> None:
+        """Encode the frame and move on to the next one."""
+        self._encoder.frame(self.frame, self.palette, self._box)
+        self._box = None
+        self._frames += 1
+        self._next_time = self._boundary()
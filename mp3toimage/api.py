@@ -0,0 +1,236 @@
+"""Render images from Python instead of the command line.
+
+The images come back as RGBA arrays (height x width x 4, uint8) keyed by
+resolution, without encoding or writing anything::
+
+    from mp3toimage.api import RenderOptions, Samples, render, render_many
+    from mp3toimage.util import Point
+
+    images = render("brass_monkey.mp3", [Point(512, 512), Point(32, 32)])
+
+    # Songs decoded by the caller (mono, or channels first like librosa)
+    images = render(Samples(time_series, 44100, tempo=104), [Point(512, 512)], RenderOptions(wrap_collisions=True))
+
+    # Many songs, decoding the next ones while the current one renders
+    for song, images in render_many(paths, [Point(512, 512)]):
+        if isinstance(images, Exception):
+            ...  # The song couldn't be decoded or is too short
+
+Songs given as paths go through the song caches with the settings set by
+configure() (the decode mode, tempo analysis and caches are process-wide,
+like on the command line). Samples skip the decode and the caches; their
+tempo is measured with the analysis profile unless it's given.
+"""
+import threading
+import argparse
+from dataclasses import dataclass, fields
+from typing import Dict, Iterable, Iterator, Tuple, Union
+
+import numpy as np
+
+import mp3toimage.algorithms
+from mp3toimage import analysis
+from mp3toimage.cache import AnalysisCache, SongCache, DEFAULT_CACHE_SIZE, DEFAULT_MEMORY_CACHE_SIZE
+from mp3toimage.prefetch import DEFAULT_PREFETCH, prefetch
+from mp3toimage.song import DECODE_MODES, SongAnalysis, SongImage
+from mp3toimage.util import Color, Point, generate_pixels
+
+ENGINES = ("python", "kernel")
+
+_ALGORITHMS = mp3toimage.algorithms.Registry()
+#: Collide-180 walks flip the shared direction points while they walk
+_COLLIDE_LOCK = threading.Lock()
+
+
+@dataclass(frozen=True)
+class RenderOptions:
+    """How the songs are drawn. The fields are the command line flags of the same name."""
+
+    #: Algorithm plugin (a module of mp3toimage.algorithms)
+    alg: str = "basic"
+    #: Color of the beat pixels
+    beat_color: Color = Color(255, 221, 74, 255)
+    #: Color of the off-beat pixels
+    off_beat_color: Color = Color(60, 105, 151, 255)
+    #: Seed of the algorithms that use random numbers
+    seed: int = mp3toimage.algorithms.DEFAULT_SEED
+    #: Start in the middle of the image instead of the top-left corner
+    start_middle: bool = False
+    #: Walk in 4 directions instead of 8
+    four_directions: bool = False
+    #: Wrap around the edges of the image
+    wrap_collisions: bool = False
+    #: Flip direction 180 degrees at the edges of the image
+    collide_180: bool = False
+    #: Walk engine, one of ENGINES
+    engine: str = "kernel"
+
+    def __post_init__(self):
+        if self.alg not in _ALGORITHMS:
+            raise ValueError(f"Unknown algorithm {self.alg}. One of: {', '.join(_ALGORITHMS)}")
+        if self.engine not in ENGINES:
+            raise ValueError(f"Unknown engine {self.engine}. One of: {', '.join(ENGINES)}")
+        if self.wrap_collisions and self.collide_180:
+            raise ValueError("wrap_collisions and collide_180 can't be used together.")
+
+    def args(self) -> argparse.Namespace:
+        """Get the options as the command line arguments the algorithms read."""
+        return argparse.Namespace(playback=False, **{field.name: getattr(self, field.name) for field in fields(self)})
+
+
+@dataclass(eq=False)
+class Samples:
+    """A song decoded by the caller."""
+
+    #: The samples, mono or channels first (they're averaged to mono)
+    time_series: np.ndarray
+    #: Sample rate of the samples in Hz
+    sample_rate: int
+    #: Tempo of the song in BPM. Measured with the analysis profile when None.
+    tempo: float = None
+    #: Times of the beats in seconds, for beat pixels on the beats (see the full analysis profile)
+    beat_times: np.ndarray = None
+    #: Name of the song in warnings and the song info
+    name: str = "<samples>"
+
+    def entry(self) -> dict:
+        """Get the song the way the song cache holds decoded songs."""
+        time_series = np.asarray(self.time_series, dtype=np.float32)
+        if time_series.ndim > 1:
+            time_series = time_series.mean(axis=0)
+        if self.tempo is not None:
+            beats = {"tempo": np.array([self.tempo], dtype=np.float64), "beat_times": self.beat_times}
+        else:
+            beats = analysis.analyze(self.name, time_series, self.sample_rate, SongImage.analysis_params)
+            if self.beat_times is not None:
+                beats["beat_times"] = self.beat_times
+        if beats["beat_times"] is not None:
+            beats["beat_times"] = np.asarray(beats["beat_times"], dtype=np.float64)
+        return {
+            "duration": len(time_series) / self.sample_rate,
+            "time_series": time_series,
+            "sample_rate": self.sample_rate,
+            "tempo": beats["tempo"],
+            "beat_times": beats["beat_times"]
+        }
+
+
+#: A song file path or decoded song
+Song = Union[str, Samples]
+
+
+def configure(
+        decode: str = "hq", analysis_profile: str = "default", bpm: float = None,
+        tempo_excerpt: float = analysis.DEFAULT_EXCERPT, cache_dir: str = None,
+        cache_size: int = DEFAULT_CACHE_SIZE, memory_cache_size: int = DEFAULT_MEMORY_CACHE_SIZE) -> None:
+    """Set how songs are decoded and analyzed (the --decode, --analysis and cache flags).
+
+    The persistent song cache is only used with a ``cache_dir``. The
+    songs decoded with the earlier settings are dropped.
+    """
+    if decode not in DECODE_MODES:
+        raise ValueError(f"Unknown decode mode {decode}. One of: {', '.join(DECODE_MODES)}")
+    if bpm is not None:
+        analysis_profile = "bpm"
+    if analysis_profile not in analysis.PROFILES:
+        raise ValueError(f"Unknown analysis profile {analysis_profile}. One of: {', '.join(analysis.PROFILES)}")
+    if (bpm is not None and bpm <= 0) or tempo_excerpt <= 0:
+        raise ValueError("The BPM and tempo excerpt must be positive.")
+
+    SongImage._song_cache = SongCache(max_bytes=memory_cache_size * 1024 * 1024)
+    SongImage.disk_cache = None
+    if cache_dir is not None:
+        SongImage.disk_cache = AnalysisCache(cache_dir, max_bytes=cache_size * 1024 * 1024)
+    SongImage.decode_mode = decode
+    SongImage.analysis_params = {"profile": analysis_profile}
+    if analysis_profile == "bpm":
+        SongImage.analysis_params["bpm"] = bpm
+    elif analysis_profile == "excerpt":
+        SongImage.analysis_params["excerpt"] = tempo_excerpt
+
+
+def render(
+        song: Song, resolutions: Iterable[Union[Point, Tuple[int, int]]],
+        options: RenderOptions = None) -> Dict[Point, np.ndarray]:
+    """Draw a song at several resolutions. Returns the RGBA image of every resolution.
+
+    The song is analyzed once for all the resolutions. Raises
+    NotEnoughSong if the song is too short for one of them.
+    """
+    resolutions = [_resolution(resolution) for resolution in resolutions]
+    args = (options or RenderOptions()).args()
+    if isinstance(song, Samples):
+        song_analysis = SongAnalysis(song.name, resolutions, entry=song.entry())
+    else:
+        song_analysis = SongAnalysis(song, resolutions)
+
+    images = {}
+    for resolution in resolutions:
+        images[resolution] = _draw(song_analysis.song_image(resolution), args)
+    return images
+
+
+def render_many(
+        songs: Iterable[Song], resolutions: Iterable[Union[Point, Tuple[int, int]]],
+        options: RenderOptions = None,
+        prefetch_depth: int = DEFAULT_PREFETCH) -> Iterator[Tuple[Song, Union[Dict[Point, np.ndarray], Exception]]]:
+    """Draw many songs at several resolutions. Yields every song with its images (see render()).
+
+    A song that can't be decoded or is too short for a resolution yields
+    its exception instead of its images, and the next songs are still
+    drawn. The next ``prefetch_depth`` songs given as paths are decoded
+    on threads while a song renders, and a song is dropped from the song
+    cache once it's rendered.
+    """
+    songs = list(songs)
+    resolutions = [_resolution(resolution) for resolution in resolutions]
+    paths = [song for song in songs if not isinstance(song, Samples)]
+    fetched = prefetch([(path, resolutions) for path in paths], prefetch_depth)
+    num_fetched = 0
+    try:
+        for song in songs:
+            if isinstance(song, Samples):
+                try:
+                    images = render(song, resolutions, options)
+                except Exception as exc:
+                    images = exc
+                yield song, images
+                continue
+
+            num_fetched += 1
+            try:
+                next(fetched)
+            except Exception as exc:
+                # The prefetcher stops at a song it can't decode. Start over on the next songs.
+                fetched = prefetch([(path, resolutions) for path in paths[num_fetched:]], prefetch_depth)
+                yield song, exc
+                continue
+
+            try:
+                images = render(song, resolutions, options)
+            except Exception as exc:
+                images = exc
+            finally:
+                SongImage._song_cache.release(song)
+            yield song, images
+    finally:
+        fetched.close()
+
+
+def _resolution(resolution: Union[Point, Tuple[int, int]]) -> Point:
+    """Get a resolution as a Point."""
+    if isinstance(resolution, Point):
+        return resolution
+    x, y = resolution
+    return Point(int(x), int(y))
+
+
+def _draw(song: SongImage, args: argparse.Namespace) -> np.ndarray:
+    """Walk a song on a new canvas."""
+    pixels = generate_pixels(song.resolution)
+    if args.collide_180:
+        with _COLLIDE_LOCK:
+            _ALGORITHMS[args.alg].generate_image(pixels, song, args, pb_list=None)
+    else:
+        _ALGORITHMS[args.alg].generate_image(pixels, song, args, pb_list=None)
+    return pixels
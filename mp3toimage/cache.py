@@ -0,0 +1,208 @@
+"""Caches for decoded songs."""
+import os
+import json
+import shutil
+import hashlib
+import warnings
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mp3toimage")
+DEFAULT_CACHE_SIZE = 2048  # MB
+DEFAULT_MEMORY_CACHE_SIZE = 1024  # MB
+
+_TIME_SERIES_FILE = "time_series.npy"
+_META_FILE = "meta.json"
+
+
+def entry_size(entry: dict) -> int:
+    """Get the bytes held by the arrays of a song entry."""
+    size = 0
+    if entry["time_series"] is not None:
+        size += entry["time_series"].nbytes
+    for amplitudes in entry.get("pixel_amplitudes", {}).values():
+        size += amplitudes.nbytes
+    return size
+
+
+def file_digest(filename: str, chunk_size: int = 1024 * 1024) -> str:
+    """Get the sha256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SongCache:
+    """An in-memory cache of decoded songs bounded by the size of their arrays.
+
+    The least recently used songs are evicted once the cache grows past
+    ``max_bytes``. The most recently added song is always kept, even if
+    it's bigger than ``max_bytes`` on its own, so it doesn't have to be
+    decoded again for every resolution.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MEMORY_CACHE_SIZE * 1024 * 1024):
+        #: Size cap for all entries in bytes
+        self.max_bytes = max_bytes
+        #: Number of lookups that found the song
+        self.hits = 0
+        #: Number of lookups that didn't find the song
+        self.misses = 0
+        #: Number of songs evicted to stay under max_bytes
+        self.evictions = 0
+        #: Bytes currently held
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, filename: str) -> dict:
+        """Get the entry for a song. Returns None on a miss."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(filename)
+            return entry
+
+    def put(self, filename: str, entry: dict) -> None:
+        """Add or replace the entry for a song and evict old songs if it's too big."""
+        with self._lock:
+            self._remove(filename)
+            self._entries[filename] = entry
+            self.size += entry_size(entry)
+
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def release(self, filename: str) -> dict:
+        """Drop a song that is no longer needed. Returns its entry if it was cached."""
+        with self._lock:
+            return self._remove(filename)
+
+    def clear(self) -> None:
+        """Drop every song."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, filename: str) -> dict:
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self.size -= entry_size(entry)
+        return entry
+
+
+class AnalysisCache:
+    """A directory of decoded songs keyed by content hash and decode parameters.
+
+    Each entry holds the decoded time series as a ``.npy`` file (loaded
+    memory-mapped) and the tempo, beat times, duration and sample rate as JSON. The
+    least recently used entries are evicted when the cache grows past
+    ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE * 1024 * 1024):
+        #: The cache directory
+        self.cache_dir = cache_dir
+        #: Size cap for all entries in bytes
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.evict()
+
+    def key(self, filename: str, decode_params: dict) -> str:
+        """Get the cache key for a song file decoded with the provided parameters."""
+        digest = hashlib.sha256(file_digest(filename).encode())
+        digest.update(json.dumps(decode_params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> dict:
+        """Get the cache entry for a key. Returns None on a miss."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(entry_dir, _META_FILE)
+        try:
+            with open(meta_path, "r") as fh:
+                meta = json.load(fh)
+            time_series = np.load(os.path.join(entry_dir, _TIME_SERIES_FILE), mmap_mode="r")
+            entry = {
+                "duration": meta["duration"],
+                "time_series": time_series,
+                "sample_rate": meta["sample_rate"],
+                "reference_samples": meta.get("reference_samples", len(time_series)),
+                "tempo": np.array(meta["tempo"]),
+                "beat_times": None if meta.get("beat_times") is None else np.array(meta["beat_times"])
+            }
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            # A partial, corrupt or outdated entry. Drop it and decode again.
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        # The meta file modification time tracks the last use for eviction
+        os.utime(meta_path)
+        return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        """Add an entry to the cache and evict old entries if it's too big."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        # Songs can be fetched on several threads (see mp3toimage.prefetch)
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            np.save(os.path.join(tmp_dir, _TIME_SERIES_FILE), entry["time_series"])
+            with open(os.path.join(tmp_dir, _META_FILE), "w") as fh:
+                json.dump({
+                    "duration": entry["duration"],
+                    "sample_rate": entry["sample_rate"],
+                    "reference_samples": entry.get("reference_samples", len(entry["time_series"])),
+                    "tempo": np.asarray(entry["tempo"]).tolist(),
+                    "beat_times": None if entry.get("beat_times") is None else np.asarray(entry["beat_times"]).tolist()
+                }, fh)
+            os.replace(tmp_dir, entry_dir)
+        except OSError as exc:
+            # Another process may have added the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                warnings.warn(f"Unable to write to the analysis cache: {exc}")
+            return
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry_dir, _META_FILE)
+            if not os.path.isfile(meta_path):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, file)) for file in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(meta_path), size, entry_dir))
+            total += size
+
+        for _last_used, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
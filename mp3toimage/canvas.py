@@ -0,0 +1,76 @@
+"""RGBA canvases the algorithms draw on."""
+import tempfile
+import threading
+
+import numpy as np
+
+from mp3toimage.util import Point, Color
+
+DEFAULT_POOL_SIZE = 256  # MB
+
+
+def new_canvas(resolution: Point, color: Color = None, mmap_dir: str = None) -> np.ndarray:
+    """Allocate an RGBA canvas filled with a color (transparent by default).
+
+    With ``mmap_dir`` the canvas is backed by an anonymous temporary file
+    in that directory instead of memory, for very large posters. The file
+    goes away with the canvas.
+    """
+    shape = (resolution.y, resolution.x, 4)
+    if mmap_dir is not None:
+        # The mapping keeps the file open after the handle is closed
+        with tempfile.TemporaryFile(dir=mmap_dir) as fh:
+            canvas = np.memmap(fh, dtype=np.uint8, mode="w+", shape=shape)
+    else:
+        canvas = np.zeros(shape, dtype=np.uint8)
+
+    # New buffers are already zeroed (transparent)
+    if color is not None and color != Color.transparent():
+        canvas[:] = color.as_tuple()
+    return canvas
+
+
+class CanvasPool:
+    """Reuse canvases between renders of the same resolution.
+
+    Released canvases are kept until the pool holds ``max_bytes`` and are
+    cleared to transparent when they are handed out again.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_POOL_SIZE * 1024 * 1024, mmap_dir: str = None):
+        #: Size cap for the free canvases in bytes
+        self.max_bytes = max_bytes
+        #: Directory for memory-mapped canvases. None to keep them in memory.
+        self.mmap_dir = mmap_dir
+        #: Bytes currently held by free canvases
+        self.size = 0
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, resolution: Point) -> np.ndarray:
+        """Get a transparent canvas, reusing a free one if there is one."""
+        canvas = None
+        with self._lock:
+            free = self._free.get((resolution.y, resolution.x))
+            if free:
+                canvas = free.pop()
+                self.size -= canvas.nbytes
+
+        if canvas is None:
+            return new_canvas(resolution, mmap_dir=self.mmap_dir)
+        canvas.fill(0)
+        return canvas
+
+    def release(self, canvas: np.ndarray) -> None:
+        """Hand a canvas that is no longer used back to the pool."""
+        with self._lock:
+            if self.size + canvas.nbytes > self.max_bytes:
+                return
+            self._free.setdefault(canvas.shape[:2], []).append(canvas)
+            self.size += canvas.nbytes
+
+    def clear(self) -> None:
+        """Drop every free canvas."""
+        with self._lock:
+            self._free.clear()
+            self.size = 0
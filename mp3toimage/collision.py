@@ -0,0 +1,301 @@
+"""Edge handling of the walkers, read from precomputed tables.
+
+Whether a step leaves the image only depends on which borders the walker
+is on and on the direction it steps in, so every collision mode is a
+table lookup instead of a search:
+
+* The border class of a position is a bitmask of the borders it touches
+  (LEFT, RIGHT, TOP and BOTTOM). 0 is the interior, one bit an edge and
+  an x and a y bit a corner (both x or both y bits on 1 pixel wide images).
+* The turn table gives, for every border class, direction and turn step
+  (modulo the number of directions), the direction the default mode
+  turns to, or NO_DIRECTION if turning by that step never finds one. The
+  walker stays in place for that step instead of turning forever.
+* The flip and wrap tables give, for every border class and step vector,
+  the vector a collide-180 walk flips to and the borders a wrapping walk
+  jumps across.
+
+The walkers know the directions by index and collide-180 walks flip them
+for good (the flips stick to the shared direction points, unless
+``sticky_flips`` is off), so a walk maps every direction index to one of
+VECTORS. The tables are checked against
+the step by step edge handling (mp3toimage.algorithms.update_position)
+on every position of small images by running this module::
+
+    python -m mp3toimage.collision
+"""
+import sys
+import argparse
+import functools
+from typing import Tuple
+
+import numpy as np
+
+from mp3toimage.util import Point
+
+#: Write the flips of collide-180 walks back to the shared direction points,
+#: so the next walks start from them. Processes whose images must only
+#: depend on their own request (the render server and pool workers) turn
+#: it off.
+sticky_flips = True
+
+#: Border bits of a position
+LEFT = 1
+RIGHT = 2
+TOP = 4
+BOTTOM = 8
+#: Number of border classes
+NUM_BORDERS = 16
+#: Turn table entry when no direction can be turned to
+NO_DIRECTION = -1
+
+#: Collision modes
+MODE_TURN = 0
+MODE_WRAP = 1
+MODE_COLLIDE_180 = 2
+
+#: Every vector a walker can step by
+VECTORS = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+VECTOR_X = np.array([vector[0] for vector in VECTORS], dtype=np.int64)
+VECTOR_Y = np.array([vector[1] for vector in VECTORS], dtype=np.int64)
+#: Index in VECTORS of a step by (dx, dy), at (dy + 1) * 3 + dx + 1
+_VECTOR_IDS = tuple(
+    VECTORS.index((dx, dy)) if (dx, dy) in VECTORS else None for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+
+
+def border_class(x: int, y: int, width: int, height: int) -> int:
+    """Get the border class of a position."""
+    return (x == 0) | (x == width - 1) << 1 | (y == 0) << 2 | (y == height - 1) << 3
+
+
+def blocked(border: int, dx: int, dy: int) -> bool:
+    """Check if a step by (dx, dy) leaves the image from a border class."""
+    return bool(
+        (dx < 0 and border & LEFT) or (dx > 0 and border & RIGHT)
+        or (dy < 0 and border & TOP) or (dy > 0 and border & BOTTOM))
+
+
+def vector_id(direction: Point) -> int:
+    """Get the index in VECTORS of a direction."""
+    return _VECTOR_IDS[(direction.y + 1) * 3 + direction.x + 1]
+
+
+def _turn(border: int, slots: Tuple[int, ...], direction_idx: int, step: int) -> int:
+    """Turn by ``step`` until a direction doesn't leave the image."""
+    turned = direction_idx
+    for _ in range(len(slots)):
+        if not blocked(border, *VECTORS[slots[turned]]):
+            return turned
+        turned = (turned + step) % len(slots)
+    return NO_DIRECTION
+
+
+@functools.lru_cache(maxsize=None)
+def turn_table(slots: Tuple[int, ...]) -> np.ndarray:
+    """Get the turn table of directions holding ``slots`` (indexes in VECTORS).
+
+    Indexed by border class, direction index and turn step modulo the
+    number of directions.
+    """
+    num_dirs = len(slots)
+    table = np.empty((NUM_BORDERS, num_dirs, num_dirs), dtype=np.int64)
+    for border in range(NUM_BORDERS):
+        for direction_idx in range(num_dirs):
+            for step in range(num_dirs):
+                table[border, direction_idx, step] = _turn(border, slots, direction_idx, step)
+    table.setflags(write=False)
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def _turn_lists(slots: Tuple[int, ...]) -> list:
+    """Get the turn table as nested lists (faster to index from Python)."""
+    return turn_table(slots).tolist()
+
+
+def _flip_table() -> np.ndarray:
+    """Get the vector a collide-180 walk flips every vector to from every border class."""
+    table = np.empty((NUM_BORDERS, len(VECTORS)), dtype=np.int64)
+    for border in range(NUM_BORDERS):
+        for vector, (dx, dy) in enumerate(VECTORS):
+            if blocked(border, dx, 0):
+                dx = -dx
+            if blocked(border, 0, dy):
+                dy = -dy
+            table[border, vector] = VECTORS.index((dx, dy))
+    table.setflags(write=False)
+    return table
+
+
+def _wrap_table() -> np.ndarray:
+    """Get the borders a wrapping walk jumps to for every border class and vector.
+
+    LEFT and TOP mean the walker goes to the first column and row, RIGHT
+    and BOTTOM to the last ones, before it steps.
+    """
+    table = np.zeros((NUM_BORDERS, len(VECTORS)), dtype=np.int64)
+    for border in range(NUM_BORDERS):
+        for vector, (dx, dy) in enumerate(VECTORS):
+            if blocked(border, dx, 0):
+                table[border, vector] |= LEFT if dx > 0 else RIGHT
+            if blocked(border, 0, dy):
+                table[border, vector] |= TOP if dy > 0 else BOTTOM
+    table.setflags(write=False)
+    return table
+
+
+FLIP_TABLE = _flip_table()
+WRAP_TABLE = _wrap_table()
+_FLIPS = FLIP_TABLE.tolist()
+_WRAPS = WRAP_TABLE.tolist()
+_VECTOR_X = VECTOR_X.tolist()
+_VECTOR_Y = VECTOR_Y.tolist()
+
+
+def collision_mode(args: argparse.Namespace) -> int:
+    """Get the collision mode of the command line arguments."""
+    if args.wrap_collisions:
+        return MODE_WRAP
+    if args.collide_180:
+        return MODE_COLLIDE_180
+    return MODE_TURN
+
+
+class Edges:
+    """Move a walker one step at a time, handling the edges with the tables.
+
+    ``directions`` are the walker's direction points. Collide-180 walks
+    flip them for good, so call store() once the walk is done to write
+    the flips back to the points.
+    """
+
+    def __init__(self, directions: tuple, resolution: Point, args: argparse.Namespace):
+        #: The direction points of the walk
+        self.directions = directions
+        #: The collision mode
+        self.mode = collision_mode(args)
+        #: Index in VECTORS of every direction
+        self.slots = [vector_id(direction) for direction in directions]
+        self._num_dirs = len(directions)
+        self._last_x = resolution.x - 1
+        self._last_y = resolution.y - 1
+        self._turns = _turn_lists(tuple(self.slots))
+
+    def move(self, x: int, y: int, direction_idx: int, turn_amnt: int) -> Tuple[int, int]:
+        """Step from (x, y) in a direction. Returns the new position.
+
+        ``turn_amnt`` is the way the walker turns when the direction
+        leaves the image in the default collision mode.
+        """
+        vector = self.slots[direction_idx]
+        border = (x == 0) | (x == self._last_x) << 1 | (y == 0) << 2 | (y == self._last_y) << 3
+        if border:
+            if self.mode == MODE_TURN:
+                turned = self._turns[border][direction_idx][turn_amnt % self._num_dirs]
+                if turned == NO_DIRECTION:
+                    return x, y
+                vector = self.slots[turned]
+            elif self.mode == MODE_WRAP:
+                wrap = _WRAPS[border][vector]
+                if wrap & LEFT:
+                    x = 0
+                elif wrap & RIGHT:
+                    x = self._last_x
+                if wrap & TOP:
+                    y = 0
+                elif wrap & BOTTOM:
+                    y = self._last_y
+            else:
+                vector = self.slots[direction_idx] = _FLIPS[border][vector]
+        return x + _VECTOR_X[vector], y + _VECTOR_Y[vector]
+
+    def store(self) -> None:
+        """Write the directions flipped by a collide-180 walk back to the direction points."""
+        store_slots(self.directions, self.slots)
+
+
+def store_slots(directions: tuple, slots) -> None:
+    """Set the direction points to the vectors of ``slots`` (if the flips are sticky)."""
+    if not sticky_flips:
+        return
+    for direction, vector in zip(directions, slots):
+        direction.x, direction.y = VECTORS[vector]
+
+
+def check(max_size: int = 4) -> int:
+    """Check the tables against update_position on every image up to max_size pixels a side.
+
+    Every position, direction, turn step and collision mode is moved once
+    with both. Returns the number of moves checked and raises
+    AssertionError on the first one that differs.
+    """
+    # The algorithms package imports this module
+    from mp3toimage.algorithms import DIRECTIONS_45, DIRECTIONS_90, update_position
+
+    checked = 0
+    modes = {
+        MODE_TURN: argparse.Namespace(wrap_collisions=False, collide_180=False),
+        MODE_WRAP: argparse.Namespace(wrap_collisions=True, collide_180=False),
+        MODE_COLLIDE_180: argparse.Namespace(wrap_collisions=False, collide_180=True)
+    }
+    direction_sets = [DIRECTIONS_45, DIRECTIONS_90]
+    # Directions left flipped by an earlier collide-180 walk
+    direction_sets.append(tuple(Point(-d.x, d.y) if i % 3 else Point(d.x, d.y) for i, d in enumerate(DIRECTIONS_45)))
+
+    for base in direction_sets:
+        num_dirs = len(base)
+        for width in range(1, max_size + 1):
+            for height in range(1, max_size + 1):
+                resolution = Point(width, height)
+                for mode, args in modes.items():
+                    for x in range(width):
+                        for y in range(height):
+                            for direction_idx in range(num_dirs):
+                                for turn_amnt in range(-num_dirs, 2 * num_dirs):
+                                    checked += _check_move(
+                                        update_position, base, resolution, args, mode, x, y,
+                                        direction_idx, turn_amnt)
+    return checked
+
+
+def _check_move(update_position, base, resolution, args, mode, x, y, direction_idx, turn_amnt) -> int:
+    """Check one move against update_position. Returns 1, or 0 when update_position doesn't return."""
+    directions = tuple(Point(d.x, d.y) for d in base)
+    edges = Edges(directions, resolution, args)
+    border = border_class(x, y, resolution.x, resolution.y)
+    expected_turn = _turn(border, tuple(edges.slots), direction_idx, turn_amnt % len(directions))
+    if mode == MODE_TURN and expected_turn == NO_DIRECTION:
+        # update_position turns forever. Make sure the walker stays in place.
+        assert edges.move(x, y, direction_idx, turn_amnt) == (x, y), (resolution, x, y, direction_idx, turn_amnt)
+        return 0
+
+    new_x, new_y = edges.move(x, y, direction_idx, turn_amnt)
+    edges.store()
+
+    ref_directions = tuple(Point(d.x, d.y) for d in base)
+    pos, direction = update_position(
+        Point(x, y), ref_directions[direction_idx], resolution, args, turn_amnt, ref_directions, direction_idx)
+    where = (mode, resolution.x, resolution.y, x, y, direction_idx, turn_amnt)
+    assert (new_x, new_y) == (pos.x + direction.x, pos.y + direction.y), where
+    assert directions == ref_directions, where
+    return 1
+
+
+def main():
+    """Check the tables."""
+    parser = argparse.ArgumentParser("Check the collision tables against the step by step edge handling")
+    parser.add_argument(
+        "--max-size", action="store", type=int, default=4,
+        help="Check every image up to this many pixels a side (default 4)")
+    args = parser.parse_args()
+
+    try:
+        checked = check(args.max_size)
+    except AssertionError as exc:
+        print(f"Mismatch (mode, width, height, x, y, direction, turn): {exc}")
+        sys.exit(1)
+    print(f"Checked {checked} moves.")
+
+
+if __name__ == "__main__":
+    main()
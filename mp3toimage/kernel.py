@@ -0,0 +1,206 @@
+"""Array based walker kernel shared by the walking algorithms.
+
+The whole walk runs on integer arrays (direction and collision tables, a
+packed RGBA canvas and scalar state) so it can be compiled with numba when it is
+installed. Without numba the same kernel runs as plain Python. numba is
+only imported the first time the kernel is used since it's slow to import.
+"""
+import argparse
+
+import numpy as np
+
+from mp3toimage import collision
+from mp3toimage.playback import PlaybackRecorder
+from mp3toimage.song import SongImage
+from mp3toimage.util import Color
+
+#: Collision modes
+MODE_TURN = collision.MODE_TURN
+MODE_WRAP = collision.MODE_WRAP
+MODE_COLLIDE_180 = collision.MODE_COLLIDE_180
+#: Border bits and turn table entry (numba reads them as constants)
+LEFT = collision.LEFT
+RIGHT = collision.RIGHT
+TOP = collision.TOP
+BOTTOM = collision.BOTTOM
+NO_DIRECTION = collision.NO_DIRECTION
+
+#: Turn sequences
+TURN_UNIT = 0
+TURN_FIB = 1
+
+#: Codes recorded for changed pixels
+CHANGED_OFF_BEAT = 1
+CHANGED_BEAT = 2
+
+
+def _walk(
+    canvas, beats, amps, overall_avg_amplitude, slots, vector_x, vector_y,
+    turns, flips, wraps, x, y, mode, turn_sequence, turn_more, off_beat_color, beat_color,
+    record, changed_idx, changed_x, changed_y, changed_code):
+    """Walk the packed canvas. Returns the number of changed pixels recorded.
+
+    ``slots`` maps the direction indexes to step vectors and the edges
+    are handled with the tables of mp3toimage.collision.
+    """
+    last_x = canvas.shape[1] - 1
+    last_y = canvas.shape[0] - 1
+    num_dirs = slots.shape[0]
+    direction_idx = 0
+    fib_a = 0
+    fib_b = 1
+    count = 0
+
+    for idx in range(beats.shape[0]):
+        # Set the color
+        pixel = canvas[y, x]
+        code = 0
+        if not beats[idx] and pixel == 0:
+            canvas[y, x] = off_beat_color
+            code = CHANGED_OFF_BEAT
+        elif pixel == 0 or pixel == off_beat_color:
+            canvas[y, x] = beat_color
+            code = CHANGED_BEAT
+
+        if code and record:
+            changed_idx[count] = idx
+            changed_x[count] = x
+            changed_y[count] = y
+            changed_code[count] = code
+            count += 1
+
+        # Choose a direction. Only the turn amount modulo the number
+        # of directions matters, so the Fibonacci sequence is kept
+        # reduced to stay in machine integers.
+        amp = amps[idx]
+        turn_amnt = 1
+        if turn_sequence == TURN_FIB:
+            turn_amnt = fib_a
+            fib_a, fib_b = fib_b, (fib_a + fib_b) % num_dirs
+        if not amp > 0:
+            turn_amnt = -turn_amnt
+
+        direction_idx += turn_amnt
+
+        # Turn more if it's above average
+        if turn_more:
+            extra = 2
+            if turn_sequence == TURN_FIB:
+                extra = turn_amnt + 1
+            if amp > overall_avg_amplitude:
+                direction_idx += extra
+            elif amp < -overall_avg_amplitude:
+                direction_idx -= extra
+
+        direction_idx = (direction_idx % num_dirs + num_dirs) % num_dirs
+        vector = slots[direction_idx]
+
+        border = 0
+        if x == 0:
+            border |= LEFT
+        if x == last_x:
+            border |= RIGHT
+        if y == 0:
+            border |= TOP
+        if y == last_y:
+            border |= BOTTOM
+
+        if border != 0:
+            if mode == MODE_WRAP:
+                wrap = wraps[border, vector]
+                if wrap & LEFT:
+                    x = 0
+                elif wrap & RIGHT:
+                    x = last_x
+                if wrap & TOP:
+                    y = 0
+                elif wrap & BOTTOM:
+                    y = last_y
+            elif mode == MODE_COLLIDE_180:
+                # The flip sticks to the direction like it does for
+                # the shared direction points in the python engine
+                vector = flips[border, vector]
+                slots[direction_idx] = vector
+            else:
+                turned = turns[border, direction_idx, (turn_amnt % num_dirs + num_dirs) % num_dirs]
+                if turned == NO_DIRECTION:
+                    # No direction to turn to. Stay for this step.
+                    continue
+                vector = slots[turned]
+
+        x += vector_x[vector]
+        y += vector_y[vector]
+
+    return count
+
+
+#: The walk compiled with numba (the plain walk without numba). Set on first use.
+_compiled_walk = None
+
+
+def _get_walk():
+    """Get the compiled walk, compiling it the first time."""
+    global _compiled_walk
+    if _compiled_walk is None:
+        try:
+            import numba
+        except ImportError:
+            _compiled_walk = _walk
+        else:
+            _compiled_walk = numba.njit(cache=True, nogil=True)(_walk)
+    return _compiled_walk
+
+
+def compiled() -> bool:
+    """Check if the kernel is compiled with numba (it then walks without the GIL)."""
+    return _get_walk() is not _walk
+
+
+def pack_color(color: Color) -> np.uint32:
+    """Pack a color into the uint32 layout of an RGBA canvas pixel."""
+    return np.uint32(color.packed)
+
+
+def walk(
+    pixels: np.ndarray, song: SongImage, args: argparse.Namespace, directions: tuple,
+    turn_sequence: int, turn_more: bool, pb_list: PlaybackRecorder = None) -> None:
+    """Walk the image with the kernel, editing ``pixels`` in place."""
+    canvas = pixels.view(np.uint32).reshape(pixels.shape[0], pixels.shape[1])
+
+    mode = collision.collision_mode(args)
+
+    x = y = 0
+    if args.start_middle:
+        x = int(song.resolution.x / 2)
+        y = int(song.resolution.y / 2)
+
+    slots = np.array([collision.vector_id(direction) for direction in directions], dtype=np.int64)
+    turns = collision.turn_table(tuple(slots.tolist()))
+
+    # Every pixel changes at most once per step so the walk
+    # can't record more changes than there are steps
+    record = pb_list is not None
+    size = song.num_pixels if record else 0
+    changed_idx = np.empty(size, dtype=np.int64)
+    changed_x = np.empty(size, dtype=np.int64)
+    changed_y = np.empty(size, dtype=np.int64)
+    changed_code = np.empty(size, dtype=np.int8)
+
+    count = _get_walk()(
+        canvas, song.beats, song.amplitudes, song.overall_avg_amplitude,
+        slots, collision.VECTOR_X, collision.VECTOR_Y, turns, collision.FLIP_TABLE,
+        collision.WRAP_TABLE, x, y, mode, turn_sequence, turn_more,
+        pack_color(args.off_beat_color), pack_color(args.beat_color),
+        record, changed_idx, changed_x, changed_y, changed_code)
+
+    # Keep the shared direction points in sync with the flips
+    collision.store_slots(directions, slots.tolist())
+
+    if record:
+        # Map the change codes to playback palette indexes
+        palette = np.zeros(CHANGED_BEAT + 1, dtype=np.uint16)
+        palette[CHANGED_OFF_BEAT] = pb_list.color_index(args.off_beat_color)
+        palette[CHANGED_BEAT] = pb_list.color_index(args.beat_color)
+        pb_list.extend(
+            changed_x[:count], changed_y[:count], palette[changed_code[:count]],
+            song.timestamps[changed_idx[:count]])
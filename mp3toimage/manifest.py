@@ -0,0 +1,132 @@
+"""Manifest of the renders in an output directory for incremental runs.
+
+The manifest maps every song to its size, modification time and content
+hash, and every set of render parameters it was rendered with to the
+files that render wrote. A song whose size and modification time haven't
+changed isn't read again, so checking a big library costs one stat per
+song.
+"""
+import os
+import json
+import warnings
+import threading
+import argparse
+from typing import List
+
+from mp3toimage.algorithms import DEFAULT_SEED
+from mp3toimage.cache import file_digest
+from mp3toimage.util import Point
+
+MANIFEST_FILE = "mp3toimage-manifest.json"
+_VERSION = 1
+
+
+def render_params(resolution: Point, args: argparse.Namespace) -> str:
+    """Get the key of the parameters that change the output of a render."""
+    params = {
+        "resolution": f"{resolution.x}x{resolution.y}",
+        "alg": args.alg,
+        "image_format": args.image_format,
+        "decode": args.decode,
+        "analysis": args.analysis,
+        "bpm": args.bpm,
+        "tempo_excerpt": args.tempo_excerpt,
+        "beat_color": list(args.beat_color.as_tuple()),
+        "off_beat_color": list(args.off_beat_color.as_tuple()),
+        "wrap_collisions": args.wrap_collisions,
+        "collide_180": args.collide_180,
+        "start_middle": args.start_middle,
+        "four_directions": args.four_directions,
+        "playback": args.playback,
+        "playback_compress": args.playback_compress
+    }
+    if args.seed != DEFAULT_SEED:
+        # Left out at the default so renders recorded before the seed stay valid
+        params["seed"] = args.seed
+    if args.animate:
+        params["animate"] = args.animate
+        params["frame_interval"] = args.frame_interval
+        params["frame_duration"] = args.frame_duration
+    return json.dumps(params, sort_keys=True)
+
+
+class Manifest:
+    """The renders of an output directory (see render_params).
+
+    Call ``save()`` to write the renders recorded since it was loaded.
+    Renders can be recorded from several threads.
+    """
+
+    def __init__(self, out_dir: str):
+        #: The output directory
+        self.out_dir = out_dir
+        #: The manifest file path
+        self.path = os.path.join(out_dir, MANIFEST_FILE)
+        self._songs = {}
+        self._out_files = None
+        self._lock = threading.Lock()
+
+        try:
+            with open(self.path, "r") as fh:
+                manifest = json.load(fh)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            warnings.warn(f"Ignoring the unreadable manifest {self.path}: {exc}")
+            return
+
+        if manifest.get("version") == _VERSION:
+            self._songs = manifest["songs"]
+
+    def stale(self, song_path: str, resolutions: List[Point], args: argparse.Namespace) -> List[Point]:
+        """Get the resolutions of a song that have to be rendered (again).
+
+        The renders of a song that changed since they were recorded are
+        forgotten.
+        """
+        song = self._song(song_path)
+        if self._out_files is None:
+            self._out_files = set(os.listdir(self.out_dir)) if os.path.isdir(self.out_dir) else set()
+
+        stale = []
+        for resolution in resolutions:
+            outputs = song["renders"].get(render_params(resolution, args))
+            if outputs is None or not self._out_files.issuperset(outputs):
+                stale.append(resolution)
+        return stale
+
+    def record(self, song_path: str, resolution: Point, args: argparse.Namespace, outputs: List[str]) -> None:
+        """Record the files written by a render (none if the song was too short for it)."""
+        names = [os.path.basename(output) for output in outputs]
+        with self._lock:
+            song = self._song(song_path)
+            song["renders"][render_params(resolution, args)] = names
+            if self._out_files is not None:
+                self._out_files.update(names)
+
+    def save(self) -> None:
+        """Write the manifest to the output directory."""
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            with open(tmp_path, "w") as fh:
+                json.dump({"version": _VERSION, "songs": self._songs}, fh)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            warnings.warn(f"Unable to write the manifest {self.path}: {exc}")
+
+    def _song(self, song_path: str) -> dict:
+        """Get the entry of a song, starting it over if the file changed."""
+        key = os.path.abspath(song_path)
+        stat = os.stat(song_path)
+        song = self._songs.get(key)
+        if song is not None and song["size"] == stat.st_size and song["mtime"] == stat.st_mtime_ns:
+            return song
+
+        # Only read the song when the cheap checks fail. A song that was
+        # just copied or touched keeps its renders.
+        digest = file_digest(song_path)
+        if song is None or song["sha256"] != digest:
+            song = self._songs[key] = {"renders": {}}
+        song.update(size=stat.st_size, mtime=stat.st_mtime_ns, sha256=digest)
+        return song
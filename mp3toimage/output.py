@@ -0,0 +1,177 @@
+"""Encode finished canvases and save them as images.
+
+The walkers only draw the beat and off-beat colors on a transparent
+canvas, so the PNGs can be saved as indexed images (one byte per pixel
+instead of four), which are a lot cheaper to compress. Canvases can also
+be encoded on background threads (zlib and libwebp let go of the GIL) so
+the next walk doesn't wait for the encoder.
+"""
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Tuple
+
+import numpy as np
+from PIL import Image
+
+from mp3toimage import profiling
+from mp3toimage.util import Color
+
+#: Image formats and their file extensions
+FORMATS = {"png": ".png", "webp": ".webp", "qoi": ".qoi"}
+DEFAULT_COMPRESS_LEVEL = 6  # Pillow's default zlib level
+
+
+class OutputError(Exception):
+    """The images can't be saved with the requested settings."""
+
+
+def check_format(image_format: str) -> None:
+    """Make sure Pillow can save a format. Raises OutputError if it can't."""
+    Image.init()
+    if image_format.upper() not in Image.SAVE:
+        raise OutputError(f"This Pillow build ({Image.__version__}) can't save {image_format} images.")
+
+
+def palette_image(pixels: np.ndarray, colors: Iterable[Color]) -> Tuple[Image.Image, bytes]:
+    """Get an indexed image of a canvas and the alpha of every palette entry.
+
+    Returns (None, None) if the canvas holds colors other than ``colors``
+    and transparent.
+    """
+    palette = [Color.transparent()]
+    for color in colors:
+        if color not in palette:
+            palette.append(color)
+
+    packed = pixels.view(np.uint32).reshape(pixels.shape[0], pixels.shape[1])
+    indexes = np.zeros(packed.shape, dtype=np.uint8)
+    matched = np.count_nonzero(packed == palette[0].packed)
+    for idx, color in enumerate(palette[1:], 1):
+        mask = packed == color.packed
+        indexes[mask] = idx
+        matched += np.count_nonzero(mask)
+    if matched != packed.size:
+        return None, None
+
+    img = Image.fromarray(indexes, mode="P")
+    img.putpalette([channel for color in palette for channel in color.as_tuple()[:3]])
+    return img, bytes(color.alpha for color in palette)
+
+
+class ImageWriter:
+    """Save canvases as images, on a pool of background threads if it has any.
+
+    With ``palette`` PNGs of canvases that only hold the walker colors are
+    saved as indexed images. ``compress_level`` is the zlib level (0-9)
+    of PNGs and the encoder effort (0-6) of lossless WebPs. At most two
+    canvases per thread wait to be encoded.
+    """
+
+    def __init__(
+        self, image_format: str = "png", compress_level: int = DEFAULT_COMPRESS_LEVEL,
+        palette: bool = False, threads: int = 0):
+        #: The image format (one of FORMATS)
+        self.image_format = image_format
+        #: The compression level
+        self.compress_level = compress_level
+        #: Save indexed PNGs when the canvas allows it
+        self.palette = palette
+        #: Number of background threads. 0 to encode on the calling thread.
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(threads) if threads else None
+        self._slots = threading.BoundedSemaphore(2 * threads) if threads else None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "ImageWriter":
+        """Get the writer for the command line arguments."""
+        # cProfile can only follow one thread
+        threads = args.writer_threads if args.profile_stage is None else 0
+        return cls(args.image_format, args.compress_level, args.palette, threads)
+
+    def save(self, pixels: np.ndarray, out, colors: Iterable[Color] = ()) -> None:
+        """Encode a canvas to a path or file object now, on the calling thread."""
+        params = {}
+        img = None
+        if self.image_format == "png":
+            params["compress_level"] = self.compress_level
+            if self.palette:
+                img, alphas = palette_image(pixels, colors)
+                if img is not None:
+                    params["transparency"] = alphas
+        elif self.image_format == "webp":
+            params.update(lossless=True, method=min(self.compress_level, 6))
+
+        if img is None:
+            img = Image.fromarray(pixels)
+        img.save(out, format=self.image_format.upper(), **params)
+
+    def write(
+        self, pixels: np.ndarray, path: str, colors: Iterable[Color] = (),
+        done: Callable[[np.ndarray], None] = None) -> None:
+        """Save a canvas as an image, in the background if there are threads.
+
+        ``done`` is called with the canvas once it's encoded (e.g. to hand
+        it back to a canvas pool). Background errors are raised by flush().
+        """
+        if self._executor is None:
+            self._write(pixels, path, colors, done)
+            return
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write_in_background, pixels, path, colors, done, profiling.labels())
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.append((path, future))
+
+    def flush(self) -> None:
+        """Wait for every image to be saved. Raises the first background error."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for _path, future in pending:
+            future.result()
+
+    def when_saved(self, path: str, callback: Callable[[], None]) -> None:
+        """Call ``callback`` once the image last written to a path is saved.
+
+        It's called right away if the image is already saved and never if
+        saving it failed. Otherwise it runs on the thread that saved it.
+        """
+        with self._lock:
+            future = next((future for pending_path, future in reversed(self._pending) if pending_path == path), None)
+        if future is None:
+            callback()
+            return
+
+        def saved(future):
+            if not future.cancelled() and future.exception() is None:
+                callback()
+        future.add_done_callback(saved)
+
+    def close(self) -> None:
+        """Wait for every image to be saved and stop the threads."""
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def _write(self, pixels: np.ndarray, path: str, colors: Iterable[Color], done: Callable) -> None:
+        with profiling.stage("png_encode"):
+            self.save(pixels, path, colors)
+        if done is not None:
+            done(pixels)
+
+    def _write_in_background(
+        self, pixels: np.ndarray, path: str, colors: Iterable[Color], done: Callable, labels: dict) -> None:
+        try:
+            # Time the encode as part of the render that submitted it
+            profiling.set_labels(**labels)
+            self._write(pixels, path, colors, done)
+        finally:
+            self._slots.release()
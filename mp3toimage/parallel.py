@@ -0,0 +1,221 @@
+"""Render songs on a pool of worker processes.
+
+Each song is decoded once in the main process and its time series is
+copied into shared memory. The resolutions are then fanned out to the
+workers, which map the shared samples instead of unpickling them. With
+--single-pass whole songs are fanned out instead. The next songs are
+decoded while the workers render (see mp3toimage.prefetch).
+Streamed songs only hold their small per-pixel averages, which are
+sent to the workers as they are.
+"""
+import os
+import sys
+import signal
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import List, Tuple
+
+import numpy as np
+
+from mp3toimage import collision, profiling
+from mp3toimage.canvas import CanvasPool
+from mp3toimage.manifest import Manifest
+from mp3toimage.output import ImageWriter
+from mp3toimage.prefetch import prefetch
+from mp3toimage.song import NotEnoughSong, SongImage
+from mp3toimage.util import Point
+
+#: Parsed command line arguments in a worker process
+_ARGS = None
+
+
+class SharedSong:
+    """A decoded song whose time series lives in shared memory."""
+
+    def __init__(self, filename: str, num_renders: int):
+        entry = SongImage.load(filename)
+        time_series = entry["time_series"]
+        if time_series is not None:
+            # Work it out once instead of in every worker
+            SongImage.overall_avg_amplitude_of(entry)
+
+        #: The song file path
+        self.filename = filename
+        #: Renders of this song that haven't finished yet
+        self.remaining = num_renders
+        #: Everything a worker needs to rebuild the song cache entry
+        self.spec = {
+            "filename": filename,
+            "shm_name": None,
+            "entry": {key: value for key, value in entry.items() if key != "time_series"}
+        }
+        #: The shared memory block holding the time series
+        self.shm = None
+
+        if time_series is not None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(time_series.nbytes, 1))
+            shared = np.ndarray(time_series.shape, dtype=time_series.dtype, buffer=self.shm.buf)
+            shared[:] = time_series
+            del shared
+            self.spec.update(shm_name=self.shm.name, shape=time_series.shape, dtype=time_series.dtype.str)
+
+        # The shared copy is the only one we need to keep around
+        SongImage._song_cache.release(filename)
+
+    def release(self) -> None:
+        """Free the shared memory block."""
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Attach to a shared memory block owned by the main process."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    # Older versions register the block with the resource tracker on
+    # attach. The tracker is shared with the main process (see
+    # render_songs) so the main process unlinking it keeps it balanced.
+    return shared_memory.SharedMemory(name=name)
+
+
+def _init_worker(args: argparse.Namespace) -> None:
+    """Set up a worker process."""
+    global _ARGS
+
+    # Ctrl+C is handled by the main process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # The walkers only see songs through shared memory
+    SongImage.disk_cache = None
+    # A render can land on any worker, so it can't start from the flips of
+    # the collide-180 walks the worker ran before
+    collision.sticky_flips = False
+
+    import mp3toimage.__main__ as cli
+    cli.ALGORITHMS = cli.discover_algorithms()
+    cli.CANVAS_POOL = CanvasPool(mmap_dir=args.canvas_mmap_dir)
+    cli.IMAGE_WRITER = ImageWriter.from_args(args)
+    profiling.enable(profiling.Profiler(profile_stage=args.profile_stage) if args.profile else None)
+    _ARGS = args
+
+
+def _render(spec: dict, resolutions: List[Point]) -> Tuple[List[str], List[dict], str]:
+    """Render resolutions of a shared song (in one pass with --single-pass).
+
+    Returns the result of every resolution (an error message on failure),
+    the stage timings and the path of the dumped cProfile stats (None if
+    not profiling).
+    """
+    import mp3toimage.__main__ as cli
+
+    shm = time_series = None
+    if spec["shm_name"] is not None:
+        shm = _attach(spec["shm_name"])
+        time_series = np.ndarray(spec["shape"], dtype=spec["dtype"], buffer=shm.buf)
+    SongImage._song_cache.put(spec["filename"], dict(spec["entry"], time_series=time_series))
+
+    try:
+        if _ARGS.single_pass:
+            results = cli.generate_images(resolutions, spec["filename"], _ARGS)
+        else:
+            results = []
+            for resolution in resolutions:
+                try:
+                    cli.generate_image(resolution, spec["filename"], _ARGS)
+                    results.append("Done.")
+                except NotEnoughSong as exc:
+                    results.append(f"Failed. {exc}")
+        cli.IMAGE_WRITER.flush()
+    finally:
+        SongImage._song_cache.release(spec["filename"])
+        time_series = None
+        try:
+            if shm is not None:
+                shm.close()
+        except BufferError:
+            # Still referenced by an exception on its way out. The
+            # mapping goes away with the worker.
+            pass
+
+    profiler = profiling.active()
+    if profiler is None:
+        return results, [], None
+    return results, profiler.take_records(spec["filename"]), profiler.dump_stats(spec["filename"])
+
+
+def render_songs(
+    renders: List[Tuple[str, List[Point]]], args: argparse.Namespace, manifest: Manifest = None) -> None:
+    """Render every song at its resolutions using args.jobs processes.
+
+    Finished renders are recorded in ``manifest`` if there is one.
+    """
+    import mp3toimage.__main__ as cli
+
+    shared_songs = []
+    pending = []
+
+    def collect(block: bool) -> None:
+        """Report finished renders and free songs that are done."""
+        done = []
+        while pending:
+            done = [item for item in pending if item[2].ready()]
+            if done or not block:
+                break
+            pending[0][2].wait(0.1)
+
+        for item in done:
+            song, song_resolutions, pending_result = item
+            pending.remove(item)
+            results, records, stats_path = pending_result.get()
+            for resolution, result in zip(song_resolutions, results):
+                print(f"\t{resolution.x}x{resolution.y} {song.filename}...{result}", flush=True)
+                cli.record_render(manifest, song.filename, resolution, args, result)
+
+            profiler = profiling.active()
+            if profiler is not None:
+                profiler.add_records(records)
+                if stats_path is not None:
+                    profiler.add_stats(song.filename, stats_path)
+                    os.remove(stats_path)
+
+            song.remaining -= 1
+            if not song.remaining:
+                shared_songs.remove(song)
+                song.release()
+                if profiler is not None:
+                    summary = profiling.finish_song(song.filename, args.out_dir, args.profile_format)
+                    print(f"\tProfile: {song.filename}: {summary}", flush=True)
+                print(f"Done: {song.filename}", flush=True)
+
+    if os.name == "posix":
+        # Start the resource tracker before the workers so they all
+        # share it, whether they are forked or spawned.
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+    with multiprocessing.Pool(args.jobs, initializer=_init_worker, initargs=(args,)) as pool:
+        try:
+            for song_path, resolutions in prefetch(renders, args.prefetch):
+                # Bound the number of songs held in shared memory
+                while len(shared_songs) >= args.jobs:
+                    collect(block=True)
+
+                print(f"Processing: {song_path}...", flush=True)
+                profiling.set_labels(song=song_path, resolution=None)
+                # One task per song in a single pass or one per resolution
+                tasks = [resolutions] if args.single_pass else [[resolution] for resolution in resolutions]
+                song = SharedSong(song_path, len(tasks))
+                shared_songs.append(song)
+                for task in tasks:
+                    pending.append((song, task, pool.apply_async(_render, (song.spec, task))))
+                collect(block=False)
+
+            while pending:
+                collect(block=True)
+        finally:
+            # Leaving the pool context terminates any workers still running
+            for song in shared_songs:
+                song.release()
@@ -0,0 +1,369 @@
+"""Reader and writer for the binary playback (.pb) format.
+
+A playback file holds every pixel change of a walk so it can be replayed
+along with the song (see mp3toimage_visualizer). All numbers are little
+endian.
+
+Header::
+
+    magic        5s   b"MP3PB"
+    version      u8
+    flags        u16  FLAG_COMPRESSED when the chunk payloads are zlib streams
+    path length  u16  followed by the UTF-8 song path
+    resolution   u32 x, u32 y
+    pixel time   f64  seconds each pixel (and so each record) lasts
+    palette size u16  followed by that many RGBA colors (4 x u8)
+
+The records follow in chunks, each one a chunk header and a payload of
+``count`` packed records (x u16, y u16, palette index u16, timestamp f32)::
+
+    count        u32  number of records (0 ends the chunk list)
+    first time   f32  timestamp of the first record
+    last time    f32  timestamp of the last record
+    size         u32  payload size in bytes
+
+Chunks hold at most ``chunk_size`` records from ``chunk_time`` seconds of
+the song, so players can read the next chunk when the song gets to its
+first timestamp instead of loading the whole file up front.
+
+After the last chunk comes an index so readers can seek by song time::
+
+    chunks       u32  followed by (u64 file offset, f32 first time) per chunk
+    index offset u64  file offset of the index
+    magic        4s   b"PBIX"
+"""
+import os
+import sys
+import zlib
+import array
+import struct
+import argparse
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from mp3toimage.util import Point, Color
+
+MAGIC = b"MP3PB"
+INDEX_MAGIC = b"PBIX"
+VERSION = 1
+FLAG_COMPRESSED = 0x1
+DEFAULT_CHUNK_SIZE = 65536  # records
+DEFAULT_CHUNK_TIME = 1.0  # seconds of the song
+#: Biggest x, y and palette index a record holds (u16)
+MAX_RECORD_VALUE = 0xFFFF
+
+#: One packed playback record
+RECORD_DTYPE = np.dtype([("x", "<u2"), ("y", "<u2"), ("color", "<u2"), ("timestamp", "<f4")])
+
+_HEADER = struct.Struct("<5sBH")
+_RESOLUTION = struct.Struct("<IId")
+_CHUNK = struct.Struct("<IffI")
+_INDEX_ENTRY = struct.Struct("<Qf")
+_INDEX_TRAILER = struct.Struct("<Q4s")
+
+
+class PlaybackFormatError(Exception):
+    """The file isn't a valid binary playback file."""
+
+
+def check_resolution(resolution: Point) -> None:
+    """Check that the positions of an image fit in the records. Raises ValueError."""
+    if resolution.x - 1 > MAX_RECORD_VALUE or resolution.y - 1 > MAX_RECORD_VALUE:
+        raise ValueError(
+            f"Playback files can't hold {resolution.x}x{resolution.y} images "
+            f"(at most {MAX_RECORD_VALUE + 1} pixels a side).")
+
+
+def _record_column(values: np.ndarray, name: str) -> bytes:
+    """Get the bytes of a u16 record column. Raises ValueError instead of wrapping."""
+    values = np.asarray(values)
+    if len(values) and (values.min() < 0 or values.max() > MAX_RECORD_VALUE):
+        raise ValueError(f"Playback record {name} out of range (0 to {MAX_RECORD_VALUE}).")
+    return values.astype(np.uint16).tobytes()
+
+
+class PlaybackWriter:
+    """Write playback records to a binary .pb file in chunks."""
+
+    def __init__(
+        self, path: str, song_path: str, resolution: Point, pixel_time: float,
+        palette: List[Color], compress: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+        chunk_time: float = DEFAULT_CHUNK_TIME):
+        check_resolution(resolution)
+        if len(palette) > MAX_RECORD_VALUE + 1:
+            raise ValueError(f"Playback files can't hold more than {MAX_RECORD_VALUE + 1} colors.")
+        #: Number of records per chunk
+        self.chunk_size = chunk_size
+        #: Seconds of the song per chunk (None for chunks of chunk_size records only)
+        self.chunk_time = chunk_time
+        #: Compress the chunk payloads with zlib
+        self.compress = compress
+        self._pending = []
+        self._pending_count = 0
+        self._index = []
+        self._fh = open(path, "wb")
+
+        flags = FLAG_COMPRESSED if compress else 0
+        song_path = os.path.abspath(song_path).encode("utf-8")
+        self._fh.write(_HEADER.pack(MAGIC, VERSION, flags))
+        self._fh.write(struct.pack("<H", len(song_path)) + song_path)
+        self._fh.write(_RESOLUTION.pack(resolution.x, resolution.y, pixel_time))
+        self._fh.write(struct.pack("<H", len(palette)))
+        for color in palette:
+            self._fh.write(struct.pack("<4B", *color.as_tuple()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def write(self, records: np.ndarray) -> None:
+        """Add records (an array of RECORD_DTYPE) in timestamp order."""
+        self._pending.append(records)
+        self._pending_count += len(records)
+        if not self.chunk_time and self._pending_count < self.chunk_size:
+            return
+
+        records = np.concatenate(self._pending)
+        # The records of the last period of the song can still go on
+        # in the next write, unless they fill whole chunks
+        period_starts = [0]
+        if self.chunk_time:
+            periods = np.floor(records["timestamp"] / self.chunk_time)
+            period_starts.extend(np.flatnonzero(np.diff(periods)) + 1)
+        for start, end in zip(period_starts, period_starts[1:]):
+            for chunk_start in range(start, end, self.chunk_size):
+                self._write_chunk(records[chunk_start:min(chunk_start + self.chunk_size, end)])
+
+        start = period_starts[-1]
+        full = start + (len(records) - start) // self.chunk_size * self.chunk_size
+        for chunk_start in range(start, full, self.chunk_size):
+            self._write_chunk(records[chunk_start:chunk_start + self.chunk_size])
+        self._pending = [records[full:]]
+        self._pending_count = len(records) - full
+
+    def close(self) -> None:
+        """Write any remaining records, the index and close the file."""
+        if self._fh.closed:
+            return
+        if self._pending_count:
+            self._write_chunk(np.concatenate(self._pending))
+        self._pending = []
+        self._pending_count = 0
+        self._fh.write(_CHUNK.pack(0, 0.0, 0.0, 0))
+
+        index_offset = self._fh.tell()
+        self._fh.write(struct.pack("<I", len(self._index)))
+        for offset, first_ts in self._index:
+            self._fh.write(_INDEX_ENTRY.pack(offset, first_ts))
+        self._fh.write(_INDEX_TRAILER.pack(index_offset, INDEX_MAGIC))
+        self._fh.close()
+
+    def _write_chunk(self, records: np.ndarray) -> None:
+        payload = np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes()
+        if self.compress:
+            payload = zlib.compress(payload)
+        first_ts = float(records["timestamp"][0])
+        self._index.append((self._fh.tell(), first_ts))
+        self._fh.write(_CHUNK.pack(len(records), first_ts, float(records["timestamp"][-1]), len(payload)))
+        self._fh.write(payload)
+
+
+class PlaybackReader:
+    """Read a binary .pb file one chunk at a time."""
+
+    def __init__(self, path: str):
+        self._fh = open(path, "rb")
+        try:
+            magic, version, flags = _HEADER.unpack(self._read(_HEADER.size))
+            if magic != MAGIC:
+                raise PlaybackFormatError(f"{path} is not a binary playback file")
+            if version > VERSION:
+                raise PlaybackFormatError(f"Unsupported playback file version {version}")
+
+            #: Chunk payloads are zlib streams
+            self.compressed = bool(flags & FLAG_COMPRESSED)
+            path_len, = struct.unpack("<H", self._read(2))
+            #: Full path to the song file
+            self.song_path = self._read(path_len).decode("utf-8")
+            res_x, res_y, pixel_time = _RESOLUTION.unpack(self._read(_RESOLUTION.size))
+            #: The image resolution
+            self.resolution = Point(res_x, res_y)
+            #: How long each record lasts in seconds
+            self.pixel_time = pixel_time
+            palette_len, = struct.unpack("<H", self._read(2))
+            #: Colors referenced by the records' palette index
+            self.palette = [
+                Color(*struct.unpack("<4B", self._read(4))) for _ in range(palette_len)]
+            self._data_offset = self._fh.tell()
+        except Exception:
+            self._fh.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def close(self) -> None:
+        self._fh.close()
+
+    def chunks(self) -> Iterator[np.ndarray]:
+        """Iterate over the records one chunk at a time."""
+        self._fh.seek(self._data_offset)
+        while True:
+            count, _first_ts, _last_ts, size = _CHUNK.unpack(self._read(_CHUNK.size))
+            if not count:
+                return
+            payload = self._read(size)
+            if self.compressed:
+                payload = zlib.decompress(payload)
+            yield np.frombuffer(payload, dtype=RECORD_DTYPE, count=count)
+
+    def read_all(self) -> np.ndarray:
+        """Read every record."""
+        chunks = list(self.chunks())
+        if not chunks:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return np.concatenate(chunks)
+
+    def index(self) -> List[Tuple[int, float]]:
+        """Get the (file offset, first timestamp) of every chunk."""
+        self._fh.seek(-_INDEX_TRAILER.size, os.SEEK_END)
+        index_offset, magic = _INDEX_TRAILER.unpack(self._read(_INDEX_TRAILER.size))
+        if magic != INDEX_MAGIC:
+            raise PlaybackFormatError("Missing chunk index")
+        self._fh.seek(index_offset)
+        count, = struct.unpack("<I", self._read(4))
+        return [_INDEX_ENTRY.unpack(self._read(_INDEX_ENTRY.size)) for _ in range(count)]
+
+    def _read(self, size: int) -> bytes:
+        data = self._fh.read(size)
+        if len(data) != size:
+            raise PlaybackFormatError("Unexpected end of playback file")
+        return data
+
+
+class PlaybackRecorder:
+    """Collects the pixel changes of a walk in growable typed columns.
+
+    Every record of a walk lasts the same ``pixel_time`` so the duration
+    is kept once for the recorder rather than once per record.
+    """
+
+    def __init__(self, pixel_time: float):
+        #: How long each record lasts in seconds
+        self.pixel_time = pixel_time
+        #: Colors referenced by the records' palette index
+        self.palette = []
+        self._palette_idx = {}
+        self._x = array.array("H")
+        self._y = array.array("H")
+        self._color = array.array("H")
+        self._timestamp = array.array("d")
+
+    def __len__(self) -> int:
+        return len(self._timestamp)
+
+    def color_index(self, color: Color) -> int:
+        """Get the palette index of a color, adding it to the palette if needed."""
+        key = tuple(int(channel) for channel in color.as_tuple())
+        idx = self._palette_idx.get(key)
+        if idx is None:
+            if len(self.palette) > MAX_RECORD_VALUE:
+                raise ValueError(f"Playback files can't hold more than {MAX_RECORD_VALUE + 1} colors.")
+            idx = self._palette_idx[key] = len(self.palette)
+            self.palette.append(Color(*key))
+        return idx
+
+    def record(self, x: int, y: int, color_idx: int, timestamp: float) -> None:
+        """Record a single pixel change."""
+        self._x.append(x)
+        self._y.append(y)
+        self._color.append(color_idx)
+        self._timestamp.append(timestamp)
+
+    def extend(self, x: np.ndarray, y: np.ndarray, color_idx: np.ndarray, timestamps: np.ndarray) -> None:
+        """Record many pixel changes at once. Raises ValueError if a value doesn't fit in a record."""
+        x = _record_column(x, "x")
+        y = _record_column(y, "y")
+        color_idx = _record_column(color_idx, "color")
+        self._x.frombytes(x)
+        self._y.frombytes(y)
+        self._color.frombytes(color_idx)
+        self._timestamp.frombytes(np.asarray(timestamps, dtype=np.float64).tobytes())
+
+    def records(self) -> np.ndarray:
+        """Get every record as an array of RECORD_DTYPE."""
+        records = np.empty(len(self), dtype=RECORD_DTYPE)
+        if not len(self):
+            return records
+        records["x"] = np.frombuffer(self._x, dtype=np.uint16)
+        records["y"] = np.frombuffer(self._y, dtype=np.uint16)
+        records["color"] = np.frombuffer(self._color, dtype=np.uint16)
+        records["timestamp"] = np.frombuffer(self._timestamp, dtype=np.float64)
+        return records
+
+    def write(self, path: str, song_path: str, resolution: Point, compress: bool = False) -> None:
+        """Write every record to a playback file in one go."""
+        write_playback(
+            path, song_path, resolution, self.pixel_time, self.palette,
+            self.records(), compress=compress)
+
+
+def write_playback(
+    path: str, song_path: str, resolution: Point, pixel_time: float,
+    palette: List[Color], records: np.ndarray, compress: bool = False) -> None:
+    """Write a whole playback file at once."""
+    with PlaybackWriter(path, song_path, resolution, pixel_time, palette, compress=compress) as writer:
+        writer.write(records)
+
+
+def convert_text(src: str, dst: str, compress: bool = False) -> None:
+    """Convert a playback file in the old text format to the binary format."""
+    palette = []
+    palette_idx = {}
+    records = []
+    pixel_time = 0.0
+
+    with open(src, "r") as fh:
+        song_path = fh.readline().rstrip("\n")
+        res_x, res_y = fh.readline().strip().split(",")
+        for line in fh:
+            if not line.strip():
+                continue
+            x, y, r, g, b, a, timestamp, pixel_time = line.strip().split(",")
+            color = (int(r), int(g), int(b), int(a))
+            if color not in palette_idx:
+                palette_idx[color] = len(palette)
+                palette.append(Color(*color))
+            records.append((int(x), int(y), palette_idx[color], float(timestamp)))
+
+    write_playback(
+        dst, song_path, Point(int(res_x), int(res_y)), float(pixel_time),
+        palette, np.array(records, dtype=RECORD_DTYPE), compress=compress)
+
+
+def main():
+    """Convert text playback files to the binary format."""
+    parser = argparse.ArgumentParser("Convert a text .pb file to the binary .pb format")
+    parser.add_argument("src", help="Path to the text .pb file")
+    parser.add_argument("dst", help="Path for the binary .pb file")
+    parser.add_argument(
+        "--compress", action="store_true",
+        help="Compress the records with zlib.")
+    args = parser.parse_args()
+
+    with open(args.src, "rb") as fh:
+        if fh.read(len(MAGIC)) == MAGIC:
+            print(f"{args.src} is already a binary playback file.")
+            sys.exit(1)
+
+    convert_text(args.src, args.dst, compress=args.compress)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Decode the next songs in the background while the current one renders.
+
+Decoding is mostly spent in the audio libraries and the disk, so it runs
+on threads next to the walks (and the image writer threads). Only a few
+songs are decoded ahead, and they're held by the prefetcher instead of
+the song cache until it's their turn, so memory stays bounded and the
+song being rendered is never evicted for one that's waiting.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+from mp3toimage import profiling
+from mp3toimage.song import SongImage
+from mp3toimage.util import Point
+
+DEFAULT_PREFETCH = 1  # songs decoded ahead
+
+
+def _fetch(filename: str) -> dict:
+    """Decode a song on a prefetch thread."""
+    profiling.set_labels(song=filename, resolution=None)
+    return SongImage.fetch(filename)
+
+
+def prefetch(renders: List[Tuple[str, List[Point]]], depth: int = DEFAULT_PREFETCH) -> Iterator[Tuple[str, List[Point]]]:
+    """Yield the renders (song path and resolutions) in order once their song is in the song cache.
+
+    The next ``depth`` songs are decoded on as many threads in the
+    meantime. With a depth of 0 every song is decoded when it's its turn.
+    Decode errors are raised when the song's turn comes.
+    """
+    if depth < 1:
+        for song_path, resolutions in renders:
+            SongImage.load(song_path)
+            yield song_path, resolutions
+        return
+
+    pending = deque()
+    executor = ThreadPoolExecutor(depth)
+    try:
+        renders = iter(renders)
+        for song_path, resolutions in renders:
+            pending.append((song_path, resolutions, executor.submit(_fetch, song_path)))
+            if len(pending) > depth:
+                break
+
+        while pending:
+            song_path, resolutions, future = pending.popleft()
+            SongImage._song_cache.put(song_path, future.result())
+            del future
+            yield song_path, resolutions
+
+            # The song is rendered. Start on the next one.
+            for next_path, next_resolutions in renders:
+                pending.append((next_path, next_resolutions, executor.submit(_fetch, next_path)))
+                break
+    finally:
+        # Don't start on songs that won't be rendered (e.g. on Ctrl+C)
+        executor.shutdown(cancel_futures=True)
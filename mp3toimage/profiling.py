@@ -0,0 +1,197 @@
+"""Per-stage timers and optional cProfile of one stage.
+
+The pipeline wraps its stages in ``stage()``. Until a Profiler is enabled
+that returns a shared no-op context manager, so the timers cost nothing
+more than a function call.
+"""
+import os
+import csv
+import json
+import time
+import pstats
+import cProfile
+import tempfile
+import threading
+from typing import List
+
+#: Stages timed by the pipeline
+STAGES = (
+    "load_song", "decode", "tempo", "stream", "pixel_analysis",
+    "generate_pixels", "algorithm", "png_encode", "pb_write")
+
+#: The enabled profiler. None when profiling is off.
+_PROFILER = None
+
+
+class _NoStage:
+    """A context manager that does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage:
+    """Time a stage and add it to the profiler's records."""
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+        self.profiling = False
+
+    def __enter__(self):
+        self.profiling = self.name == self.profiler.profile_stage
+        if self.profiling:
+            self.profiler.cprofile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        elapsed = time.perf_counter() - self.start
+        if self.profiling:
+            self.profiler.cprofile.disable()
+            self.profiler.add_stats(self.profiler.labels["song"], self.profiler.cprofile)
+            self.profiler.cprofile = cProfile.Profile()
+        self.profiler.add_records([dict(self.profiler.labels, stage=self.name, seconds=elapsed)])
+        return False
+
+
+class Profiler:
+    """Collects stage timings labeled by song and resolution."""
+
+    def __init__(self, profile_stage: str = None):
+        #: Timings of every stage that ran (song, resolution, stage, seconds)
+        self.records = []
+        #: The stage to run under cProfile. None to only time the stages.
+        self.profile_stage = profile_stage
+        #: cProfile of the running profile stage
+        self.cprofile = cProfile.Profile() if profile_stage else None
+        self._stats = {}
+        self._local = threading.local()
+        # Prefetch and writer threads add records while songs are taken
+        self._records_lock = threading.Lock()
+
+    @property
+    def labels(self) -> dict:
+        """Labels added to every record of the current thread."""
+        labels = getattr(self._local, "labels", None)
+        if labels is None:
+            labels = self._local.labels = {"song": None, "resolution": None}
+        return labels
+
+    def stage(self, name: str) -> _Stage:
+        """Time a stage."""
+        return _Stage(self, name)
+
+    def add_records(self, records: List[dict]) -> None:
+        """Add stage records (e.g. from a worker process)."""
+        with self._records_lock:
+            self.records.extend(records)
+
+    def take_records(self, song: str) -> List[dict]:
+        """Remove and return the records of a song."""
+        with self._records_lock:
+            records = [record for record in self.records if record["song"] == song]
+            self.records = [record for record in self.records if record["song"] != song]
+        return records
+
+    def add_stats(self, song: str, source) -> None:
+        """Merge cProfile stats of a song (a dump file path or a cProfile.Profile)."""
+        stats = self._stats.get(song)
+        if stats is None:
+            self._stats[song] = pstats.Stats(source)
+        else:
+            stats.add(source)
+
+    def dump_stats(self, song: str, path: str = None) -> str:
+        """Write and forget the cProfile stats of a song.
+
+        Without a path the stats go to a temporary file. Returns the path
+        or None when nothing was profiled.
+        """
+        stats = self._stats.pop(song, None)
+        if stats is None:
+            return None
+
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".prof")
+            os.close(fd)
+        stats.dump_stats(path)
+        return path
+
+
+def enable(profiler: Profiler) -> None:
+    """Start timing stages with a profiler."""
+    global _PROFILER
+    _PROFILER = profiler
+
+
+def active() -> Profiler:
+    """Get the enabled profiler. None when profiling is off."""
+    return _PROFILER
+
+
+def stage(name: str):
+    """Time a stage if profiling is on."""
+    if _PROFILER is None:
+        return _NO_STAGE
+    return _PROFILER.stage(name)
+
+
+def set_labels(**labels) -> None:
+    """Set the song and/or resolution the following stages belong to."""
+    if _PROFILER is not None:
+        _PROFILER.labels.update(labels)
+
+
+def labels() -> dict:
+    """Get a copy of the labels of the current thread (empty when profiling is off)."""
+    if _PROFILER is None:
+        return {}
+    return dict(_PROFILER.labels)
+
+
+def _totals(records: List[dict]) -> dict:
+    """Sum the time of every stage."""
+    totals = {}
+    for record in records:
+        totals[record["stage"]] = totals.get(record["stage"], 0.0) + record["seconds"]
+    return totals
+
+
+def write_report(path: str, song: str, records: List[dict]) -> None:
+    """Write the stage timings of a song as JSON or CSV (by extension)."""
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as fh:
+            writer = csv.DictWriter(fh, fieldnames=("song", "resolution", "stage", "seconds"))
+            writer.writeheader()
+            writer.writerows(records)
+        return
+
+    with open(path, "w") as fh:
+        json.dump({
+            "song": song,
+            "totals": _totals(records),
+            "stages": [
+                {key: value for key, value in record.items() if key != "song"} for record in records]
+        }, fh, indent=2)
+
+
+def finish_song(song: str, out_dir: str, report_format: str = "json") -> str:
+    """Write the report (and cProfile stats) of a song to out_dir. Returns a summary."""
+    if _PROFILER is None:
+        return ""
+
+    name, _ = os.path.splitext(os.path.basename(song))
+    records = _PROFILER.take_records(song)
+    write_report(os.path.join(out_dir, f"{name}-profile.{report_format}"), song, records)
+    if _PROFILER.profile_stage:
+        _PROFILER.dump_stats(song, os.path.join(out_dir, f"{name}-{_PROFILER.profile_stage}.prof"))
+
+    return ", ".join(f"{stage_name} {seconds:.3f}s" for stage_name, seconds in _totals(records).items())
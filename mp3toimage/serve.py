@@ -0,0 +1,404 @@
+"""Render images on demand from a long-running server.
+
+``python -m mp3toimage serve`` answers HTTP requests (over TCP or a Unix
+socket) with the encoded image of a song::
+
+    GET /render?song=music/brass_monkey.mp3&resolution=512x512&alg=fib
+
+Besides ``song`` (a path under the server's root directory), a request
+can set ``resolution``, ``alg``, ``seed``, ``beat_color``, ``off_beat_color``
+and the ``wrap_collisions``, ``collide_180``, ``start_middle`` and
+``four_directions`` flags like the command line does. ``GET /status``
+returns the state of the caches as JSON.
+
+The interpreter, librosa and the algorithms are loaded once, and decoded
+songs stay in the in-memory song cache between requests. Decodes and
+walks run on a pool of threads (librosa, zlib and the compiled kernel let
+go of the GIL). Requests for a song that is being decoded wait for that
+decode instead of starting their own, and identical requests share one
+render.
+"""
+import os
+import io
+import sys
+import json
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import mp3toimage.algorithms
+from mp3toimage import analysis, collision
+from mp3toimage.cache import (
+    AnalysisCache, SongCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, DEFAULT_MEMORY_CACHE_SIZE)
+from mp3toimage.canvas import CanvasPool
+from mp3toimage.output import DEFAULT_COMPRESS_LEVEL, FORMATS, ImageWriter, OutputError, check_format
+from mp3toimage.song import NotEnoughSong, SongImage
+from mp3toimage.util import Point
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8750
+DEFAULT_MAX_PIXELS = 3840 * 2160
+#: Server decode modes. 'auto' needs the resolutions up front.
+DECODE_MODES = ("hq", "fast", "native")
+#: Image format -> content type
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp", "qoi": "image/qoi"}
+#: Render flags a request can turn on
+FLAGS = ("wrap_collisions", "collide_180", "start_middle", "four_directions")
+
+
+class RequestError(Exception):
+    """A request can't be rendered. Carries the HTTP status of the response."""
+
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        #: The HTTP status of the response
+        self.status = status
+
+
+def _stamp(path: str) -> Tuple[int, int]:
+    """Get the size and modification time of a file to notice when it changes."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _flag(value: str) -> bool:
+    """Parse a flag of a request ("", "1", "true", "yes" and "on" turn it on)."""
+    return value.lower() in ("", "1", "true", "yes", "on")
+
+
+class RenderServer:
+    """Render images of the songs under ``root`` for HTTP requests."""
+
+    def __init__(self, args: argparse.Namespace):
+        # Imported here so `python -m mp3toimage -h` doesn't pay for the server
+        from mp3toimage.__main__ import VALID_SONG_EXTS, validate_color
+
+        #: The server settings (command line arguments)
+        self.args = args
+        #: Only songs under this directory are rendered
+        self.root = os.path.realpath(args.root)
+        #: Algorithm plugins, imported on their first request and kept
+        self.algorithms = mp3toimage.algorithms.Registry()
+        #: Canvases reused between renders
+        self.canvas_pool = CanvasPool(mmap_dir=args.canvas_mmap_dir)
+        #: Encodes the images on the render threads
+        self.writer = ImageWriter(args.image_format, args.compress_level, args.palette)
+        self._song_exts = VALID_SONG_EXTS
+        self._validate_color = validate_color
+        self._executor = ThreadPoolExecutor(args.workers)
+        # Every walk starts from the same directions, so an image only
+        # depends on its request and collide-180 walks can run together
+        collision.sticky_flips = False
+        # In-flight decodes by song path and renders by request
+        self._decodes = {}
+        self._renders = {}
+        # Size and modification time of the cached songs
+        self._stamps = {}
+
+    def song_path(self, song: str) -> str:
+        """Get the path of a requested song. Raises RequestError if it can't be rendered."""
+        if not song:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Missing song.")
+        path = os.path.realpath(os.path.join(self.root, song))
+        try:
+            outside = os.path.commonpath([self.root, path]) != self.root
+        except ValueError:
+            # On another drive
+            outside = True
+        if outside:
+            raise RequestError(HTTPStatus.FORBIDDEN, f"{song} is outside of the song directory.")
+        if not os.path.isfile(path):
+            raise RequestError(HTTPStatus.NOT_FOUND, f"{song} - File not found.")
+        _, ext = os.path.splitext(path)
+        if ext not in self._song_exts:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"{song} - Unsupported file type.")
+        return path
+
+    def render_args(self, query: dict) -> Tuple[Point, argparse.Namespace]:
+        """Get the resolution and render arguments of a request. Raises RequestError if invalid."""
+        def param(name: str, default: str = None) -> str:
+            return query.get(name, [default])[-1]
+
+        try:
+            x, y = param("resolution", "512x512").split("x")
+            resolution = Point(int(x), int(y))
+        except ValueError as exc:
+            raise RequestError(
+                HTTPStatus.BAD_REQUEST,
+                f"Invalid resolution format. Expected <num>x<num> (e.g. 512x512): {exc}") from exc
+        if resolution.x < 1 or resolution.y < 1 or resolution.x * resolution.y > self.args.max_pixels:
+            raise RequestError(
+                HTTPStatus.BAD_REQUEST, f"Invalid resolution. At most {self.args.max_pixels} pixels.")
+
+        try:
+            beat_color = self._validate_color(param("beat_color", "255,221,74"))
+            off_beat_color = self._validate_color(param("off_beat_color", "60,105,151"))
+        except ValueError as exc:
+            raise RequestError(
+                HTTPStatus.BAD_REQUEST, f"Invalid color format. Expected <num>,<num>,<num>: {exc}") from exc
+
+        alg = param("alg", "basic")
+        if alg not in self.algorithms:
+            raise RequestError(
+                HTTPStatus.BAD_REQUEST, f"Unknown algorithm {alg}. One of: {', '.join(self.algorithms)}")
+
+        try:
+            seed = int(param("seed", str(mp3toimage.algorithms.DEFAULT_SEED)))
+        except ValueError as exc:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"Invalid seed: {exc}") from exc
+
+        args = argparse.Namespace(
+            alg=alg, seed=seed, engine=self.args.engine, beat_color=beat_color, off_beat_color=off_beat_color,
+            playback=False)
+        for flag in FLAGS:
+            setattr(args, flag, flag in query and _flag(param(flag)))
+        if args.wrap_collisions and args.collide_180:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "wrap_collisions and collide_180 can't be used together.")
+        return resolution, args
+
+    async def load(self, path: str) -> None:
+        """Decode a song into the song cache, or wait for the decode already running."""
+        stamp = _stamp(path)
+        if self._stamps.get(path) != stamp:
+            # The file changed since it was decoded
+            SongImage._song_cache.release(path)
+            self._stamps[path] = stamp
+        if path in SongImage._song_cache:
+            return
+
+        decode = self._decodes.get(path)
+        if decode is None:
+            decode = asyncio.get_running_loop().run_in_executor(self._executor, SongImage.load, path)
+            self._decodes[path] = decode
+            decode.add_done_callback(lambda _future: self._decodes.pop(path, None))
+        # A client that hangs up doesn't cancel the decode of the others
+        await asyncio.shield(decode)
+
+    async def render(self, path: str, resolution: Point, args: argparse.Namespace) -> bytes:
+        """Get the encoded image of a song, sharing the render of identical requests."""
+        await self.load(path)
+
+        key = (path, self._stamps[path], resolution, tuple(sorted(vars(args).items())))
+        render = self._renders.get(key)
+        if render is None:
+            render = asyncio.get_running_loop().run_in_executor(
+                self._executor, self._render, path, resolution, args)
+            self._renders[key] = render
+            render.add_done_callback(lambda _future: self._renders.pop(key, None))
+        return await asyncio.shield(render)
+
+    def _render(self, path: str, resolution: Point, args: argparse.Namespace) -> bytes:
+        """Walk and encode an image on a worker thread."""
+        # The song was evicted for others since it was decoded if it's a miss
+        song = SongImage(path, resolution)
+        pixels = self.canvas_pool.acquire(resolution)
+        try:
+            self.algorithms[args.alg].generate_image(pixels, song, args, pb_list=None)
+            out = io.BytesIO()
+            self.writer.save(pixels, out, colors=(args.off_beat_color, args.beat_color))
+        finally:
+            self.canvas_pool.release(pixels)
+        return out.getvalue()
+
+    def status(self) -> dict:
+        """Get the state of the caches."""
+        cache = SongImage._song_cache
+        return {
+            "songs": len(cache),
+            "song_cache_bytes": cache.size,
+            "song_cache_hits": cache.hits,
+            "song_cache_misses": cache.misses,
+            "song_cache_evictions": cache.evictions,
+            "decoding": len(self._decodes),
+            "rendering": len(self._renders)
+        }
+
+    async def respond(self, method: str, target: str) -> Tuple[HTTPStatus, str, bytes]:
+        """Get the status, content type and body of the response to a request."""
+        if method not in ("GET", "HEAD"):
+            return HTTPStatus.METHOD_NOT_ALLOWED, "text/plain", b"Only GET requests are supported.\n"
+
+        url = urlsplit(target)
+        if url.path == "/status":
+            return HTTPStatus.OK, "application/json", json.dumps(self.status()).encode()
+        if url.path != "/render":
+            return HTTPStatus.NOT_FOUND, "text/plain", b"Not found. Use /render or /status.\n"
+
+        query = parse_qs(url.query, keep_blank_values=True)
+        try:
+            path = self.song_path(query.get("song", [""])[-1])
+            resolution, args = self.render_args(query)
+            image = await self.render(path, resolution, args)
+        except RequestError as exc:
+            return exc.status, "text/plain", f"{exc}\n".encode()
+        except NotEnoughSong as exc:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, "text/plain", f"{exc}\n".encode()
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"Failed: {target} - {exc!r}", flush=True)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", b"The image could not be rendered.\n"
+        return HTTPStatus.OK, CONTENT_TYPES[self.args.image_format], image
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answer the requests of a connection until the client closes it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._send(writer, "HTTP/1.1", HTTPStatus.BAD_REQUEST, "text/plain", b"", False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                # Requests aren't expected to have a body, skip it if one is sent
+                length = int(headers.get("content-length", "0") or 0)
+                if length:
+                    await reader.readexactly(length)
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+                status, content_type, body = await self.respond(method, target)
+                await self._send(writer, version, status, content_type, body if method != "HEAD" else b"",
+                                 keep_alive, len(body))
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send(
+        writer: asyncio.StreamWriter, version: str, status: HTTPStatus, content_type: str, body: bytes,
+        keep_alive: bool, length: int = None) -> None:
+        """Write a response."""
+        head = (
+            f"{version} {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body) if length is None else length}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self) -> None:
+        """Listen for requests until cancelled."""
+        if self.args.unix_socket:
+            server = await asyncio.start_unix_server(self.handle, path=self.args.unix_socket)
+            where = self.args.unix_socket
+        else:
+            server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+            where = f"http://{self.args.host}:{self.args.port}"
+        print(f"Serving {self.root} on {where}. Press ctrl+c to stop", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    def close(self) -> None:
+        """Stop the worker threads."""
+        self._executor.shutdown(cancel_futures=True)
+
+
+def main(argv: List[str] = None):
+    """Entry point of ``python -m mp3toimage serve``."""
+    parser = argparse.ArgumentParser("mp3toimage serve", description="Render images of songs for HTTP requests")
+    parser.add_argument(
+        "--root", action="store", default=".",
+        help="Directory of the songs. Requested song paths are relative to it (default current directory).")
+    parser.add_argument(
+        "--host", action="store", default=DEFAULT_HOST,
+        help=f"Address to listen on (default {DEFAULT_HOST})")
+    parser.add_argument(
+        "--port", action="store", type=int, default=DEFAULT_PORT,
+        help=f"Port to listen on (default {DEFAULT_PORT})")
+    parser.add_argument(
+        "--unix-socket", action="store", default=None,
+        help="Listen on this Unix socket instead of a TCP port.")
+    parser.add_argument(
+        "-w", "--workers", action="store", type=int, default=os.cpu_count() or 1,
+        help="Number of threads that decode songs and render images (default number of CPUs)")
+    parser.add_argument(
+        "--max-pixels", action="store", type=int, default=DEFAULT_MAX_PIXELS,
+        help=f"Biggest image a request can ask for, in pixels (default {DEFAULT_MAX_PIXELS})")
+    parser.add_argument(
+        "--engine", action="store", default="kernel", choices=("python", "kernel"),
+        help="Walk engine for the walking algorithms (default kernel).")
+    parser.add_argument(
+        "--image-format", action="store", default="png", choices=FORMATS.keys(),
+        help="Format of the images (default png). WebP images are lossless.")
+    parser.add_argument(
+        "--compress-level", action="store", type=int, default=DEFAULT_COMPRESS_LEVEL,
+        help=f"zlib level of PNG images from 0 (fastest) to 9 (default {DEFAULT_COMPRESS_LEVEL}). "
+             "For WebP images, the encoder effort from 0 to 6.")
+    parser.add_argument(
+        "--palette", action="store_true",
+        help="Encode PNG images with a palette of the beat, off-beat and transparent colors.")
+    parser.add_argument(
+        "--decode", action="store", default="hq", choices=DECODE_MODES,
+        help="How songs are decoded (see python -m mp3toimage -h).")
+    parser.add_argument(
+        "--analysis", action="store", default="default", choices=analysis.PROFILES,
+        help="How the tempo of songs is found (see python -m mp3toimage -h).")
+    parser.add_argument(
+        "--tempo-excerpt", action="store", type=float, default=analysis.DEFAULT_EXCERPT,
+        help="Seconds of the song the 'excerpt' analysis measures the tempo on "
+             f"(default {analysis.DEFAULT_EXCERPT:g}).")
+    parser.add_argument(
+        "--cache-dir", action="store", default=DEFAULT_CACHE_DIR,
+        help=f"Directory for the persistent cache of decoded songs (default {DEFAULT_CACHE_DIR})")
+    parser.add_argument(
+        "--cache-size", action="store", type=int, default=DEFAULT_CACHE_SIZE,
+        help=f"Size cap of the persistent song cache in MB (default {DEFAULT_CACHE_SIZE})")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Don't use the persistent song cache.")
+    parser.add_argument(
+        "--memory-cache-size", action="store", type=int, default=DEFAULT_MEMORY_CACHE_SIZE,
+        help="Size cap of the in-memory cache of decoded songs kept warm between requests in MB "
+             f"(default {DEFAULT_MEMORY_CACHE_SIZE})")
+    parser.add_argument(
+        "--canvas-mmap-dir", action="store", default=None,
+        help="Back the image canvases with memory-mapped files in this directory instead of memory.")
+
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.root):
+        print(f"Invalid song directory. {args.root} - Directory not found.")
+        sys.exit(1)
+    if args.workers < 1 or args.max_pixels < 1 or args.tempo_excerpt <= 0:
+        print("Invalid settings. The workers, max pixels and tempo excerpt must be positive.")
+        sys.exit(1)
+    if args.unix_socket and not hasattr(asyncio, "start_unix_server"):
+        print("Invalid settings. Unix sockets aren't supported on this platform.")
+        sys.exit(1)
+    try:
+        check_format(args.image_format)
+    except OutputError as exc:
+        print(f"Invalid image format. {exc}")
+        sys.exit(1)
+
+    SongImage._song_cache = SongCache(max_bytes=args.memory_cache_size * 1024 * 1024)
+    if not args.no_cache:
+        SongImage.disk_cache = AnalysisCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+    SongImage.decode_mode = args.decode
+    SongImage.analysis_params = {"profile": args.analysis}
+    if args.analysis == "excerpt":
+        SongImage.analysis_params["excerpt"] = args.tempo_excerpt
+
+    server = RenderServer(args)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        server.close()
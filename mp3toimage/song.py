@@ -1,13 +1,29 @@
-"""Classes/helpers for parsing song files"""
+"""Classes/helpers for parsing song files
+
+librosa (and the stream module, which needs it) is slow to import so
+it's only imported when a song is actually decoded.
+"""
 import math
 import warnings
-from typing import Tuple
+from importlib import metadata
+from typing import List, Tuple
 
-import librosa
 import numpy as np
 
+from mp3toimage import analysis, profiling
+from mp3toimage.cache import SongCache
 from mp3toimage.util import Point
 
+#: How songs are decoded. 'hq' resamples to the decode rate with
+#: librosa's best resampler, 'fast' with its fast resampler and 'native'
+#: keeps the rate of the file. 'auto' decodes at the native rate and
+#: averages the samples down to what the biggest resolution needs.
+DECODE_MODES = ("hq", "fast", "native", "auto")
+#: Samples per pixel the auto decode mode keeps at least
+MIN_SAMPLES_PER_PIXEL = 32
+#: Lowest rate the auto decode mode goes down to, so the tempo can still be measured
+MIN_AUTO_RATE = 11025
+
 
 class NotEnoughSong(Exception):
     """There's just not enough song."""
@@ -18,76 +34,347 @@ class SongImage:
 
     #: Cache the song analysis to speed up processing when generating
     #: images from the same song with multiple resolutions.
-    _song_cache = {}
+    _song_cache = SongCache()
+    #: Optional persistent cache of decoded songs shared between
+    #: runs (see mp3toimage.cache.AnalysisCache).
+    disk_cache = None
+    #: Parameters used to decode songs. Part of the disk cache key.
+    decode_params = {"sr": 22050, "mono": True}
+    #: How songs are decoded (one of DECODE_MODES). Part of the disk cache key.
+    decode_mode = "hq"
+    #: Resolutions songs are decoded for. The auto decode mode picks the
+    #: sample rate for the biggest one.
+    decode_resolutions = None
+    #: How the tempo (and beats) of songs are analyzed (see
+    #: mp3toimage.analysis). Part of the disk cache key.
+    analysis_params = {"profile": "default"}
+    #: Resolutions to analyze songs for block by block instead of
+    #: decoding them whole (see mp3toimage.stream). None to decode whole.
+    stream_resolutions = None
 
-    def __init__(self, filename: str, resolution: Point):
-        #: The song file path
+    def __init__(self, filename: str, resolution: Point, analysis: "SongAnalysis" = None, entry: dict = None):
+        #: The song file path (or name of a song decoded by the caller)
         self.filename = filename
         #: The image resolution
         self.resolution = resolution
-        #: Load the song fresh or from the cache
-        self._load_song()
+        #: Shared analysis of the song when rendering several resolutions at once
+        self._analysis = analysis
+        #: Load the song fresh or from the cache, unless it's already decoded
+        self._load_song(entry)
         #: Convert to beats per second
         self.bps = self.tempo / 60.0
         #: Get the total number of pixels for the image
         self.num_pixels = self.resolution.x * self.resolution.y
         #: Get the amount of time each pixel will represent in seconds
         self.pixel_time = self.duration / self.num_pixels
-        #: Get the number of whole samples each pixel represents
-        self.samples_per_pixel = math.floor(len(self.time_series) / self.num_pixels)
+        if self._streamed is None:
+            num_samples = len(self.time_series)
+        else:
+            num_samples = self._streamed["num_samples"]
         #: Overall average amplitude
-        self.overall_avg_amplitude = np.absolute(self.time_series).mean()
+        self.overall_avg_amplitude = self.overall_avg_amplitude_of(self._entry)
+        #: Get the number of whole samples each pixel represents
+        self.samples_per_pixel = math.floor(num_samples / self.num_pixels)
 
-        if not self.samples_per_pixel:
+        # Songs decoded at another rate are held to the number of samples
+        # they have at the decode rate, so the same songs are long enough
+        # whatever the decode mode.
+        reference_samples = self._entry.get("reference_samples", num_samples)
+        if not self.samples_per_pixel or not math.floor(reference_samples / self.num_pixels):
             raise NotEnoughSong(
                 "Not enough song data to make an image "
                 f"with resolution {self.resolution.x}x{self.resolution.y}")
 
-    def _load_song(self) -> None:
-        """Load a song (use the cache if it's already loaded)."""
-        if self.filename in self._song_cache:
-            self.duration = self._song_cache[self.filename]["duration"]
-            self.time_series = self._song_cache[self.filename]["time_series"]
-            self.sample_rate = self._song_cache[self.filename]["sample_rate"]
-            self.tempo = self._song_cache[self.filename]["tempo"]
-            return
+        #: Per-pixel song info (timestamp, beat flag and average amplitude)
+        #: computed for every pixel at once so the algorithms can index into it
+        with profiling.stage("pixel_analysis"):
+            self.timestamps, self.beats, self.amplitudes = self._analyze_pixels()
+
+    def _load_song(self, entry: dict = None) -> None:
+        """Load a song (use the cache if it's already loaded) or use the decoded ``entry``."""
+        if entry is None:
+            with profiling.stage("load_song"):
+                entry = self.load(self.filename, self.resolution)
 
         #: Total song length in seconds
-        self.duration = librosa.get_duration(filename=self.filename)
+        self.duration = entry["duration"]
+        #: The time series data (amplitudes of the waveform). None for
+        #: streamed songs, which only keep the per-pixel averages.
+        self.time_series = entry["time_series"]
+        #: The sample rate of the time series
+        self.sample_rate = entry["sample_rate"]
+        #: The tempo (BPM)
+        self.tempo = entry["tempo"]
+        #: Times of the beats in seconds with the full analysis profile, else None
+        self.beat_times = entry.get("beat_times")
+        self._entry = entry
+        self._streamed = entry if self.time_series is None else None
+
+    @staticmethod
+    def overall_avg_amplitude_of(entry: dict) -> float:
+        """Get the overall average amplitude of a song entry.
+
+        It only depends on the song so it's computed once and kept in the
+        entry for every other resolution.
+        """
+        if "overall_avg_amplitude" not in entry:
+            entry["overall_avg_amplitude"] = np.absolute(entry["time_series"]).mean()
+        return entry["overall_avg_amplitude"]
+
+    @classmethod
+    def load(cls, filename: str, resolution: Point = None) -> dict:
+        """Get the decoded song data and analysis (use the caches if it's already loaded)."""
+        entry = cls._song_cache.get(filename)
+
+        # Streamed songs are only analyzed for the resolutions asked for
+        if entry is not None and entry["time_series"] is None and resolution is not None:
+            if resolution.x * resolution.y not in entry["pixel_amplitudes"]:
+                entry = cls._stream_song(filename, resolution, entry)
+                cls._song_cache.put(filename, entry)
+
+        if entry is None:
+            entry = cls.fetch(filename, resolution)
+
+            # Update the cache
+            cls._song_cache.put(filename, entry)
+
+        return entry
+
+    @classmethod
+    def fetch(cls, filename: str, resolution: Point = None) -> dict:
+        """Decode a song or read it from the disk cache, without the in-memory cache."""
+        if cls.stream_resolutions is not None:
+            return cls._stream_song(filename, resolution)
+        num_pixels = cls._decode_pixels(resolution)
+        if cls.disk_cache is None:
+            return cls._decode_song(filename, num_pixels)
+
+        # Decoded samples can change between librosa releases. The
+        # version comes from the package metadata to skip importing it.
+        decode_params = dict(cls.decode_params, mode=cls.decode_mode)
+        if cls.decode_mode == "auto":
+            decode_params["num_pixels"] = num_pixels
+        cache_key = cls.disk_cache.key(
+            filename, dict(
+                decode_params, analysis=cls.analysis_params, librosa=metadata.version("librosa")))
+        entry = cls.disk_cache.get(cache_key)
+        if entry is None:
+            entry = cls._decode_song(filename, num_pixels)
+            cls.disk_cache.put(cache_key, entry)
+        return entry
+
+    @classmethod
+    def _decode_pixels(cls, resolution: Point = None) -> int:
+        """Get the biggest number of pixels songs are decoded for. None if unknown."""
+        resolutions = list(cls.decode_resolutions or ())
+        if resolution is not None:
+            resolutions.append(resolution)
+        if not resolutions:
+            return None
+        return max(res.x * res.y for res in resolutions)
+
+    @classmethod
+    def _decode_song(cls, filename: str, num_pixels: int = None) -> dict:
+        """Decode and analyze a song file for images of up to ``num_pixels``."""
+        with profiling.stage("decode"):
+            duration, time_series, sample_rate, reference_samples = cls._load_samples(filename, num_pixels)
+        with profiling.stage("tempo"):
+            beats = analysis.analyze(filename, time_series, sample_rate, cls.analysis_params)
+
+        return {
+            "duration": duration,
+            "time_series": time_series,
+            "sample_rate": sample_rate,
+            "reference_samples": reference_samples,
+            "tempo": beats["tempo"],
+            "beat_times": beats["beat_times"]
+        }
+
+    @classmethod
+    def _load_samples(cls, filename: str, num_pixels: int = None) -> Tuple[float, np.ndarray, int, int]:
+        """Decode a song file with the decode mode.
+
+        Returns the duration, time series, sample rate and the number of
+        samples the song has at the decode rate.
+        """
+        import librosa
+
+        duration = librosa.get_duration(filename=filename)
 
         # Suppress the user warning for loading with audioread
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            #: The time series data (amplitudes of the waveform) and the sample rate
-            self.time_series, self.sample_rate = librosa.load(self.filename)
-
-        #: An onset envelop is used to measure BPM
-        onset_env = librosa.onset.onset_strength(self.time_series, sr=self.sample_rate)
-        #: Measure the tempo (BPM)
-        self.tempo = librosa.beat.tempo(onset_envelope=onset_env, sr=self.sample_rate)
-
-        # Update the cache
-        self._song_cache[self.filename] = {
-            "duration": self.duration,
-            "time_series": self.time_series,
-            "sample_rate": self.sample_rate,
-            "tempo": self.tempo
-        }
+            time_series, sample_rate = librosa.load(filename, **cls._load_params())
+
+        reference_samples = cls._reference_samples(len(time_series), sample_rate)
+        if cls.decode_mode == "auto" and num_pixels:
+            time_series, sample_rate = cls._decimate(time_series, sample_rate, duration, num_pixels)
+        return duration, time_series, sample_rate, reference_samples
+
+    @classmethod
+    def _load_params(cls) -> dict:
+        """Get the librosa.load parameters of the decode mode."""
+        params = dict(cls.decode_params)
+        if cls.decode_mode == "fast":
+            params["res_type"] = "kaiser_fast"
+        elif cls.decode_mode in ("native", "auto"):
+            params["sr"] = None
+        return params
+
+    @classmethod
+    def _reference_samples(cls, num_samples: int, sample_rate: int) -> int:
+        """Get the length resampling to the decode rate gives (like librosa.resample)."""
+        decode_rate = cls.decode_params.get("sr")
+        if decode_rate and decode_rate != sample_rate:
+            return int(np.ceil(num_samples * float(decode_rate) / sample_rate))
+        return num_samples
+
+    @staticmethod
+    def _decimation(sample_rate: int, duration: float, num_pixels: int) -> int:
+        """Get how many samples to average into one for images of ``num_pixels``.
+
+        It's the biggest block that divides the sample rate (so the new rate
+        is whole) and keeps the lowest rate the images need.
+        """
+        needed_rate = max(MIN_SAMPLES_PER_PIXEL * num_pixels / max(duration, 1e-9), MIN_AUTO_RATE)
+        factor = 1
+        for block in range(2, int(sample_rate // needed_rate) + 1):
+            if sample_rate % block == 0:
+                factor = block
+        return factor
+
+    @classmethod
+    def _decimate(
+            cls, time_series: np.ndarray, sample_rate: int, duration: float, num_pixels: int) -> Tuple[np.ndarray, int]:
+        """Average blocks of samples down to the lowest rate images of ``num_pixels`` need."""
+        factor = cls._decimation(sample_rate, duration, num_pixels)
+        if factor == 1:
+            return time_series, sample_rate
+
+        usable = len(time_series) - len(time_series) % factor
+        decimated = time_series[:usable].reshape(-1, factor).mean(axis=1, dtype=np.float64)
+        return decimated.astype(time_series.dtype), sample_rate // factor
+
+    @classmethod
+    def _stream_song(cls, filename: str, resolution: Point = None, entry: dict = None) -> dict:
+        """Analyze a song block by block for the stream resolutions and ``resolution``.
+
+        The samples are decoded like the decode mode decodes them. The tempo
+        and per-pixel averages of an earlier streamed ``entry`` are reused.
+        Streamed songs only follow the bpm analysis profile; the others
+        measure the tempo on the whole song.
+        """
+        from mp3toimage import stream
+
+        pixel_counts = {res.x * res.y for res in cls.stream_resolutions or ()}
+        if resolution is not None:
+            pixel_counts.add(resolution.x * resolution.y)
+
+        if entry is not None:
+            tempo = entry["tempo"]
+            pixel_counts.difference_update(entry["pixel_amplitudes"])
+        else:
+            tempo = analysis.given_tempo(filename, cls.analysis_params)
+
+        params = cls._load_params()
+        num_pixels = cls._decode_pixels(resolution)
+        try:
+            with profiling.stage("stream"):
+                sample_rate, num_samples = stream.song_length(filename, params)
+                decimate = 1
+                if cls.decode_mode == "auto" and num_pixels:
+                    decimate = cls._decimation(sample_rate, num_samples / sample_rate, num_pixels)
+                streamed = stream.analyze(
+                    filename, params, sorted(pixel_counts), song_tempo=tempo, decimate=decimate)
+        except stream.StreamError as exc:
+            warnings.warn(f"Decoding {filename} whole. {exc}")
+            return cls._decode_song(filename, num_pixels)
+
+        streamed["reference_samples"] = cls._reference_samples(num_samples, sample_rate)
+        if entry is not None:
+            streamed["pixel_amplitudes"].update(entry["pixel_amplitudes"])
+        return streamed
+
+    def _analyze_pixels(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Compute the timestamp, beat flag and average amplitude of every pixel."""
+        song_times = np.arange(self.num_pixels) * self.pixel_time
+
+        beats = np.zeros(self.num_pixels, dtype=bool)
+        if self.beat_times is not None:
+            # The pixels the tracked beats fall in are beats
+            beat_pixels = np.floor(self.beat_times / self.pixel_time).astype(np.int64)
+            beats[beat_pixels[beat_pixels < self.num_pixels]] = True
+        else:
+            # To figure out if it's a beat, let's just round and
+            # see if it's evenly divisible
+            floor_song_times = np.floor(song_times).astype(np.int64)
+            nonzero = floor_song_times != 0
+            beats[nonzero] = math.ceil(self.bps) % floor_song_times[nonzero] == 0
+
+        # Now let's figure out the average amplitude of the
+        # waveform for each pixel's time. Trailing samples that
+        # don't fill a whole pixel are dropped.
+        if self._streamed is not None:
+            avg_amplitudes = self._streamed["pixel_amplitudes"][self.num_pixels]
+        elif self._analysis is not None and self.num_pixels in self._analysis.pixel_amplitudes:
+            avg_amplitudes = self._analysis.pixel_amplitudes[self.num_pixels]
+        else:
+            avg_amplitudes = self._pixel_averages(self.time_series, self.num_pixels, self.samples_per_pixel)
+        return (song_times, beats, avg_amplitudes)
+
+    @staticmethod
+    def _pixel_averages(time_series: np.ndarray, num_pixels: int, samples_per_pixel: int) -> np.ndarray:
+        """Average the samples of every pixel (in the samples' precision)."""
+        samps = time_series[:num_pixels * samples_per_pixel].reshape(num_pixels, samples_per_pixel)
+        return samps.mean(axis=1)
 
     def get_info_at_pixel(self, pixel_idx: int) -> Tuple[bool, float, float]:
         """Get song info for the pixel at the provided pixel index."""
-        beat = False
-        song_time = pixel_idx * self.pixel_time
+        return (
+            bool(self.beats[pixel_idx]),
+            self.amplitudes[pixel_idx],
+            float(self.timestamps[pixel_idx])
+        )
 
-        # To figure out if it's a beat, let's just round and
-        # see if it's evenly divisible
-        floor_song_time = math.floor(song_time)
-        if floor_song_time and math.ceil(self.bps) % floor_song_time == 0:
-            beat = True
 
-        # Now let's figure out the average amplitude of the
-        # waveform for this pixel's time
-        sample_idx = pixel_idx * self.samples_per_pixel
-        samps = self.time_series[sample_idx:sample_idx + self.samples_per_pixel]
-        avg_amplitude = np.array(samps).mean()
-        return (beat, avg_amplitude, song_time)
+class SongAnalysis:
+    """Per-pixel analysis of a song for several resolutions at once.
+
+    The song is loaded once for all the resolutions and the pixel averages
+    of every resolution are taken like a lone SongImage takes them, so they
+    match it bit for bit.
+    """
+
+    def __init__(self, filename: str, resolutions: List[Point], entry: dict = None):
+        #: The song file path (or name of a song decoded by the caller)
+        self.filename = filename
+        #: Average amplitude of every pixel keyed by the number of pixels
+        self.pixel_amplitudes = {}
+        #: The decoded song when it doesn't come from the song cache
+        self._entry = entry
+
+        if entry is None:
+            entry = SongImage.load(filename)
+        if entry["time_series"] is None and self._entry is None:
+            # Streamed songs are only analyzed for the resolutions asked for
+            for resolution in resolutions:
+                entry = SongImage.load(filename, resolution)
+        if entry["time_series"] is None:
+            self.pixel_amplitudes = entry["pixel_amplitudes"]
+            return
+
+        with profiling.stage("pixel_analysis"):
+            self._analyze_pixels(entry["time_series"], resolutions)
+
+    def _analyze_pixels(self, time_series: np.ndarray, resolutions: List[Point]) -> None:
+        """Average the samples of every pixel of every resolution."""
+        for resolution in resolutions:
+            num_pixels = resolution.x * resolution.y
+            samples_per_pixel = math.floor(len(time_series) / num_pixels)
+            if samples_per_pixel and num_pixels not in self.pixel_amplitudes:
+                self.pixel_amplitudes[num_pixels] = SongImage._pixel_averages(
+                    time_series, num_pixels, samples_per_pixel)
+
+    def song_image(self, resolution: Point) -> SongImage:
+        """Get the song info for one of the resolutions."""
+        return SongImage(self.filename, resolution, analysis=self, entry=self._entry)
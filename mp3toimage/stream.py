@@ -0,0 +1,465 @@
+"""Block-wise song analysis for songs too long to decode in one go.
+
+The song is read in blocks with librosa.stream, mixed down, resampled
+with the resampler librosa.load uses (or averaged down for the auto
+decode mode) and folded into per-pixel amplitude accumulators and an
+onset envelope as it goes. Only the per-pixel averages and the onset
+envelope are kept, so memory grows with the resolution instead of with
+the decoded song.
+
+resampy (librosa 0.8) only resamples whole signals, so every block is
+resampled with the samples around it that the filter reaches (see
+_ResampyStream). soxr (librosa 0.10 and later) resamples a stream.
+
+The accumulators reduce the same samples the same way as the full-load
+analysis in mp3toimage.song. The onset envelope clips the spectrogram
+relative to its loudest value, which is only known at the end of the
+song, so the envelope is computed in a second pass over the file. The
+tempogram the tempo is picked from is averaged a block of frames at a
+time too. Resampled samples, spectrograms and averages of a block can
+differ from the full ones by float rounding, which leaves the analysis
+within a few ulps of the full-load analysis.
+"""
+import math
+import inspect
+import warnings
+from typing import Iterator, List, Tuple
+
+import librosa
+import numpy as np
+import soundfile
+
+try:
+    import resampy
+except ImportError:
+    resampy = None
+
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+DEFAULT_BLOCK_SIZE = 262144  # samples read per block
+TEMPOGRAM_BLOCK_SIZE = 1024  # onset frames autocorrelated per block
+#: Most samples summed in one go by the overall average (see _AbsMeanAccumulator)
+SUBTREE_SIZE = 65536
+#: Resampler librosa.load uses by default (it changed between releases)
+_LOAD_RES_TYPE = inspect.signature(librosa.load).parameters["res_type"].default
+#: librosa resamplers resampy resamples with
+_RESAMPY_FILTERS = ("kaiser_best", "kaiser_fast")
+#: librosa resamplers a soxr stream resamples like
+_SOXR_QUALITIES = {"soxr_vhq": "VHQ", "soxr_hq": "HQ", "soxr_mq": "MQ", "soxr_lq": "LQ", "soxr_qq": "QQ"}
+
+#: Spectrogram parameters of librosa.onset.onset_strength
+_N_FFT = 2048
+_HOP_LENGTH = 512
+_TOP_DB = 80.0
+#: Parameters of librosa.beat.tempo
+_AC_SIZE = 8.0
+_START_BPM = 120.0
+_STD_BPM = 1.0
+_MAX_TEMPO = 320.0
+
+
+class StreamError(Exception):
+    """The song can't be analyzed block by block."""
+
+
+class _ResampyStream:
+    """Resample a song block by block with resampy, like a soxr.ResampleStream.
+
+    Every chunk is resampled with the samples before it that the filter
+    reaches, and only the outputs the filter has every sample for are
+    returned. The samples kept start on an input sample that falls on an
+    output sample, so the outputs are taken at the same times as when the
+    whole song is resampled. resampy adds the output times up as it goes,
+    so the outputs that fall on an input sample can differ slightly from
+    a whole resample when the rates aren't multiples of each other.
+    """
+
+    def __init__(self, in_rate: int, out_rate: int, filter_name: str):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.filter_name = filter_name
+        gcd = math.gcd(in_rate, out_rate)
+        self._in_period = in_rate // gcd
+        # Input samples the filter reaches on either side of an output
+        interp_win, precision, _ = resampy.filters.get_filter(filter_name)
+        self._reach = len(interp_win) // int(min(1.0, out_rate / in_rate) * precision) + 1
+        self._buffer = np.empty(0, dtype=np.float32)
+        self._start = 0
+        self._produced = 0
+
+    def resample_chunk(self, samples: np.ndarray, last: bool = False) -> np.ndarray:
+        """Add the next samples. Returns the outputs they complete (all of them if it's the last)."""
+        self._buffer = np.concatenate((self._buffer, samples))
+        # Outputs whose last sample under the filter has arrived
+        ready = -(-(self._start + len(self._buffer) - self._reach) * self.out_rate // self.in_rate)
+        if len(self._buffer) * self.out_rate < self.in_rate or (not last and ready <= self._produced):
+            # resampy needs enough samples for one output
+            return np.empty(0, dtype=np.float32)
+
+        first = self._start * self.out_rate // self.in_rate
+        resampled = resampy.resample(self._buffer, self.in_rate, self.out_rate, filter=self.filter_name)
+        out = resampled[self._produced - first:None if last else ready - first]
+        self._produced += len(out)
+
+        # Keep the samples the filter reaches from the next output
+        keep = (self._produced * self.in_rate // self.out_rate - self._reach) // self._in_period * self._in_period
+        if keep > self._start:
+            self._buffer = self._buffer[keep - self._start:]
+            self._start = keep
+        return out
+
+
+class _PixelAccumulator:
+    """Average the samples of every pixel of one resolution as they arrive."""
+
+    def __init__(self, num_pixels: int, num_samples: int):
+        #: Number of whole samples each pixel represents
+        self.samples_per_pixel = math.floor(num_samples / num_pixels)
+        #: The average amplitude of every pixel
+        self.amplitudes = np.empty(num_pixels if self.samples_per_pixel else 0, dtype=np.float32)
+        self._filled = 0
+        self._leftover = np.empty(0, dtype=np.float32)
+
+    def add(self, samples: np.ndarray) -> None:
+        """Add the next block of samples."""
+        remaining = (len(self.amplitudes) - self._filled) * self.samples_per_pixel - len(self._leftover)
+        if remaining <= 0:
+            return
+
+        # Keep the samples of a pixel contiguous so the mean reduces them
+        # in the same order as the full-load analysis
+        samples = np.concatenate((self._leftover, samples[:remaining]))
+        whole = len(samples) // self.samples_per_pixel
+        used = whole * self.samples_per_pixel
+        if whole:
+            self.amplitudes[self._filled:self._filled + whole] = \
+                samples[:used].reshape(whole, self.samples_per_pixel).mean(axis=1)
+            self._filled += whole
+        self._leftover = samples[used:]
+
+
+def _pairwise_split(size: int) -> int:
+    """Get the size of the first half numpy's pairwise sum splits ``size`` values into."""
+    half = size // 2
+    return half - half % 8
+
+
+def _subtrees(start: int, size: int) -> Iterator[Tuple[int, int]]:
+    """Split values the way numpy's pairwise sum does down to SUBTREE_SIZE. Yields (start, size)."""
+    if size <= SUBTREE_SIZE:
+        yield start, size
+        return
+    half = _pairwise_split(size)
+    yield from _subtrees(start, half)
+    yield from _subtrees(start + half, size - half)
+
+
+def _buffered_sum() -> bool:
+    """Check if numpy sums big float32 arrays a buffer at a time.
+
+    numpy 1 sums every np.getbufsize() values pairwise and adds the sums
+    up in order, numpy 2 sums the whole array pairwise.
+    """
+    bufsize = np.getbufsize()
+    # Buffer sums of 2**24, 1 and 1, which round differently depending
+    # on the order they're added up in
+    probe = np.full(3 * bufsize, 1.0 / bufsize, dtype=np.float32)
+    probe[:bufsize] = 2.0 ** 24 / bufsize
+    total = np.float32(0.0)
+    for start in range(0, len(probe), bufsize):
+        total += np.add.reduce(probe[start:start + bufsize])
+    return np.add.reduce(probe) == total
+
+
+_BUFFERED_SUM = _buffered_sum()
+
+
+class _AbsMeanAccumulator:
+    """Average the absolute value of the samples as they arrive.
+
+    The full-load analysis takes the float32 mean of the whole song, which
+    numpy sums pairwise: it splits the values in halves (rounded down to a
+    multiple of 8) until they're 128 long. The splits only depend on the
+    number of values, so the song is cut into the same subtrees of up to
+    SUBTREE_SIZE samples, numpy sums every one of them once it has arrived
+    and the sums are added up the way numpy would. numpy 1 sums a buffer
+    at a time instead (see _buffered_sum), so the song is cut into buffers
+    whose sums are added up in order.
+    """
+
+    def __init__(self, num_samples: int):
+        self.num_samples = num_samples
+        if _BUFFERED_SUM:
+            bufsize = np.getbufsize()
+            self._subtrees = [
+                (start, min(bufsize, num_samples - start)) for start in range(0, num_samples, bufsize)]
+        else:
+            self._subtrees = list(_subtrees(0, num_samples))
+        self._sums = []
+        self._buffer = np.empty(0, dtype=np.float32)
+        self._offset = 0
+
+    def add(self, samples: np.ndarray) -> None:
+        """Add the next block of samples."""
+        self._buffer = np.concatenate((self._buffer, np.absolute(samples)))
+        end = self._offset + len(self._buffer)
+        while len(self._sums) < len(self._subtrees):
+            start, size = self._subtrees[len(self._sums)]
+            if start + size > end:
+                break
+            self._sums.append(np.add.reduce(self._buffer[start - self._offset:start - self._offset + size]))
+            self._buffer = self._buffer[start + size - self._offset:]
+            self._offset = start + size
+
+    def finish(self) -> np.float32:
+        """Get the average like numpy.mean of the whole song."""
+        if not self.num_samples:
+            return np.float32(0.0)
+        if _BUFFERED_SUM:
+            total = np.float32(0.0)
+            for subtotal in self._sums:
+                total += subtotal
+        else:
+            total = self._combine(iter(self._sums), self.num_samples)
+        # The division numpy.mean does
+        return total.dtype.type(total / self.num_samples)
+
+    def _combine(self, sums: Iterator[np.float32], size: int) -> np.float32:
+        if size <= SUBTREE_SIZE:
+            return next(sums)
+        half = _pairwise_split(size)
+        return self._combine(sums, half) + self._combine(sums, size - half)
+
+
+class _OnsetAccumulator:
+    """Build the librosa onset strength envelope block by block.
+
+    Without a ``max_db`` only the loudest value of the log-power mel
+    spectrogram is measured. With it, the envelope is built clipping the
+    spectrogram the way librosa.power_to_db does with ``top_db``.
+    """
+
+    def __init__(self, sample_rate: int, max_db: np.float32 = None):
+        self.sample_rate = sample_rate
+        #: The loudest value of the log-power mel spectrogram
+        self.max_db = max_db
+        self._measure = max_db is None
+        # The spectrogram padding changed between librosa releases
+        self._pad_mode = inspect.signature(librosa.feature.melspectrogram).parameters["pad_mode"].default
+        self._buffer = None
+        self._head = np.empty(0, dtype=np.float32)
+        self._last_frames = None
+        self._num_frames = 0
+        self._envelope = []
+
+    def add(self, samples: np.ndarray) -> None:
+        """Add the next block of samples."""
+        if self._buffer is None:
+            # Centered frames need the start of the song to pad it
+            self._head = np.concatenate((self._head, samples))
+            if len(self._head) <= _N_FFT // 2:
+                return
+            samples = np.pad(self._head, (_N_FFT // 2, 0), mode=self._pad_mode)
+            self._buffer = np.empty(0, dtype=np.float32)
+            self._head = None
+
+        self._buffer = np.concatenate((self._buffer, samples))
+        self._frames()
+
+    def finish(self) -> np.ndarray:
+        """Add the end of the song. Returns the envelope if one was built."""
+        if self._buffer is None:
+            self._buffer = np.pad(self._head, (_N_FFT // 2, 0), mode=self._pad_mode)
+        self._buffer = np.pad(self._buffer, (0, _N_FFT // 2), mode=self._pad_mode)
+        self._frames()
+        if self._measure:
+            return None
+
+        # Shift for the lag and the frame centering and trim to the
+        # frame count like librosa.onset.onset_strength
+        envelope = np.concatenate([np.zeros(1 + _N_FFT // (2 * _HOP_LENGTH), dtype=np.float32)] + self._envelope)
+        return envelope[:self._num_frames]
+
+    def _frames(self) -> None:
+        """Analyze every whole frame in the buffer."""
+        if len(self._buffer) < _N_FFT:
+            return
+        num_frames = 1 + (len(self._buffer) - _N_FFT) // _HOP_LENGTH
+        mel = librosa.feature.melspectrogram(
+            y=self._buffer[:(num_frames - 1) * _HOP_LENGTH + _N_FFT], sr=self.sample_rate,
+            n_fft=_N_FFT, hop_length=_HOP_LENGTH, center=False)
+        self._buffer = self._buffer[num_frames * _HOP_LENGTH:]
+        self._num_frames += num_frames
+
+        log_mel = librosa.power_to_db(mel, top_db=None)
+        if self._measure:
+            block_max = log_mel.max()
+            if self.max_db is None or block_max > self.max_db:
+                self.max_db = block_max
+            return
+
+        log_mel = np.maximum(log_mel, self.max_db - _TOP_DB)
+
+        # Overlap the last frame already used so the band average never
+        # runs on a single frame, which numpy sums in a different order
+        num_overlap = 0
+        if self._last_frames is not None:
+            num_overlap = self._last_frames.shape[1] - 1
+            log_mel = np.concatenate((self._last_frames, log_mel), axis=1)
+        self._last_frames = log_mel[:, -2:]
+
+        # Without centering the envelope of the frames starts with the lag
+        onsets = librosa.onset.onset_strength(S=log_mel, sr=self.sample_rate, center=False)
+        self._envelope.append(onsets[1 + num_overlap:])
+
+
+def tempo(onset_env: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Measure the tempo like librosa.beat.tempo without building the whole tempogram.
+
+    The tempogram holds a few hundred values for every onset frame, far
+    more than the envelope itself, so librosa.feature.tempogram builds it
+    a block of frames at a time and only its time average is kept.
+    """
+    win_length = librosa.time_to_frames(_AC_SIZE, sr=sample_rate, hop_length=_HOP_LENGTH).item()
+
+    # The padding librosa.feature.tempogram centers the windows with. A
+    # block of uncentered windows over it is that block of the tempogram.
+    num_frames = len(onset_env)
+    padded = np.pad(onset_env, int(win_length // 2), mode="linear_ramp", end_values=[0, 0])
+
+    total = np.zeros(win_length)
+    for start in range(0, num_frames, TEMPOGRAM_BLOCK_SIZE):
+        stop = min(start + TEMPOGRAM_BLOCK_SIZE, num_frames)
+        block = librosa.feature.tempogram(
+            onset_envelope=padded[start:stop + win_length - 1], sr=sample_rate, hop_length=_HOP_LENGTH,
+            win_length=win_length, center=False)
+        total += block.sum(axis=1)
+    tempogram = total[:, np.newaxis] / num_frames
+
+    # Weight the autocorrelation by a log-normal distribution around the
+    # start tempo and kill everything above the max tempo
+    bpms = librosa.tempo_frequencies(win_length, hop_length=_HOP_LENGTH, sr=sample_rate)
+    logprior = -0.5 * ((np.log2(bpms) - np.log2(_START_BPM)) / _STD_BPM) ** 2
+    logprior[:int(np.argmax(bpms < _MAX_TEMPO))] = -np.inf
+
+    best_period = np.argmax(np.log1p(1e6 * tempogram) + logprior[:, np.newaxis], axis=0)
+    return bpms[best_period]
+
+
+def song_length(filename: str, decode_params: dict) -> Tuple[int, int]:
+    """Get the sample rate and number of samples a song decodes to."""
+    try:
+        info = soundfile.info(filename)
+    except RuntimeError as exc:
+        raise StreamError(f"Unable to read {filename} in blocks: {exc}")
+
+    sample_rate = decode_params.get("sr") or info.samplerate
+    if sample_rate == info.samplerate:
+        return sample_rate, info.frames
+    return sample_rate, int(np.ceil(info.frames * (float(sample_rate) / info.samplerate)))
+
+
+def _average_down(samples: np.ndarray, factor: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Average blocks of ``factor`` samples. Returns the averages and the samples left over."""
+    usable = len(samples) - len(samples) % factor
+    averages = samples[:usable].reshape(-1, factor).mean(axis=1, dtype=np.float64)
+    return averages.astype(samples.dtype), samples[usable:]
+
+
+def blocks(
+    filename: str, decode_params: dict, block_size: int = DEFAULT_BLOCK_SIZE,
+    decimate: int = 1) -> Iterator[np.ndarray]:
+    """Decode a song block by block, mixed down and resampled like librosa.load.
+
+    With ``decimate`` every that many samples are averaged into one like
+    the auto decode mode does (see SongImage._decimate).
+    """
+    if not decode_params.get("mono", True):
+        raise StreamError("Only mono decoding can be streamed")
+
+    sample_rate, num_samples = song_length(filename, decode_params)
+    num_samples //= decimate
+    native_rate = librosa.get_samplerate(filename)
+    resampler = None
+    if sample_rate != native_rate:
+        res_type = decode_params.get("res_type", _LOAD_RES_TYPE)
+        if res_type in _RESAMPY_FILTERS and resampy is not None:
+            resampler = _ResampyStream(native_rate, sample_rate, res_type)
+        elif res_type in _SOXR_QUALITIES and soxr is not None:
+            resampler = soxr.ResampleStream(
+                native_rate, sample_rate, 1, dtype="float32", quality=_SOXR_QUALITIES[res_type])
+        else:
+            raise StreamError(f"Resampling with {res_type} in blocks isn't supported")
+
+    produced = 0
+    leftover = np.empty(0, dtype=np.float32)
+    for samples in librosa.stream(filename, block_length=block_size, frame_length=1, hop_length=1, mono=True):
+        if resampler is not None:
+            samples = resampler.resample_chunk(samples)
+        if decimate > 1:
+            samples, leftover = _average_down(np.concatenate((leftover, samples)), decimate)
+        samples = samples[:num_samples - produced]
+        produced += len(samples)
+        yield samples
+
+    if resampler is not None:
+        samples = resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)
+        if decimate > 1:
+            samples, leftover = _average_down(np.concatenate((leftover, samples)), decimate)
+        samples = samples[:num_samples - produced]
+        produced += len(samples)
+        yield samples
+
+    # Match the length of a full decode
+    if produced < num_samples:
+        yield np.zeros(num_samples - produced, dtype=np.float32)
+
+
+def analyze(
+    filename: str, decode_params: dict, pixel_counts: List[int], song_tempo: np.ndarray = None,
+    block_size: int = DEFAULT_BLOCK_SIZE, decimate: int = 1) -> dict:
+    """Analyze a song for every pixel count without holding the decoded song.
+
+    The tempo is measured too unless it's provided (e.g. from an earlier
+    pass over the same song). ``decimate`` averages the samples down (see
+    blocks()).
+    """
+    sample_rate, num_samples = song_length(filename, decode_params)
+    sample_rate //= decimate
+    num_samples //= decimate
+    pixels = {num_pixels: _PixelAccumulator(num_pixels, num_samples) for num_pixels in pixel_counts}
+    onsets = _OnsetAccumulator(sample_rate) if song_tempo is None else None
+    abs_mean = _AbsMeanAccumulator(num_samples)
+
+    for samples in blocks(filename, decode_params, block_size, decimate):
+        abs_mean.add(samples)
+        for accumulator in pixels.values():
+            accumulator.add(samples)
+        if onsets is not None:
+            onsets.add(samples)
+
+    if onsets is not None:
+        onsets.finish()
+        onsets = _OnsetAccumulator(sample_rate, max_db=onsets.max_db)
+        for samples in blocks(filename, decode_params, block_size, decimate):
+            onsets.add(samples)
+        song_tempo = tempo(onsets.finish(), sample_rate)
+
+    # Suppress the user warning for reading with audioread
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        duration = librosa.get_duration(filename=filename)
+
+    return {
+        "duration": duration,
+        "time_series": None,
+        "sample_rate": sample_rate,
+        "tempo": song_tempo,
+        "num_samples": num_samples,
+        "overall_avg_amplitude": abs_mean.finish(),
+        "pixel_amplitudes": {
+            num_pixels: accumulator.amplitudes for num_pixels, accumulator in pixels.items()}
+    }
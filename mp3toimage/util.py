@@ -1,4 +1,5 @@
 """Shared utility methods and classes."""
+import sys
 from typing import Tuple
 
 import numpy as np
@@ -7,52 +8,77 @@ import numpy as np
 class Point:
     """A class with an x and y attribute to represent a point."""
 
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
 
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Point):
+            return NotImplemented
+        return self.x == other.x and self.y == other.y
+
     def __hash__(self) -> int:
-        return hash(f"{self.x},{self.y}")
+        return hash((self.x, self.y))
 
 
 class Color:
-    """A class to represent a color."""
+    """A class to represent a color.
+
+    Colors are immutable. ``packed`` holds the color the way a pixel of an
+    RGBA canvas viewed as uint32 does, so walkers can compare and set
+    pixels as plain integers.
+    """
+
+    __slots__ = ("red", "green", "blue", "alpha", "packed")
 
     def __init__(self, r, g, b, a):
-        self.red = r
-        self.green = g
-        self.blue = b
-        self.alpha = a
+        object.__setattr__(self, "red", r)
+        object.__setattr__(self, "green", g)
+        object.__setattr__(self, "blue", b)
+        object.__setattr__(self, "alpha", a)
+        object.__setattr__(self, "packed", int.from_bytes(bytes((r, g, b, a)), sys.byteorder))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Colors are immutable")
+
+    def __reduce__(self):
+        return (Color, self.as_tuple())
 
     def as_tuple(self) -> Tuple[int, int, int, int]:
         return (self.red, self.green, self.blue, self.alpha)
 
     @classmethod
     def transparent(cls):
-        return cls(0, 0, 0, 0)
+        return TRANSPARENT
 
     @classmethod
     def from_tuple(cls, as_tuple: Tuple[int, int, int, int]) -> object:
         return cls(as_tuple[0], as_tuple[1], as_tuple[2], as_tuple[3])
 
+    @classmethod
+    def from_packed(cls, packed: int) -> object:
+        return cls(*int(packed).to_bytes(4, sys.byteorder))
+
     def __eq__(self, other: object) -> bool:
-        return self.red == other.red and\
-               self.green == other.green and\
-               self.blue == other.blue and\
-               self.alpha == other.alpha
+        if not isinstance(other, Color):
+            return NotImplemented
+        return self.packed == other.packed
+
+    def __hash__(self) -> int:
+        return self.packed
 
     def __str__(self):
         return f"{self.red},{self.green},{self.blue},{self.alpha}"
 
 
-def generate_pixels(resolution: Point) -> np.ndarray:
-    """Generate transparent pixels for an image."""
-    pixels = []
+#: The color of a fresh canvas
+TRANSPARENT = Color(0, 0, 0, 0)
 
-    for _row in range(resolution.y):
-        cur_row = []
-        for _col in range(resolution.x):
-            cur_row.append(Color.transparent().as_tuple())
-        pixels.append(cur_row)
 
-    return np.array(pixels, dtype=np.uint8)
\ No newline at end of file
+def generate_pixels(resolution: Point) -> np.ndarray:
+    """Generate transparent pixels for an image."""
+    # Imported here since the canvas module builds on Point and Color
+    from mp3toimage.canvas import new_canvas
+    return new_canvas(resolution)
\ No newline at end of file
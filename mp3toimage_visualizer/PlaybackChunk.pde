@@ -0,0 +1,53 @@
+/*
+ * PlaybackChunk.pde
+ *
+ * The records of one chunk of a .pb file, held in
+ * arrays that are reused for every chunk, and the
+ * cursor of the next record to draw.
+ *
+ *  Created on: October 18, 2026
+ */
+
+class PlaybackChunk {
+    /*
+     * Records of a chunk in timestamp order. pixels
+     * holds the index of every record in a pixel
+     * buffer (y * width + x).
+     */
+    int count = 0;
+    int cursor = 0;
+    int[] pixels = new int[0];
+    color[] colors = new color[0];
+    float[] timestamps = new float[0];
+
+    void reset(int size) {
+        /*
+         * Make room for size records and rewind the cursor.
+         */
+        if (pixels.length < size) {
+            pixels = new int[size];
+            colors = new color[size];
+            timestamps = new float[size];
+        }
+        count = size;
+        cursor = 0;
+    }
+
+    boolean drawUntil(float ts, int[] buffer) {
+        /*
+         * Write the colors of the records up to the provided
+         * timestamp to the pixel buffer. Returns true if any
+         * record was drawn.
+         */
+        int start = cursor;
+        while (cursor < count && timestamps[cursor] <= ts) {
+            buffer[pixels[cursor]] = colors[cursor];
+            cursor++;
+        }
+        return cursor > start;
+    }
+
+    boolean done() {
+        return cursor >= count;
+    }
+}
@@ -0,0 +1,160 @@
+/*
+ * PlaybackFile.pde
+ *
+ * Reader for the binary .pb playback format written
+ * by mp3toimage.playback in the Python code. The
+ * header is read up front and the records are read
+ * one chunk at a time as the song plays: a chunk is
+ * only loaded once the song gets to its first
+ * timestamp (from the chunk header).
+ *
+ *  Created on: October 18, 2026
+ */
+import java.io.BufferedInputStream;
+import java.io.DataInputStream;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.util.zip.DataFormatException;
+import java.util.zip.Inflater;
+
+class PlaybackFile {
+    /*
+     * A binary playback file. Has the song path, resolution,
+     * palette and the chunks of records.
+     */
+    static final int RECORD_SIZE = 10;
+    static final int CHUNK_HEADER_SIZE = 16;
+    static final int FLAG_COMPRESSED = 0x1;
+
+    private DataInputStream input;
+    private boolean compressed;
+    private boolean finished = false;
+    // Header of the next chunk, read ahead (-1 until it's read)
+    private int nextCount = -1;
+    private float nextFirstTime;
+    private int nextSize;
+    // Payload buffers reused from chunk to chunk
+    private byte[] payload = new byte[0];
+    private byte[] records = new byte[0];
+
+    String songPath;
+    int resolutionX;
+    int resolutionY;
+    float pixelTime;
+    color[] palette;
+
+    PlaybackFile(String filepath) throws IOException {
+        input = new DataInputStream(new BufferedInputStream(createInput(filepath)));
+
+        ByteBuffer header = read(8);
+        byte[] magic = new byte[5];
+        header.get(magic);
+        if (!new String(magic, "US-ASCII").equals("MP3PB")) {
+            throw new IOException(filepath + " is not a binary playback file");
+        }
+        header.get();  // Version
+        compressed = (header.getShort() & FLAG_COMPRESSED) != 0;
+
+        byte[] path = new byte[read(2).getShort() & 0xFFFF];
+        input.readFully(path);
+        songPath = new String(path, "UTF-8");
+
+        ByteBuffer resolution = read(16);
+        resolutionX = resolution.getInt();
+        resolutionY = resolution.getInt();
+        pixelTime = (float)resolution.getDouble();
+
+        palette = new color[read(2).getShort() & 0xFFFF];
+        ByteBuffer colors = read(palette.length * 4);
+        for (int i = 0; i < palette.length; i++) {
+            int r = colors.get() & 0xFF;
+            int g = colors.get() & 0xFF;
+            int b = colors.get() & 0xFF;
+            int a = colors.get() & 0xFF;
+            palette[i] = color(r, g, b, a);
+        }
+    }
+
+    float nextChunkTime() throws IOException {
+        /*
+         * Get the timestamp of the first record of the next
+         * chunk. Infinity once every chunk has been read.
+         */
+        if (finished) {
+            return Float.POSITIVE_INFINITY;
+        }
+        if (nextCount < 0) {
+            ByteBuffer header = read(CHUNK_HEADER_SIZE);
+            nextCount = header.getInt();
+            nextFirstTime = header.getFloat();
+            header.getFloat();  // Last timestamp
+            nextSize = header.getInt();
+            if (nextCount == 0) {
+                finished = true;
+                input.close();
+                return Float.POSITIVE_INFINITY;
+            }
+        }
+        return nextFirstTime;
+    }
+
+    boolean readChunk(PlaybackChunk chunk) throws IOException {
+        /*
+         * Read the records of the next chunk into chunk (its
+         * arrays are reused). Returns false once every chunk
+         * has been read.
+         */
+        if (nextChunkTime() == Float.POSITIVE_INFINITY) {
+            return false;
+        }
+
+        int count = nextCount;
+        int size = count * RECORD_SIZE;
+        if (payload.length < nextSize) {
+            payload = new byte[nextSize];
+        }
+        input.readFully(payload, 0, nextSize);
+        byte[] data = payload;
+        if (compressed) {
+            if (records.length < size) {
+                records = new byte[size];
+            }
+            inflate(payload, nextSize, records, size);
+            data = records;
+        }
+        nextCount = -1;
+
+        chunk.reset(count);
+        ByteBuffer buffer = ByteBuffer.wrap(data, 0, size).order(ByteOrder.LITTLE_ENDIAN);
+        for (int i = 0; i < count; i++) {
+            int x = buffer.getShort() & 0xFFFF;
+            int y = buffer.getShort() & 0xFFFF;
+            int c = buffer.getShort() & 0xFFFF;
+            chunk.pixels[i] = y * resolutionX + x;
+            chunk.colors[i] = palette[c];
+            chunk.timestamps[i] = buffer.getFloat();
+        }
+        return true;
+    }
+
+    private ByteBuffer read(int size) throws IOException {
+        byte[] data = new byte[size];
+        input.readFully(data);
+        return ByteBuffer.wrap(data).order(ByteOrder.LITTLE_ENDIAN);
+    }
+
+    private void inflate(byte[] data, int length, byte[] out, int size) throws IOException {
+        Inflater inflater = new Inflater();
+        inflater.setInput(data, 0, length);
+        try {
+            int offset = 0;
+            while (offset < size && !inflater.finished()) {
+                offset += inflater.inflate(out, offset, size - offset);
+            }
+        } catch (DataFormatException e) {
+            throw new IOException(e);
+        } finally {
+            inflater.end();
+        }
+    }
+}
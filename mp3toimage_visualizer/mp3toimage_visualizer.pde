@@ -4,7 +4,12 @@
  * MP3 to image visualization sketch. Reads in
  * a .pb file generated with Python and plays
  * it back here. (song file must exist in
- * original location).
+ * original location). The records are loaded a
+ * chunk at a time as the song plays and drawn to
+ * a pixel buffer that's shown once per frame.
+ * Text .pb files from older versions can be
+ * converted with:
+ *     python -m mp3toimage.playback old.pb new.pb
  *
  *  Created on: October 26, 2021
  *      Author: Sean LaPlante
@@ -14,11 +19,12 @@ import processing.sound.*;
 SoundFile soundFile = null;
 String soundFilePath = null;
 String pbFilePath = null;
+PlaybackFile pbFile = null;
 boolean setupComplete = false;
 int resolutionX = 0;
 int resolutionY = 0;
-int drawIdx = 0;
-ArrayList<PlaybackItem> pbItems = new ArrayList<PlaybackItem>();
+PlaybackChunk pbChunk = new PlaybackChunk();
+PImage canvas = null;
 
 
 void fileSelected(File selection) {
@@ -31,47 +37,6 @@ void fileSelected(File selection) {
 }
 
 
-void parseFile(String filepath) {
-    BufferedReader reader = createReader(filepath);
-    String line = null;
-    int index = -1;
-
-    try {
-        while ((line = reader.readLine()) != null) {
-            index++;
-
-            if (index == 0) {
-                // First item is the full path to the song file
-                soundFilePath = line;
-                continue;
-            }
-
-            // All items begin with an x and y
-            String[] pieces = split(line, ",");
-            int x = int(pieces[0]);
-            int y = int(pieces[1]);
-
-            if (index == 1) {
-                // but, the second item is just the image resolution. So just x,y
-                resolutionX = x;
-                resolutionY = y;
-                continue;
-            }
-
-            int r = int(pieces[2]);
-            int g = int(pieces[3]);
-            int b = int(pieces[4]);
-            int a = int(pieces[5]);
-            float timestamp = float(pieces[6]);
-
-            pbItems.add(new PlaybackItem(x, y, r, g, b, a, timestamp));
-        }
-        reader.close();
-    } catch (IOException e) {
-        e.printStackTrace();
-    }
-}
-
 void setup() {
     size(600, 600);
     frameRate(90);
@@ -81,12 +46,19 @@ void setup() {
 
 void draw() {
     if (pbFilePath != null && !setupComplete) {
-        println("Parsing: " + pbFilePath);
-        parseFile(pbFilePath);
-        if (soundFilePath == null) {
+        println("Opening: " + pbFilePath);
+        try {
+            pbFile = new PlaybackFile(pbFilePath);
+        } catch (IOException e) {
+            e.printStackTrace();
             exit();
+            return;
         }
+        soundFilePath = pbFile.songPath;
+        resolutionX = pbFile.resolutionX;
+        resolutionY = pbFile.resolutionY;
         println("Image Resolution: " + resolutionX + "x" + resolutionY);
+        canvas = createImage(resolutionX, resolutionY, ARGB);
         println("Playing: " + soundFilePath);
 
         // Resize the window
@@ -105,20 +77,31 @@ void draw() {
         setupComplete = true;
     }
 
-    if (!setupComplete || !soundFile.isPlaying() || pbItems.size() == 0) {
+    if (!setupComplete || !soundFile.isPlaying()) {
         return;
     }
 
+    // Draw the records up to the song position, loading the
+    // next chunks once the song gets to them
     float songPos = soundFile.position();
-    int count = 0;
-    PlaybackItem item = pbItems.get(0);
-    while(pbItems.size() > 0 && item.should_pop(songPos)) {
-        item = pbItems.get(0);
-        item.display();
-        pbItems.remove(0);
-        count++;
+    boolean changed = false;
+    canvas.loadPixels();
+    try {
+        while (true) {
+            changed |= pbChunk.drawUntil(songPos, canvas.pixels);
+            if (!pbChunk.done() || pbFile.nextChunkTime() > songPos || !pbFile.readChunk(pbChunk)) {
+                break;
+            }
+        }
+    } catch (IOException e) {
+        e.printStackTrace();
+        exit();
+        return;
     }
-    if (count >= 1000) {
-        println("TOO MUCH DATA. Drawing is likely to fall behind.");
+
+    if (changed) {
+        canvas.updatePixels();
+        background(204);
+        image(canvas, 0, 0);
     }
 }
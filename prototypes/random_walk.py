@@ -1,9 +1,15 @@
-"""Generate an image by randomly walking."""
+"""Generate an image by randomly walking.
+
+Run from the repo root: python -m prototypes.random_walk
+"""
 import random
 
 import numpy as np
 from PIL import Image
 
+from mp3toimage.canvas import new_canvas
+from mp3toimage.util import Color
+
 WIDTH = 64
 HEIGHT = 64
 INITIAL_COLOR = (0, 0, 0, 0)  # Transparent
@@ -18,15 +24,7 @@ class Point:
 
 def generate_pixels() -> np.ndarray:
     """Generate pixels of an image with the provided resolution."""
-    pixels = []
-
-    for _row in range(HEIGHT):
-        cur_row = []
-        for _col in range(WIDTH):
-            cur_row.append(INITIAL_COLOR)
-        pixels.append(cur_row)
-
-    return np.array(pixels, dtype=np.uint8)
+    return new_canvas(Point(WIDTH, HEIGHT), Color.from_tuple(INITIAL_COLOR))
 
 
 def walk_pixels(pixels: np.ndarray):
@@ -1,24 +1,23 @@
+"""Generate a solid red square.
+
+Run from the repo root: python -m prototypes.red_square
+"""
 import numpy as np
 from PIL import Image
 from typing import Tuple
 
+from mp3toimage.canvas import new_canvas
+from mp3toimage.util import Point, Color
+
 SQUARE_COLOR = (255, 0, 0, 255)  # Let's make a red square
 ICON_SIZE = (512, 512)  # The recommended minimum size from WordPress
 
 
 def generate_pixels(resolution: Tuple[int, int]) -> np.ndarray:
     """Generate pixels of an image with the provided resolution."""
-    pixels = []
-
     # Eventually I'll extend this to generate an image one pixel at a time
     # based on an input song.
-    for _row in range(resolution[1]):
-        cur_row = []
-        for _col in range(resolution[0]):
-            cur_row.append(SQUARE_COLOR)
-        pixels.append(cur_row)
-
-    return np.array(pixels, dtype=np.uint8)
+    return new_canvas(Point(*resolution), Color.from_tuple(SQUARE_COLOR))
 
 
 def main():